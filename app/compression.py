@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Прозрачное сжатие объектов хранилища
+import io
+import math
+import zlib
+from collections import Counter
+from pathlib import Path
+from typing import BinaryIO, Optional, Tuple
+
+try:
+    import zstandard # Необязательная зависимость: без нее используется zlib
+except ImportError:
+    zstandard = None
+
+# Заголовок сжатого объекта: MAGIC + кодек (1 байт) + уровень сжатия (1 байт).
+# Несжатые объекты хранятся без заголовка, если только их содержимое
+# само не начинается с MAGIC - тогда заголовок с CODEC_NONE снимает неоднозначность.
+MAGIC = b"\x89UOB"
+HEADER_SIZE = len(MAGIC) + 2
+
+CODEC_NONE = 0
+CODEC_ZLIB = 1
+CODEC_ZSTD = 2
+
+CODEC_NAMES = {"none": CODEC_NONE, "zlib": CODEC_ZLIB, "zstd": CODEC_ZSTD}
+
+# Уровни сжатия: быстрый - при сохранении версии, максимальный - при фоновом пересжатии
+FAST_LEVELS = {CODEC_ZLIB: 1, CODEC_ZSTD: 3}
+MAX_LEVELS = {CODEC_ZLIB: 9, CODEC_ZSTD: 19}
+
+IO_BLOCK_SIZE = 256 * 1024
+SAMPLE_SIZE = 16 * 1024
+# Данные с энтропией выше порога (бит на байт) считаются уже сжатыми
+ENTROPY_THRESHOLD = 7.5
+
+# Сигнатуры форматов, которые уже сжаты внутри (JPEG, PNG, ZIP/DOCX/XLSX, архивы, медиа)
+_COMPRESSED_SIGNATURES = (
+    b"\xff\xd8\xff", b"\x89PNG", b"GIF8", b"PK\x03\x04", b"\x1f\x8b", b"7z\xbc\xaf\x27\x1c",
+    b"Rar!", b"\xfd7zXZ\x00", b"\x28\xb5\x2f\xfd", b"BZh", b"ID3", b"OggS", b"fLaC",
+)
+
+
+def is_codec_available(codec: int) -> bool:
+    return codec != CODEC_ZSTD or zstandard is not None
+
+
+def default_codec() -> int:
+    """zstd, если установлен модуль zstandard, иначе zlib."""
+    return CODEC_ZSTD if zstandard is not None else CODEC_ZLIB
+
+
+def codec_from_name(name: str) -> int:
+    """Преобразует имя кодека из настроек ("auto", "zstd", "zlib", "none") в его код."""
+    codec = CODEC_NAMES.get(name)
+    if codec is None or not is_codec_available(codec):
+        return default_codec()
+    return codec
+
+
+# --- Определение несжимаемых данных ---
+
+def _entropy(sample: bytes) -> float:
+    """Энтропия Шеннона выборки в битах на байт."""
+    if not sample:
+        return 0.0
+    total = len(sample)
+    return -sum(count / total * math.log2(count / total) for count in Counter(sample).values())
+
+
+def is_incompressible(head: bytes, sample: bytes) -> bool:
+    """
+    Быстрая проверка, стоит ли сжимать данные.
+    head - начало данных (для проверки сигнатуры формата),
+    sample - выборка из середины (PDF, например, начинается с текста, но внутри сжат).
+    """
+    if head.startswith(_COMPRESSED_SIGNATURES) or head[4:8] == b"ftyp" or \
+            (head.startswith(b"RIFF") and head[8:12] in (b"WEBP", b"AVI ")):
+        return True
+    return _entropy(sample) >= ENTROPY_THRESHOLD
+
+
+def is_data_incompressible(data: bytes) -> bool:
+    middle = len(data) // 2
+    return is_incompressible(data[:SAMPLE_SIZE], data[middle:middle + SAMPLE_SIZE])
+
+
+def is_file_incompressible(f: BinaryIO, file_size: int) -> bool:
+    """
+    Проверяет открытый файл по сигнатуре и выборкам из начала и середины, не читая его целиком.
+    Позиция чтения возвращается в начало файла.
+    """
+    head = f.read(SAMPLE_SIZE)
+    if file_size > 2 * SAMPLE_SIZE:
+        f.seek(file_size // 2)
+        sample = f.read(SAMPLE_SIZE)
+    else:
+        sample = head
+    f.seek(0)
+    return is_incompressible(head, sample)
+
+
+# --- Заголовок ---
+
+def make_header(codec: int, level: int = 0) -> bytes:
+    return MAGIC + bytes((codec, level))
+
+
+def parse_header(head: bytes) -> Optional[Tuple[int, int]]:
+    """Возвращает (кодек, уровень) или None, если данные хранятся без заголовка."""
+    if len(head) >= HEADER_SIZE and head.startswith(MAGIC):
+        return head[len(MAGIC)], head[len(MAGIC) + 1]
+    return None
+
+
+def read_header(file_path: Path) -> Optional[Tuple[int, int]]:
+    with open(file_path, "rb") as f:
+        return parse_header(f.read(HEADER_SIZE))
+
+
+def needs_raw_header(head: bytes) -> bool:
+    """Несжатым данным заголовок нужен, только если их начало само выглядит как заголовок."""
+    head = head[:len(MAGIC)]
+    return bool(head) and MAGIC.startswith(head)
+
+
+# --- Потоковое сжатие ---
+
+class _ZlibWriter:
+    def __init__(self, raw: BinaryIO, level: int):
+        self._raw = raw
+        self._compressor = zlib.compressobj(level)
+
+    def write(self, data):
+        self._raw.write(self._compressor.compress(data))
+
+    def finish(self):
+        self._raw.write(self._compressor.flush())
+
+
+class _ZstdWriter:
+    def __init__(self, raw: BinaryIO, level: int):
+        self._writer = zstandard.ZstdCompressor(level=level).stream_writer(raw, closefd=False)
+
+    def write(self, data):
+        self._writer.write(data)
+
+    def finish(self):
+        self._writer.flush(zstandard.FLUSH_FRAME)
+
+
+class _RawWriter:
+    def __init__(self, raw: BinaryIO):
+        self._raw = raw
+
+    def write(self, data):
+        self._raw.write(data)
+
+    def finish(self):
+        pass
+
+
+class EncodingWriter:
+    """
+    Пишет данные в поток в формате хранилища: с заголовком и сжатием
+    либо как есть (для несжимаемых данных).
+    """
+
+    def __init__(self, raw: BinaryIO, codec: int, level: Optional[int] = None):
+        self._raw = raw
+        self._codec = codec
+        self._level = level if level is not None else FAST_LEVELS.get(codec, 0)
+        self._writer = None
+
+    def write(self, data):
+        if self._writer is None:
+            self._start(bytes(data[:len(MAGIC)]))
+        self._writer.write(data)
+
+    def _start(self, head: bytes):
+        if self._codec == CODEC_NONE:
+            if needs_raw_header(head):
+                self._raw.write(make_header(CODEC_NONE))
+            self._writer = _RawWriter(self._raw)
+            return
+        self._raw.write(make_header(self._codec, self._level))
+        if self._codec == CODEC_ZSTD:
+            self._writer = _ZstdWriter(self._raw, self._level)
+        else:
+            self._writer = _ZlibWriter(self._raw, self._level)
+
+    def finish(self):
+        if self._writer is None:
+            self._start(b"")
+        self._writer.finish()
+
+
+# --- Потоковое чтение ---
+
+class _ZlibReader(io.RawIOBase):
+    """Распаковывает zlib-поток порциями, не загружая объект в память."""
+
+    def __init__(self, raw: BinaryIO):
+        super().__init__()
+        self._raw = raw
+        self._decompressor = zlib.decompressobj()
+        self._buffer = b""
+        self._eof = False
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while not self._buffer and not self._eof:
+            data = self._decompressor.unconsumed_tail or self._raw.read(IO_BLOCK_SIZE)
+            if data:
+                self._buffer = self._decompressor.decompress(data, max(len(buffer), IO_BLOCK_SIZE))
+            else:
+                self._buffer = self._decompressor.flush()
+                self._eof = True
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+    def close(self):
+        self._raw.close()
+        super().close()
+
+
+def open_decoded(raw: BinaryIO) -> BinaryIO:
+    """
+    Оборачивает поток сохраненного объекта в поток распакованного содержимого.
+    Поток raw должен поддерживать seek (обычный файл).
+    """
+    start = raw.tell()
+    header = parse_header(raw.read(HEADER_SIZE))
+    if header is None:
+        raw.seek(start)
+        return raw
+    codec = header[0]
+    if codec == CODEC_NONE:
+        return raw
+    if codec == CODEC_ZLIB:
+        return io.BufferedReader(_ZlibReader(raw), IO_BLOCK_SIZE)
+    if codec == CODEC_ZSTD:
+        if zstandard is None:
+            raw.close()
+            raise OSError("Объект сжат zstd, но модуль zstandard не установлен")
+        return zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True, closefd=True)
+    raw.close()
+    raise OSError("Неизвестный кодек объекта: {0}".format(codec))
+
+
+def open_stored(file_path: Path) -> BinaryIO:
+    """Открывает файл объекта хранилища для чтения распакованного содержимого."""
+    return open_decoded(open(file_path, "rb"))
+
+
+def is_plain_file(file_path: Path) -> bool:
+    """Проверяет, что файл хранится как есть и его можно читать напрямую."""
+    with open(file_path, "rb") as f:
+        return not f.read(len(MAGIC)) == MAGIC
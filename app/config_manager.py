@@ -7,6 +7,8 @@ from typing import Any, Dict, List, Set
 from PySide6.QtCore import QObject, Signal
 from PySide6.QtWidgets import QSystemTrayIcon
 
+from app.watch_rules import WatchRules
+
 
 class ConfigManager(QObject):
     """
@@ -37,9 +39,14 @@ class ConfigManager(QObject):
             "language": "auto",
             "launch_on_startup": False,
             "is_first_launch": True, # Флаг для первого запуска
+            "compression_codec": "auto", # Кодек сжатия хранилища: "auto", "zstd", "zlib" или "none"
+            "hash_algorithm": "sha256", # Алгоритм хеширования содержимого: "sha256" или "blake3"
+            # Читать крупные файлы через отображение в память. В Windows такой файл нельзя обрезать, пока он читается
+            "use_mmap": False,
         }
 
         self._settings = self._default_settings.copy()
+        self._watch_rules = None # Правила отслеживания, скомпилированные для текущего списка элементов
         self.load()
 
     def _get_app_data_path(self) -> Path:
@@ -178,7 +185,9 @@ class ConfigManager(QObject):
         def make_hashable(d):
             # Сортируем исключения, чтобы порядок не влиял на сравнение
             exclusions = tuple(sorted(d.get("exclusions", [])))
-            return (d["path"], d["type"], exclusions)
+            patterns = (tuple(sorted(d.get("exclude_patterns", []))), tuple(sorted(d.get("include_patterns", []))))
+            return (d["path"], d["type"], exclusions, d.get("baseline", "full"), patterns,
+                    bool(d.get("use_ignore_files", False)))
 
         set_a = {make_hashable(item) for item in self._normalize_items_for_storage(list_a)}
         set_b = {make_hashable(item) for item in self._normalize_items_for_storage(list_b)}
@@ -195,6 +204,12 @@ class ConfigManager(QObject):
         """Возвращает список отслеживаемых элементов."""
         return self.get("watched_items", [])
 
+    def get_watch_rules(self) -> WatchRules:
+        """Возвращает правила отслеживания; они компилируются один раз на каждое изменение списка элементов."""
+        if self._watch_rules is None or self._watch_rules.items is not self.get_watched_items():
+            self._watch_rules = WatchRules(self.get_watched_items())
+        return self._watch_rules
+
     def set_watched_items(self, items: List[Dict]):
         """Устанавливает список отслеживаемых элементов."""
         self.set("watched_items", items)
\ No newline at end of file
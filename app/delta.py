@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+# Бинарные дельты между версиями файла
+from typing import Dict, Optional
+
+DELTA_MAGIC = b"UDL1"
+# Размер блока, по которому ищутся совпадения с базовой версией
+BLOCK_SIZE = 32
+# Ускорение поиска на участках без совпадений (как в LZ4): после каждых 2**SKIP_SHIFT промахов
+# шаг растет на байт, но не больше MAX_SKIP. MAX_SKIP взаимно прост с BLOCK_SIZE, поэтому
+# длинный совпадающий участок все равно попадет на выровненный блок базовой версии.
+SKIP_SHIFT = 6
+MAX_SKIP = BLOCK_SIZE - 1
+
+_OP_COPY = 0x01
+_OP_INSERT = 0x02
+
+
+class DeltaError(ValueError):
+    """Дельта повреждена или не подходит к базовой версии."""
+
+
+def _write_varint(out: bytearray, value: int):
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(data: bytes, pos: int):
+    result, shift = 0, 0
+    while True:
+        if pos >= len(data):
+            raise DeltaError("Неожиданный конец дельты")
+        byte = data[pos]
+        pos += 1
+        result |= (byte & 0x7F) << shift
+        if not byte & 0x80:
+            return result, pos
+        shift += 7
+
+
+def _common_prefix_length(a: bytes, a_start: int, b: bytes, b_start: int, limit: int) -> int:
+    """Длина совпадающего участка a[a_start:] и b[b_start:], но не больше limit."""
+    length = 0
+    # Сравниваем срезами убывающего размера: это выполняется на стороне C,
+    # а побайтовый цикл на Python остается только для последних байтов.
+    for step in (65536, 4096, 256, 16, 1):
+        while length + step <= limit and \
+                a[a_start + length:a_start + length + step] == b[b_start + length:b_start + length + step]:
+            length += step
+    return length
+
+
+def encode(base: bytes, target: bytes, max_size: Optional[int] = None) -> Optional[bytes]:
+    """
+    Строит дельту, превращающую base в target.
+    Дельта состоит из команд COPY (смещение и длина участка базовой версии)
+    и INSERT (новые байты).
+    Если задан max_size и дельта заведомо окажется больше, кодирование прекращается и возвращается None.
+    """
+    out = bytearray(DELTA_MAGIC)
+    _write_varint(out, len(base))
+    _write_varint(out, len(target))
+
+    # Индекс блоков базовой версии (по выровненным смещениям)
+    index: Dict[bytes, int] = {}
+    for offset in range(0, len(base) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        index.setdefault(base[offset:offset + BLOCK_SIZE], offset)
+
+    def emit_insert(start: int, end: int):
+        if end > start:
+            out.append(_OP_INSERT)
+            _write_varint(out, end - start)
+            out.extend(target[start:end])
+
+    literal_start = 0
+    position = 0
+    misses = 0
+    target_length = len(target)
+    while position + BLOCK_SIZE <= target_length:
+        base_offset = index.get(target[position:position + BLOCK_SIZE])
+        if base_offset is None:
+            misses += 1
+            position += min(1 + (misses >> SKIP_SHIFT), MAX_SKIP)
+            if max_size is not None and len(out) + position - literal_start > max_size:
+                return None
+            continue
+        misses = 0
+
+        # Расширяем совпадение назад, в еще не закодированные (в том числе пропущенные) байты
+        while position > literal_start and base_offset > 0 and \
+                target[position - 1] == base[base_offset - 1]:
+            position -= 1
+            base_offset -= 1
+
+        limit = min(target_length - position, len(base) - base_offset)
+        length = _common_prefix_length(target, position, base, base_offset, limit)
+
+        emit_insert(literal_start, position)
+        out.append(_OP_COPY)
+        _write_varint(out, base_offset)
+        _write_varint(out, length)
+        position += length
+        literal_start = position
+
+    emit_insert(literal_start, target_length)
+    if max_size is not None and len(out) > max_size:
+        return None
+    return bytes(out)
+
+
+def apply(base: bytes, delta: bytes) -> bytes:
+    """Восстанавливает целевую версию по базовой версии и дельте."""
+    if not delta.startswith(DELTA_MAGIC):
+        raise DeltaError("Неизвестный формат дельты")
+    pos = len(DELTA_MAGIC)
+    base_length, pos = _read_varint(delta, pos)
+    target_length, pos = _read_varint(delta, pos)
+    if base_length != len(base):
+        raise DeltaError("Дельта построена для другой базовой версии")
+
+    out = bytearray()
+    while pos < len(delta):
+        op = delta[pos]
+        pos += 1
+        if op == _OP_COPY:
+            offset, pos = _read_varint(delta, pos)
+            length, pos = _read_varint(delta, pos)
+            if offset + length > len(base):
+                raise DeltaError("Команда COPY выходит за границы базовой версии")
+            out += base[offset:offset + length]
+        elif op == _OP_INSERT:
+            length, pos = _read_varint(delta, pos)
+            if pos + length > len(delta):
+                raise DeltaError("Неожиданный конец дельты")
+            out += delta[pos:pos + length]
+            pos += length
+        else:
+            raise DeltaError("Неизвестная команда дельты: {0}".format(op))
+
+    if len(out) != target_length:
+        raise DeltaError("Размер восстановленной версии не совпадает с ожидаемым")
+    return bytes(out)
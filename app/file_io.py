@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+# Низкоуровневые операции с файлами: копирование без участия пользовательского пространства,
+# последовательное чтение больших файлов с повторно используемым буфером
+import contextlib
+import errno
+import mmap
+import os
+import sys
+import threading
+from pathlib import Path
+from typing import BinaryIO, Iterator
+
+try:
+    import fcntl # Есть только на POSIX-системах
+except ImportError:
+    fcntl = None
+
+# Способы копирования без чтения данных в память процесса
+CLONE_FICLONE = "ficlone" # Клонирование экстентов (copy-on-write) на btrfs, XFS и т.п.
+CLONE_COPY_FILE_RANGE = "copy_file_range" # Копирование внутри ядра
+
+FICLONE = 0x40049409 # _IOW(0x94, 9, int) из linux/fs.h
+COPY_RANGE_BLOCK = 64 * 1024 * 1024
+
+# Размер буфера последовательного чтения: крупные блоки сокращают число системных вызовов
+# и вызовов хеширования/сжатия, а один буфер на поток не создает новый объект на каждый блок
+IO_BUFFER_SIZE = 2 * 1024 * 1024
+# После чтения файлов крупнее этого размера их страницы убираются из кеша ОС,
+# чтобы сохранение версии не вытесняло из памяти данные, с которыми работает пользователь
+DROP_CACHE_THRESHOLD = 32 * 1024 * 1024
+# Файлы крупнее этого размера можно читать через mmap (см. iter_blocks)
+MMAP_THRESHOLD = 64 * 1024 * 1024
+
+_thread_buffers = threading.local()
+
+# Ошибки, означающие, что файловая система (или пара файловых систем) не поддерживает способ копирования
+_UNSUPPORTED_ERRNOS = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTSUP, errno.EINVAL, errno.ENOSYS,
+                       errno.ENOTTY, errno.EPERM, errno.EBADF}
+
+
+def available_clone_methods() -> tuple:
+    """Способы копирования, которые в принципе доступны на этой платформе."""
+    methods = []
+    if fcntl is not None and sys.platform.startswith("linux"):
+        methods.append(CLONE_FICLONE)
+    if hasattr(os, "copy_file_range"):
+        methods.append(CLONE_COPY_FILE_RANGE)
+    return tuple(methods)
+
+
+def clone_file(method: str, source_fd: int, target_fd: int):
+    """
+    Копирует содержимое source_fd в пустой target_fd указанным способом.
+    Выбрасывает OSError, если способ не сработал (целевой файл может остаться частично заполненным).
+    """
+    if method == CLONE_FICLONE:
+        fcntl.ioctl(target_fd, FICLONE, source_fd)
+        return
+    offset = 0
+    while True:
+        copied = os.copy_file_range(source_fd, target_fd, COPY_RANGE_BLOCK, offset, offset)
+        if copied == 0:
+            return
+        offset += copied
+
+
+def is_unsupported_error(error: OSError) -> bool:
+    return error.errno in _UNSUPPORTED_ERRNOS
+
+
+# --- Последовательное чтение ---
+
+def _acquire_buffer() -> bytearray:
+    """Берет буфер чтения текущего потока; при вложенном чтении создается еще один буфер."""
+    buffer = getattr(_thread_buffers, "buffer", None)
+    _thread_buffers.buffer = None
+    return buffer if buffer is not None else bytearray(IO_BUFFER_SIZE)
+
+
+def _release_buffer(buffer: bytearray):
+    _thread_buffers.buffer = buffer
+
+
+def _fadvise(f: BinaryIO, advice_name: str):
+    advice = getattr(os, advice_name, None)
+    if advice is None or not hasattr(os, "posix_fadvise"):
+        return
+    try:
+        os.posix_fadvise(f.fileno(), 0, 0, advice)
+    except (OSError, ValueError):
+        pass # Подсказка необязательна: файловая система или объект файла могут ее не поддерживать
+
+
+@contextlib.contextmanager
+def open_sequential(file_path: Path, drop_cache: bool = True) -> Iterator[BinaryIO]:
+    """
+    Открывает файл для однократного последовательного чтения: без буферизации Python
+    (данные читаются прямо в буфер вызывающей стороны) и с подсказкой ОС о последовательном доступе.
+    Если drop_cache и прочитано больше DROP_CACHE_THRESHOLD, страницы файла убираются из кеша ОС.
+    Выбрасывает OSError.
+    """
+    f = open(file_path, "rb", buffering=0)
+    try:
+        _fadvise(f, "POSIX_FADV_SEQUENTIAL")
+        yield f
+        if drop_cache and f.tell() >= DROP_CACHE_THRESHOLD:
+            _fadvise(f, "POSIX_FADV_DONTNEED")
+    finally:
+        f.close()
+
+
+def iter_blocks(f: BinaryIO, use_mmap: bool = False) -> Iterator[memoryview]:
+    """
+    Читает поток до конца блоками в буфер потока (readinto) и отдает их как memoryview.
+    Блок действителен только до следующей итерации: его нужно обработать (хешировать, записать)
+    или скопировать. С use_mmap файл крупнее MMAP_THRESHOLD отображается в память целиком,
+    и блоки отдаются без копирования; если отобразить файл нельзя, используется обычное чтение.
+    """
+    if use_mmap:
+        mapped = _map_file(f)
+        if mapped is not None:
+            with mapped, memoryview(mapped) as view:
+                for offset in range(0, len(view), IO_BUFFER_SIZE):
+                    with view[offset:offset + IO_BUFFER_SIZE] as block:
+                        yield block
+            return
+
+    buffer = _acquire_buffer()
+    try:
+        with memoryview(buffer) as view:
+            while True:
+                read = f.readinto(buffer)
+                if not read:
+                    return
+                with view[:read] as block:
+                    yield block
+    finally:
+        _release_buffer(buffer)
+
+
+def _map_file(f: BinaryIO):
+    try:
+        if f.tell() != 0 or os.fstat(f.fileno()).st_size < MMAP_THRESHOLD:
+            return None
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None # Поток без файлового дескриптора или файловая система без поддержки mmap
+
+
+def copy_stream(source: BinaryIO, target: BinaryIO) -> int:
+    """Копирует поток через буфер текущего потока. Возвращает количество скопированных байт."""
+    copied = 0
+    for block in iter_blocks(source):
+        target.write(block)
+        copied += len(block)
+    return copied
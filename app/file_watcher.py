@@ -1,49 +1,43 @@
 # -*- coding: utf-8 -*-
 # Сервис отслеживания файлов
+import os
 import time
 from pathlib import Path
-from typing import List, Dict, Set
+from typing import Iterable, List, Dict, Optional, Set
 
 from PySide6.QtCore import QObject, Signal
 from PySide6.QtWidgets import QSystemTrayIcon
 from watchdog.observers import Observer
 from watchdog.events import FileSystemEventHandler, FileSystemEvent
 
+from app.ignore_files import IGNORE_FILE_NAMES
+from app.scanner import normalize_path
+from app.watch_rules import WatchRules
+
 
 class ChangeHandler(FileSystemEventHandler):
     """
     Обработчик событий файловой системы от watchdog.
-    Использует сложный набор правил для фильтрации событий.
+    Фильтрует события скомпилированными правилами отслеживания (WatchRules).
     """
-    def __init__(self, file_modified_signal: Signal, rules: Dict):
+    def __init__(self, file_modified_signal: Signal, rules: WatchRules):
         super().__init__()
         self.file_modified = file_modified_signal
         self._rules = rules
 
     def _is_path_allowed(self, path_str: str) -> bool:
         """Проверяет, соответствует ли путь правилам отслеживания."""
-        try:
-            path = Path(path_str).resolve()
-        except (OSError, RuntimeError):
-            # Если не удается разрешить путь (например, временный файл удален), игнорируем
-            return False
-
-        # 1. Прямая проверка отслеживаемых файлов
-        if path in self._rules.get('files', set()):
-            return True
-
-        # 2. Проверка по папкам и исключениям
-        for folder_path, exclusion_paths in self._rules.get('folders', {}).items():
-            if path.is_relative_to(folder_path):
-                # Файл находится в отслеживаемой папке. Теперь проверим, не исключен ли он.
-                is_excluded = any(path.is_relative_to(ex_path) for ex_path in exclusion_paths)
-                if not is_excluded:
-                    return True # Не исключен, значит, отслеживаем
-        
-        return False # Не попал ни под одно правило
+        return self._rules.is_watched(path_str)
+
+    def on_any_event(self, event: FileSystemEvent):
+        # Изменение .gitignore/.ignore сбрасывает кешированные правила его папки
+        for path in (event.src_path, getattr(event, "dest_path", "")):
+            if path and os.path.basename(path) in IGNORE_FILE_NAMES:
+                self._rules.ignore_file_changed(path)
 
     def on_modified(self, event: FileSystemEvent):
-        if Path(event.src_path).is_file() and not event.is_directory and self._is_path_allowed(event.src_path):
+        # Правила проверяются до обращения к файловой системе
+        if not event.is_directory and self._is_path_allowed(event.src_path) and Path(event.src_path).is_file():
             self.file_modified.emit(event.src_path)
 
     def on_created(self, event: FileSystemEvent):
@@ -51,10 +45,39 @@ class ChangeHandler(FileSystemEventHandler):
         # Необходимо добавить небольшую задержку, чтобы файл успел быть полностью записан.
         # Watchdog может генерировать on_created, когда файл еще не полностью доступен.
         # HistoryManager.add_file_version и так обрабатывает это, но явная проверка не помешает.
-        if Path(event.src_path).is_file() and not event.is_directory and self._is_path_allowed(event.src_path):
+        if not event.is_directory and self._is_path_allowed(event.src_path) and Path(event.src_path).is_file():
             self.file_modified.emit(event.src_path)
 
 
+class FileItemsHandler(ChangeHandler):
+    """
+    Обработчик нерекурсивных наблюдений за папками отдельно отслеживаемых файлов:
+    событие проходит, только если его путь - один из файлов-элементов (поиск в множестве, O(1)).
+    """
+    def _is_path_allowed(self, path_str: str) -> bool:
+        return normalize_path(path_str) in self._rules.file_keys
+
+
+def _plan_watches(folders: Iterable[Path], file_dirs: Iterable[Path]) -> Dict[Path, bool]:
+    """
+    Минимальный набор наблюдений {папка: рекурсивно ли}, покрывающий все элементы: папка внутри
+    другой рекурсивно наблюдаемой папки отдельного наблюдения не получает, а папки файлов-элементов
+    вне них наблюдаются нерекурсивно, по одному наблюдению на папку. При сортировке по компонентам
+    вложенные папки идут сразу за своим предком, поэтому достаточно сравнения с последним
+    оставленным рекурсивным корнем.
+    """
+    requested = {(path, True) for path in folders} | {(path, False) for path in file_dirs}
+    watches: Dict[Path, bool] = {}
+    last_root: Optional[Path] = None
+    for path, recursive in sorted(requested, key=lambda w: (w[0].parts, not w[1])):
+        if last_root is not None and path.is_relative_to(last_root):
+            continue
+        watches[path] = recursive
+        if recursive:
+            last_root = path
+    return watches
+
+
 class FileWatcher(QObject):
     """
     Сервис, который отслеживает изменения в указанных элементах
@@ -63,7 +86,7 @@ class FileWatcher(QObject):
     file_modified = Signal(str)
     file_watcher_notification = Signal(str, QSystemTrayIcon.MessageIcon)
 
-    def __init__(self, watched_items: List[Dict]):
+    def __init__(self, watched_items: List[Dict], rules: Optional[WatchRules] = None):
         super().__init__()
         self._observer = None
         self._is_paused_by_user = False
@@ -71,19 +94,24 @@ class FileWatcher(QObject):
         
         # --- Новая логика на основе правил ---
         self._watched_items = watched_items
-        self._rules = {}
-        self._folders_to_watch = set()
+        self._rules: Optional[WatchRules] = None
+        self._folders_to_watch: Dict[Path, bool] = {} # Папка -> наблюдается ли рекурсивно
+        self._saved_watch_count = 0 # Сколько наблюдений сэкономлено объединением перекрывающихся
         self._handler = None # Будет создан в _reset_observer_and_schedule
+        self._file_items_handler = None
 
-        self._reset_observer_and_schedule(watched_items)
+        self._reset_observer_and_schedule(watched_items, rules)
 
-    def _build_rules_and_paths(self, items: List[Dict]):
-        """Создает правила фильтрации и список уникальных папок для наблюдения."""
-        self._rules = {
-            'files': set(),      # {Path('C:/file1.txt'), ...}
-            'folders': {}        # {Path('C:/folder1'): {Path('C:/folder1/exclude1'), ...}}
-        }
-        self._folders_to_watch = set()
+    def _build_rules_and_paths(self, items: List[Dict], rules: Optional[WatchRules] = None):
+        """
+        Берет правила фильтрации (или компилирует их, если они не переданы)
+        и составляет минимальный список папок для наблюдения: вложенные и повторяющиеся
+        наблюдения объединяются, а лишние события отсекают правила. Для файла-элемента
+        его папка наблюдается нерекурсивно.
+        """
+        self._rules = rules if rules is not None else WatchRules(items)
+        folders: List[Path] = []
+        file_dirs: List[Path] = []
 
         for item in items:
             path_str = item.get("path")
@@ -97,32 +125,34 @@ class FileWatcher(QObject):
 
             resolved_path = path.resolve()
             if item_type == 'file':
-                self._rules['files'].add(resolved_path)
-                # Добавляем родительскую папку для наблюдения
-                self._folders_to_watch.add(resolved_path.parent)
+                # Добавляем родительскую папку для нерекурсивного наблюдения
+                file_dirs.append(resolved_path.parent)
             
             elif item_type == 'folder':
-                exclusions = {Path(ex).resolve() for ex in item.get("exclusions", [])}
-                self._rules['folders'][resolved_path] = exclusions
                 # Добавляем саму папку для наблюдения
-                self._folders_to_watch.add(resolved_path)
+                folders.append(resolved_path)
 
-    def _reset_observer_and_schedule(self, items: List[Dict]):
+        self._folders_to_watch = _plan_watches(folders, file_dirs)
+        self._saved_watch_count = len(folders) + len(file_dirs) - len(self._folders_to_watch)
+
+    def _reset_observer_and_schedule(self, items: List[Dict], rules: Optional[WatchRules] = None):
         """Пересоздает наблюдателя и планирует отслеживание на основе новых правил."""
         if self._observer and self._observer.is_alive():
             self._observer.stop()
             self._observer.join()
 
         self._watched_items = items
-        self._build_rules_and_paths(items)
+        self._build_rules_and_paths(items, rules)
         
         self._observer = Observer()
         self._handler = ChangeHandler(self.file_modified, self._rules)
+        self._file_items_handler = FileItemsHandler(self.file_modified, self._rules)
         self._scheduled_watches.clear()
 
-        for path in self._folders_to_watch:
+        for path, recursive in self._folders_to_watch.items():
             if path.exists():
-                watch = self._observer.schedule(self._handler, str(path), recursive=True)
+                handler = self._handler if recursive else self._file_items_handler
+                watch = self._observer.schedule(handler, str(path), recursive=recursive)
                 self._scheduled_watches.append(watch)
             else:
                  self.file_watcher_notification.emit(
@@ -130,8 +160,8 @@ class FileWatcher(QObject):
                     QSystemTrayIcon.Warning
                 )
 
-    def update_items(self, new_items: List[Dict]):
-        """Обновляет список отслеживаемых элементов."""
+    def update_items(self, new_items: List[Dict], rules: Optional[WatchRules] = None):
+        """Обновляет список отслеживаемых элементов и правила их отслеживания."""
         # Простое сравнение словарей достаточно, т.к. ConfigManager уже провел сложную проверку
         if self._watched_items == new_items:
             return
@@ -139,7 +169,7 @@ class FileWatcher(QObject):
         was_running = self.is_running()
         was_paused_by_user = self._is_paused_by_user
 
-        self._reset_observer_and_schedule(new_items)
+        self._reset_observer_and_schedule(new_items, rules)
 
         if was_running and not was_paused_by_user:
             self.start()
@@ -155,15 +185,15 @@ class FileWatcher(QObject):
             return
 
         if not self._observer or not self._observer.is_alive():
-            self._reset_observer_and_schedule(self._watched_items)
+            self._reset_observer_and_schedule(self._watched_items, self._rules)
 
         try:
             self._observer.start()
             watched_paths_str = ", ".join([str(p) for p in self._folders_to_watch])
-            self.file_watcher_notification.emit(
-                self.tr("Начинаю отслеживание папок: {0}").format(watched_paths_str),
-                QSystemTrayIcon.Information
-            )
+            message = self.tr("Начинаю отслеживание папок: {0}").format(watched_paths_str)
+            if self._saved_watch_count:
+                message += " " + self.tr("Объединено перекрывающихся наблюдений: {0}.").format(self._saved_watch_count)
+            self.file_watcher_notification.emit(message, QSystemTrayIcon.Information)
         except RuntimeError as e:
             self.file_watcher_notification.emit(
                 self.tr("Ошибка при запуске отслеживания файлов: {0}").format(e),
@@ -189,5 +219,9 @@ class FileWatcher(QObject):
     def is_paused(self) -> bool:
         return self._is_paused_by_user
 
+    def get_saved_watch_count(self) -> int:
+        """Сколько наблюдений не понадобилось благодаря объединению вложенных и повторяющихся."""
+        return self._saved_watch_count
+
     def get_watched_items(self) -> List[Dict]:
         return self._watched_items
\ No newline at end of file
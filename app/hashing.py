@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+# Алгоритмы хеширования содержимого, которым адресуются объекты хранилища
+import hashlib
+from typing import BinaryIO, Optional
+
+from app import file_io
+
+try:
+    import blake3 # Необязательная зависимость: быстрый криптографический хеш
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash # Необязательная зависимость: очень быстрый некриптографический хеш для предварительной проверки
+except ImportError:
+    xxhash = None
+
+# Оба алгоритма дают 256-битный дайджест, поэтому ключи объектов имеют один формат
+# (64 шестнадцатеричных символа), а алгоритм каждого объекта записан в таблице objects.
+ALGORITHM_SHA256 = "sha256"
+ALGORITHM_BLAKE3 = "blake3"
+DEFAULT_ALGORITHM = ALGORITHM_SHA256
+
+
+def is_available(algorithm: str) -> bool:
+    if algorithm == ALGORITHM_SHA256:
+        return True
+    if algorithm == ALGORITHM_BLAKE3:
+        return blake3 is not None
+    return False
+
+
+def algorithm_from_name(name: str) -> str:
+    """Преобразует имя алгоритма из настроек; недоступный или неизвестный алгоритм заменяется SHA-256."""
+    return name if is_available(name) else DEFAULT_ALGORITHM
+
+
+def new_hasher(algorithm: str):
+    """Создает объект хеширования с методами update() и hexdigest()."""
+    if algorithm == ALGORITHM_BLAKE3 and blake3 is not None:
+        return blake3.blake3()
+    if algorithm != ALGORITHM_SHA256:
+        raise ValueError("Алгоритм хеширования недоступен: {0}".format(algorithm))
+    return hashlib.sha256()
+
+
+def hash_bytes(algorithm: str, data: bytes) -> str:
+    hasher = new_hasher(algorithm)
+    hasher.update(data)
+    return hasher.hexdigest()
+
+
+def new_quick_hasher():
+    """
+    Хеш для предварительной проверки (xxh3-128) или None, если модуль xxhash не установлен.
+    Он не адресует объекты, а лишь позволяет быстро убедиться, что большой файл не изменился.
+    """
+    return xxhash.xxh3_128() if xxhash is not None else None
+
+
+def quick_hash_available() -> bool:
+    return xxhash is not None
+
+
+def quick_hash_stream(stream: BinaryIO, use_mmap: bool = False) -> Optional[str]:
+    hasher = new_quick_hasher()
+    if hasher is None:
+        return None
+    for block in file_io.iter_blocks(stream, use_mmap):
+        hasher.update(block)
+    return hasher.hexdigest()
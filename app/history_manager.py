@@ -1,13 +1,15 @@
 # -*- coding: utf-8 -*-
 # Управление версиями файлов (хранилищем)
-import hashlib
+import io
 import os
-import shutil
 import sqlite3
 import threading
-from datetime import datetime
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta
 from pathlib import Path
-from typing import List, Tuple, Optional, Dict, Set
+from typing import List, Tuple, Optional, Dict, Set, BinaryIO, NamedTuple, Iterable
 import tempfile 
 import psutil # Для получения информации о диске
 
@@ -20,21 +22,89 @@ import fitz
 from docx import Document 
 from openpyxl import load_workbook 
 
+from app import compression, file_io, hashing, path_patterns, scanner, schema
+from app.object_store import ObjectStore, StagedObject
+from app.watch_rules import WatchRules
+
+
+class ScanProgress(NamedTuple):
+    """Снимок хода сканирования, который ScanWorker публикует не чаще раза в PROGRESS_INTERVAL_S."""
+    files_done: int
+    files_total: int # 0, если файлы заранее не подсчитывались
+    bytes_done: int # Объем прочитанных (новых) файлов
+    files_per_second: float
+    bytes_per_second: float
+    eta_seconds: Optional[float] # None, если оценить нельзя
+    current_file: str
+
+
+class StagedVersion(NamedTuple):
+    """Первая версия файла, подготовленная HistoryManager.stage_initial_version."""
+    file_path: Path
+    fingerprint: Optional[Tuple[int, int, int, int]]
+    staged: Optional[StagedObject] # None - индексная базовая версия без содержимого
+    baseline_hash: Optional[str] = None
+    capture_pending: bool = False
+
+
+class StagedUpdate(NamedTuple):
+    """Новая версия отслеживаемого файла, подготовленная HistoryManager.stage_changed_version при сверке."""
+    file_path: Path
+    fingerprint: Optional[Tuple[int, int, int, int]]
+    staged: Optional[StagedObject] # None - содержимое не прочитано (не изменилось или сохраняется дельтой)
+    base_hash: Optional[str] # Хеш последней версии - база дельты
+    unchanged: bool = False # Содержимое совпадает с последней версией: обновляется только отпечаток
+
 
 class ScanWorker(QObject):
     """
     Рабочий, выполняющий сканирование файлов в отдельном потоке.
     Теперь понимает сложную структуру 'watched_items' с исключениями.
+
+    Элементы группируются по устройству (st_dev), и каждое устройство сканируется своей
+    "дорожкой" (_ScanLane): папки на разных дисках обходятся и читаются одновременно,
+    но не более MAX_PARALLEL_DEVICES дорожек сразу. Чтение, хеширование и копирование файлов
+    выполняют пулы потоков дорожек, всего не более PARALLEL_FILES потоков
+    (hashlib и файловый ввод-вывод отпускают GIL). Записи о версиях добавляются в БД
+    под блокировкой HistoryManager, по мере готовности файлов.
+
+    Ход сканирования публикуется снимками ScanProgress не чаще раза в PROGRESS_INTERVAL_S,
+    а не сигналом на каждый файл. Для оценки оставшегося времени общее число файлов берется
+    из предыдущего сканирования (число отслеживаемых путей элементов, один запрос к БД), а если
+    count_files_first включен - подсчитывается отдельным обходом без чтения перед сканированием.
+
+    Прерванное сканирование папки продолжается с места остановки: не реже раза
+    в CHECKPOINT_INTERVAL_S в БД сохраняется последняя папка (в детерминированном порядке
+    обхода scanner.walk_files), все файлы которой и всех папок до нее уже записаны.
     """
     finished = Signal()
-    progress = Signal(str)
+    progress = Signal(object) # ScanProgress
     scan_notification = Signal(str, QSystemTrayIcon.MessageIcon)
 
-    def __init__(self, history_manager, items_to_scan: List[Dict]):
+    PARALLEL_FILES = min(8, os.cpu_count() or 1)
+    MAX_PENDING_FILES = 4 * PARALLEL_FILES # Ограничение очереди, чтобы обход дерева не опережал чтение
+    MAX_PARALLEL_DEVICES = 4
+    PROGRESS_INTERVAL_S = 0.5
+    CHECKPOINT_INTERVAL_S = 5.0
+
+    def __init__(self, history_manager, items_to_scan: List[Dict], count_files_first: bool = False,
+                 rules: Optional[WatchRules] = None):
         super().__init__()
         self.history_manager = history_manager
         self.items_to_scan = items_to_scan
+        # Исключения папок берутся из общих скомпилированных правил отслеживания
+        self.rules = rules if rules is not None else WatchRules(items_to_scan)
+        self.count_files_first = count_files_first
         self._should_stop = False
+        # Счетчики для снимков хода сканирования (их обновляют все дорожки)
+        self._progress_lock = threading.Lock()
+        self._files_done = 0
+        self._files_total = 0
+        self._versions_updated = 0 # Новые версии файлов, измененных, пока приложение не работало
+        self._bytes_done = 0
+        self._current_file = ""
+        self._started_at = 0.0
+        self._last_report_at = 0.0
 
     def stop(self):
         self._should_stop = True
@@ -46,55 +116,306 @@ class ScanWorker(QObject):
                 self.tr("Началось фоновое сканирование файлов..."),
                 QSystemTrayIcon.Information
             )
-            for item in self.items_to_scan:
-                if self._should_stop: break
+            self._files_done, self._bytes_done, self._current_file = 0, 0, ""
+            self._versions_updated = 0
+            self._files_total = self._count_files() if self.count_files_first else self._estimate_files_total()
+            self._started_at = self._last_report_at = time.monotonic()
+
+            device_groups = self._group_by_device(self.items_to_scan)
+            lane_count = min(len(device_groups), self.MAX_PARALLEL_DEVICES)
+            # Общее ограничение потоков чтения делится между одновременно работающими дорожками
+            files_per_lane = max(1, self.PARALLEL_FILES // max(lane_count, 1))
+            lanes = [_ScanLane(self, items, files_per_lane) for items in device_groups]
+            if lane_count <= 1:
+                for lane in lanes:
+                    lane.run()
+            else:
+                with ThreadPoolExecutor(max_workers=lane_count) as lane_executor:
+                    lane_futures = [lane_executor.submit(lane.run) for lane in lanes]
+                    try:
+                        for future in lane_futures:
+                            future.result()
+                    except Exception:
+                        self._should_stop = True # Остальные дорожки останавливаются до выхода из пула
+                        raise
+
+            if self._versions_updated:
+                # Одно уведомление на сканирование, а не на каждый измененный файл
+                self.scan_notification.emit(
+                    self.tr("Сохранены новые версии файлов, измененных вне приложения: {0}").format(self._versions_updated),
+                    QSystemTrayIcon.Information
+                )
+            if self._should_stop:
+                self.scan_notification.emit(self.tr("Сканирование прервано."), QSystemTrayIcon.Warning)
+            else:
+                self._report_progress(force=True)
+                self.scan_notification.emit(self.tr("Сканирование завершено."), QSystemTrayIcon.Information)
+        except Exception as e:
+            self.scan_notification.emit(self.tr("Критическая ошибка сканирования: {0}").format(e), QSystemTrayIcon.Critical)
+        finally:
+            self.finished.emit()
+
+    @staticmethod
+    def _group_by_device(items: List[Dict]) -> List[List[Dict]]:
+        """Группирует элементы по устройству, сохраняя их порядок; недоступные пути идут в отдельную группу."""
+        groups: Dict[Optional[int], List[Dict]] = {}
+        for item in items:
+            try:
+                device = os.stat(item.get("path")).st_dev
+            except (OSError, TypeError, ValueError):
+                device = None # Дорожка сама сообщит, что путь не существует
+            groups.setdefault(device, []).append(item)
+        return list(groups.values())
+
+    @staticmethod
+    def _rules_key(item: Dict) -> str:
+        """Ключ правил исключений элемента: точка продолжения действительна только при тех же правилах."""
+        ignore_key = ["use_ignore_files"] if item.get("use_ignore_files") else []
+        return "\n".join(sorted(item.get("exclusions", [])) + path_patterns.item_pattern_keys(item) + ignore_key)
+
+    def _estimate_files_total(self) -> int:
+        """
+        Оценка числа файлов по предыдущему сканированию: сколько путей элементов уже отслеживается.
+        0 (первое сканирование) означает, что общее число неизвестно.
+        """
+        return sum(self.history_manager.count_tracked_paths_under(Path(item["path"]))
+                   for item in self.items_to_scan if item.get("path"))
+
+    def _count_files(self) -> int:
+        """Предварительный подсчет файлов для оценки оставшегося времени: только обход, без чтения."""
+        total = 0
+        for item in self.items_to_scan:
+            if self._should_stop: break
+            path_str = item.get("path")
+            if item.get("type") == "file":
+                total += 1 if os.path.isfile(path_str) else 0
+            elif item.get("type") == "folder" and os.path.isdir(path_str):
+                path, rules_key = Path(path_str), self._rules_key(item)
+                exclusion_keys = self.rules.exclusion_keys(item)
+                resume_after = self.history_manager.get_scan_checkpoint(str(path), rules_key)
+                dir_index = self.history_manager.get_dir_index(path, rules_key, self.history_manager.get_tracked_paths_under(path))
+                for _ in scanner.walk_files(str(path), exclusion_keys, lambda: self._should_stop, resume_after, dir_index,
+                                            self.rules.patterns(item), self.rules.ignore(item)):
+                    total += 1
+        return total
+
+    def _version_updated(self):
+        with self._progress_lock:
+            self._versions_updated += 1
+
+    def _file_done(self, file_name: str, bytes_read: int = 0):
+        """Учитывает обработанный дорожкой файл и при необходимости публикует снимок."""
+        with self._progress_lock:
+            self._files_done += 1
+            self._bytes_done += bytes_read
+            self._current_file = file_name
+        self._report_progress()
+
+    def _report_progress(self, force: bool = False):
+        """Публикует снимок хода сканирования, если с предыдущего прошло не меньше PROGRESS_INTERVAL_S."""
+        with self._progress_lock:
+            now = time.monotonic()
+            if not force and now - self._last_report_at < self.PROGRESS_INTERVAL_S:
+                return
+            self._last_report_at = now
+            elapsed = max(now - self._started_at, 1e-6)
+            files_per_second = self._files_done / elapsed
+            # Файлы могли появиться после подсчета: итог не меньше уже обработанного
+            files_total = max(self._files_total, self._files_done) if self._files_total else 0
+            eta_seconds = None
+            if files_total and files_per_second > 0:
+                eta_seconds = (files_total - self._files_done) / files_per_second
+            snapshot = ScanProgress(
+                self._files_done, files_total, self._bytes_done,
+                files_per_second, self._bytes_done / elapsed, eta_seconds, self._current_file
+            )
+        self.progress.emit(snapshot)
+
+
+class _ScanLane:
+    """
+    Сканирование элементов одного устройства для ScanWorker: обход, очередь файлов
+    на чтение в собственном пуле потоков, запись готовых файлов и точки продолжения.
+    """
+    def __init__(self, worker: ScanWorker, items: List[Dict], parallel_files: int):
+        self.worker = worker
+        self.history_manager = worker.history_manager
+        self.items = items
+        self.parallel_files = parallel_files
+        self.max_pending = max(1, worker.MAX_PENDING_FILES * parallel_files // worker.PARALLEL_FILES)
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pending: Dict[Future, Tuple[str, Optional[list]]] = {} # Файл и запись его папки в _dir_queue
+        # Уже отслеживаемые пути внутри текущего элемента с их сохраненными отпечатками
+        self._tracked_paths: Dict[str, Optional[Tuple[int, int, int, int]]] = {}
+        self._skipped_dirs: Set[str] = set() # Папки текущего элемента, не все файлы которых записаны
+        self._baseline = HistoryManager.BASELINE_FULL # Режим базовой версии текущего элемента
+        # Точка продолжения сканирования текущей папки
+        self._checkpoint_item: Optional[Tuple[str, str]] = None # (путь элемента, ключ правил исключений)
+        self._dir_queue: deque = deque() # [папка, незаписанных файлов] в порядке обхода
+        self._checkpoint: Optional[str] = None
+        self._saved_checkpoint: Optional[str] = None
+        self._last_checkpoint_at = 0.0
+
+    def _should_stop(self) -> bool:
+        return self.worker._should_stop
+
+    def run(self):
+        """Сканирует элементы дорожки. Ошибки отдельных файлов сообщаются и не прерывают сканирование."""
+        self._executor = ThreadPoolExecutor(max_workers=self.parallel_files)
+        try:
+            for item in self.items:
+                if self._should_stop(): break
 
                 path_str = item.get("path")
                 item_type = item.get("type")
-                exclusions = item.get("exclusions", [])
 
                 path = Path(path_str)
                 if not path.exists():
-                    self.scan_notification.emit(
-                        self.tr("Путь для сканирования не существует и будет проигнорирован: {0}").format(path_str),
+                    self.worker.scan_notification.emit(
+                        self.worker.tr("Путь для сканирования не существует и будет проигнорирован: {0}").format(path_str),
                         QSystemTrayIcon.Warning
                     )
                     continue
 
+                # Отслеживаемые пути элемента загружаются одним запросом по диапазону вместо запроса на каждый файл
+                self._tracked_paths = self.history_manager.get_tracked_fingerprints_under(path)
+                self._baseline = HistoryManager.baseline_from_name(item.get("baseline"))
                 if item_type == "file":
-                    self.progress.emit(path.name)
-                    try:
-                        self.history_manager.add_initial_version(path)
-                    except Exception as e:
-                        self.scan_notification.emit(self.tr("Ошибка при обработке {0}: {1}").format(path, e), QSystemTrayIcon.Warning)
+                    self._submit(str(path))
 
                 elif item_type == "folder":
-                    # Преобразуем строки исключений в Path объекты для корректной работы
-                    exclusion_paths = {Path(ex).resolve() for ex in exclusions}
-
-                    for root, dirs, files in os.walk(path):
-                        if self._should_stop: break
-
-                        # --- Эффективная логика исключений ---
-                        # Модифицируем 'dirs' на месте, чтобы os.walk не заходил в исключенные папки
-                        dirs[:] = [d for d in dirs if Path(root, d).resolve() not in exclusion_paths]
-
-                        for name in files:
-                            if self._should_stop: break
-                            file_path = Path(root) / name
-                            self.progress.emit(file_path.name)
-                            try:
-                                self.history_manager.add_initial_version(file_path)
-                            except Exception as e:
-                                self.scan_notification.emit(self.tr("Ошибка при обработке {0}: {1}").format(file_path, e), QSystemTrayIcon.Warning)
-                    if self._should_stop: self.scan_notification.emit(self.tr("Сканирование прервано."), QSystemTrayIcon.Warning)
-
-            if not self._should_stop:
-                self.scan_notification.emit(self.tr("Сканирование завершено."), QSystemTrayIcon.Information)
-        except Exception as e:
-            self.scan_notification.emit(self.tr("Критическая ошибка сканирования: {0}").format(e), QSystemTrayIcon.Critical)
+                    # Исключения и шаблоны скомпилированы заранее в правилах; исключенные поддеревья не читаются
+                    exclusion_keys = self.worker.rules.exclusion_keys(item)
+                    rules_key = ScanWorker._rules_key(item)
+                    resume_after = self._begin_checkpoints(str(path), rules_key)
+                    # Папки, не изменившиеся с прошлого сканирования, не читаются (см. scanner.DirIndex)
+                    dir_index = self.history_manager.get_dir_index(path, rules_key, self._tracked_paths)
+                    self._skipped_dirs.clear()
+                    for file_path, file_stat in scanner.walk_files(str(path), exclusion_keys, self._should_stop,
+                                                                   resume_after, dir_index, self.worker.rules.patterns(item),
+                                                                   self.worker.rules.ignore(item)):
+                        if self._should_stop(): break
+                        self._submit(file_path, file_stat)
+                    # Элемент считается просканированным, только когда все его файлы записаны
+                    self._drain(0)
+                    if not self._should_stop():
+                        self.history_manager.save_dir_index(path, dir_index, self._skipped_dirs, prune=resume_after is None)
+                        self.history_manager.save_scan_checkpoint(*self._checkpoint_item, None)
+                        self._checkpoint_item = None
+
+            self._drain(0)
         finally:
-            self.finished.emit()
+            # Недочитанные файлы отменяются, а прочитанные после остановки - отбрасываются
+            for future in self._pending:
+                future.cancel()
+            self._drain(0)
+            self._executor.shutdown(wait=True)
+            self._save_checkpoint()
+
+    def _submit(self, file_path: str, file_stat: Optional[os.stat_result] = None):
+        """
+        Отдает файл пулу на чтение и хеширование; при заполненной очереди сначала записывает готовые.
+        file_stat - данные stat, полученные при обходе папки (чтобы не запрашивать их повторно).
+        """
+        dir_entry = None
+        if self._checkpoint_item is not None:
+            # Файлы папки идут подряд, поэтому новая папка всегда добавляется в конец очереди
+            dir_path = os.path.dirname(file_path)
+            if not self._dir_queue or self._dir_queue[-1][0] != dir_path:
+                self._dir_queue.append([dir_path, 0])
+            dir_entry = self._dir_queue[-1]
+        if file_path in self._tracked_paths:
+            file_stat = self._changed_tracked_stat(file_path, file_stat)
+            if file_stat is None:
+                self.worker._file_done(os.path.basename(file_path))
+                return
+            stage, args = self.history_manager.stage_changed_version, (file_path, file_stat)
+        else:
+            stage, args = self.history_manager.stage_initial_version, (file_path, file_stat, self._baseline)
+        if len(self._pending) >= self.max_pending:
+            self._drain(self.max_pending - 1)
+        future = self._executor.submit(stage, *args)
+        self._pending[future] = (file_path, dir_entry)
+        if dir_entry is not None:
+            dir_entry[1] += 1
+
+    def _drain(self, max_pending: int):
+        """Дожидается готовых файлов и добавляет их версии, пока в очереди больше max_pending файлов."""
+        while len(self._pending) > max_pending:
+            done, _ = wait(self._pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                file_path, dir_entry = self._pending.pop(future)
+                if future.cancelled():
+                    continue
+                bytes_read = 0
+                try:
+                    staged_version = future.result()
+                    if self._should_stop():
+                        self.history_manager.discard_staged_version(staged_version)
+                        continue # Файл не записан, и его папка не может стать точкой продолжения
+                    if isinstance(staged_version, StagedUpdate):
+                        if self.history_manager.commit_changed_version(staged_version):
+                            self.worker._version_updated()
+                    else:
+                        self.history_manager.commit_initial_version(staged_version)
+                    bytes_read = staged_version.staged.data_size if staged_version.staged else 0
+                except Exception as e:
+                    self._skipped_dirs.add(os.path.dirname(file_path)) # Папку нужно будет прочитать снова
+                    self.worker.scan_notification.emit(
+                        self.worker.tr("Ошибка при обработке {0}: {1}").format(file_path, e), QSystemTrayIcon.Warning
+                    )
+                finally:
+                    self.worker._file_done(os.path.basename(file_path), bytes_read)
+                if dir_entry is not None:
+                    dir_entry[1] -= 1 # Файл записан (или не читается) и больше не задерживает свою папку
+            self._advance_checkpoint()
+
+    def _changed_tracked_stat(self, file_path: str, file_stat: Optional[os.stat_result]) -> Optional[os.stat_result]:
+        """
+        Сверяет отслеживаемый файл с отпечатком последней версии. Возвращает данные stat файла, если его
+        нужно прочитать (изменен, пока приложение не работало, или отпечатку нельзя доверять), иначе None.
+        Сам файл читается пулом дорожки, как и новые файлы (см. HistoryManager.stage_changed_version).
+        """
+        saved_fingerprint = self._tracked_paths[file_path]
+        try:
+            if file_stat is None:
+                file_stat = os.stat(file_path)
+        except OSError:
+            return None
+        if HistoryManager._same_fingerprint(self.history_manager._get_fingerprint(file_stat), saved_fingerprint):
+            return None
+        return file_stat
+
+    def _begin_checkpoints(self, item_path: str, rules_key: str) -> Optional[str]:
+        """Начинает учет точки продолжения для папки; возвращает папку, после которой продолжить обход."""
+        resume_after = self.history_manager.get_scan_checkpoint(item_path, rules_key)
+        self._checkpoint_item = (item_path, rules_key)
+        self._dir_queue.clear()
+        self._checkpoint = self._saved_checkpoint = resume_after
+        self._last_checkpoint_at = time.monotonic()
+        return resume_after
+
+    def _advance_checkpoint(self):
+        """Сдвигает точку продолжения на последнюю папку, все файлы которой и всех папок до нее записаны."""
+        # Последняя папка очереди может еще обходиться, поэтому она не снимается
+        while len(self._dir_queue) > 1 and self._dir_queue[0][1] == 0:
+            self._checkpoint = self._dir_queue.popleft()[0]
+        if time.monotonic() - self._last_checkpoint_at >= self.worker.CHECKPOINT_INTERVAL_S:
+            self._save_checkpoint()
+
+    def _save_checkpoint(self):
+        if self._checkpoint_item is None or self._checkpoint is None or self._checkpoint == self._saved_checkpoint:
+            return
+        try:
+            self.history_manager.save_scan_checkpoint(*self._checkpoint_item, self._checkpoint)
+        except sqlite3.Error as e:
+            # Например, БД уже закрыта при выходе: сканирование просто начнется с предыдущей точки
+            self.worker.scan_notification.emit(
+                self.worker.tr("Не удалось сохранить точку продолжения сканирования: {0}").format(e), QSystemTrayIcon.Warning
+            )
+            return
+        self._saved_checkpoint = self._checkpoint
+        self._last_checkpoint_at = time.monotonic()
 
 
 class CleanupWorker(QObject):
@@ -105,10 +426,11 @@ class CleanupWorker(QObject):
     progress = Signal(str)
     cleanup_notification = Signal(str, QSystemTrayIcon.MessageIcon)
 
-    def __init__(self, history_manager, watched_items: List[Dict]):
+    def __init__(self, history_manager, watched_items: List[Dict], rules: Optional[WatchRules] = None):
         super().__init__()
         self.history_manager = history_manager
         self.watched_items = watched_items
+        self.rules = rules
         self._should_stop = False
 
     def stop(self):
@@ -121,7 +443,8 @@ class CleanupWorker(QObject):
         )
         messages, files_deleted = self.history_manager.clean_unwatched_files_in_db(
             self.watched_items,
-            lambda: self._should_stop
+            lambda: self._should_stop,
+            self.rules
         )
         for msg, icon_type in messages:
             self.cleanup_notification.emit(msg, icon_type)
@@ -137,6 +460,37 @@ class CleanupWorker(QObject):
         self.finished.emit()
 
 
+class MaintenanceWorker(QObject):
+    """
+    Рабочий, выполняющий фоновое обслуживание хранилища в отдельном потоке.
+    Задачи берутся из HistoryManager.get_maintenance_tasks() и выполняются по очереди.
+    """
+    finished = Signal()
+    maintenance_notification = Signal(str, QSystemTrayIcon.MessageIcon)
+
+    def __init__(self, history_manager):
+        super().__init__()
+        self.history_manager = history_manager
+        self._should_stop = False
+
+    def stop(self):
+        self._should_stop = True
+
+    def run(self):
+        self._should_stop = False
+        try:
+            for task in self.history_manager.get_maintenance_tasks():
+                if self._should_stop: break
+                try:
+                    message = task(lambda: self._should_stop)
+                    if message:
+                        self.maintenance_notification.emit(message, QSystemTrayIcon.Information)
+                except Exception as e:
+                    self.maintenance_notification.emit(self.tr("Ошибка обслуживания хранилища: {0}").format(e), QSystemTrayIcon.Warning)
+        finally:
+            self.finished.emit()
+
+
 class HistoryManager(QObject):
     """
     Управляет хранилищем версий файлов.
@@ -150,7 +504,8 @@ class HistoryManager(QObject):
     version_deleted = Signal(int) # Испускается, когда версия удалена (file_id)
     files_deleted = Signal(list) # Испускается, когда файлы полностью удалены (список кортежей (file_id, original_path_str))
     history_notification = Signal(str, QSystemTrayIcon.MessageIcon)
-    scan_progress = Signal(str)
+    scan_progress = Signal(str) # Текстовое состояние сканирования (или обновления БД) для трея и окна истории
+    scan_statistics = Signal(object) # Снимок ScanProgress с числами для тех, кому нужен не только текст
 
     # Новый сигнал для обновления информации о хранилище
     # Аргументы: (процент_заполнения_иконки_0_1, размер_хранилища_форматировано,
@@ -160,6 +515,25 @@ class HistoryManager(QObject):
     DB_NAME = "metadata.db"
     OBJECTS_DIR = "objects"
     STORAGE_SCAN_INTERVAL_MS = 60 * 1000 # 1 минута
+    MAINTENANCE_INTERVAL_MS = 30 * 60 * 1000 # 30 минут
+    COLD_OBJECT_AGE = timedelta(days=7) # Объекты без новых версий дольше этого срока пересжимаются сильнее
+    STORAGE_RECONCILE_INTERVAL = timedelta(days=1) # Как часто счетчик объема сверяется с диском
+    STORAGE_RECONCILED_AT_KEY = "reconciled_at"
+    HASH_ALGORITHM_PROPERTY = "hash_algorithm" # Алгоритм хеширования новых объектов в таблице store_properties
+    # Файл, измененный недавнее этого срока, мог измениться еще раз в пределах точности mtime,
+    # поэтому его отпечаток не сохраняется
+    FINGERPRINT_RACY_WINDOW_NS = 2 * 1000 ** 3
+    # Режимы базовой версии при первом сканировании элемента (ключ "baseline"), от надежного к экономному:
+    # полная копия; индекс с фоновым захватом содержимого; отпечаток и хеш; только отпечаток.
+    # В индексных режимах содержимое сохраняется при первом замеченном изменении файла.
+    BASELINE_FULL = "full"
+    BASELINE_BACKGROUND = "background"
+    BASELINE_HASH = "hash"
+    BASELINE_METADATA = "metadata"
+    BASELINE_MODES = (BASELINE_FULL, BASELINE_BACKGROUND, BASELINE_HASH, BASELINE_METADATA)
+    # Сколько исходного содержимого фоновый захват сохраняет за один запуск обслуживания
+    BASELINE_CAPTURE_BATCH_FILES = 500
+    BASELINE_CAPTURE_BATCH_BYTES = 256 * 1024 ** 2
 
     # --- Списки поддерживаемых расширений для предпросмотра ---
     TEXT_EXTENSIONS = {'.txt', '.log', '.md', '.py', '.json', '.xml', '.html', '.css', '.js', '.csv'}
@@ -167,6 +541,10 @@ class HistoryManager(QObject):
     PDF_EXTENSIONS = {'.pdf'}
     DOCX_EXTENSIONS = {'.docx'}
     XLSX_EXTENSIONS = {'.xlsx'}
+    # Текстовые форматы, версии которых хранятся дельтами относительно предыдущей версии
+    DELTA_EXTENSIONS = TEXT_EXTENSIONS | {'.ini', '.cfg', '.toml', '.yaml', '.yml', '.sql', '.ts', '.tsx',
+                                          '.jsx', '.c', '.h', '.cpp', '.hpp', '.cs', '.java', '.go', '.rs',
+                                          '.sh', '.bat', '.ps1', '.tex', '.rst', '.svg'}
 
     def __init__(self, storage_path: Path, parent=None):
         super().__init__(parent)
@@ -179,11 +557,24 @@ class HistoryManager(QObject):
         self._cleanup_thread = None
         self._cleanup_worker = None
         self._is_cleanup_running = False
+        self._maintenance_thread = None
+        self._maintenance_worker = None
+        self._is_maintenance_running = False
         self._db_connection_lock = threading.RLock()
+        # Версии по событиям наблюдателя сохраняются в одном фоновом потоке, по порядку событий
+        self._version_executor = ThreadPoolExecutor(max_workers=1)
+        self._version_queue_lock = threading.Lock()
+        self._queued_versions: Set[str] = set()
         self._setup_storage()
         self._db_connection = sqlite3.connect(self.db_path, check_same_thread=False)
         self._db_connection.execute("PRAGMA foreign_keys = ON")
         self._setup_database()
+        # Физическое хранение содержимого версий (целиком или блоками)
+        self.object_store = ObjectStore(self.storage_path, self._db_connection, self._db_connection_lock)
+        # Алгоритм хеширования хранилища (свойство store_properties); к нему переадресуются все объекты
+        self._store_hash_algorithm = hashing.DEFAULT_ALGORITHM
+        self._setup_object_store()
+        self._setup_storage_accounting()
         # --- Система асинхронной очереди задач для предотвращения deadlock ---
         self._pending_operation: Optional[str] = None
         self._pending_args: Optional[tuple] = None
@@ -195,19 +586,15 @@ class HistoryManager(QObject):
         self._storage_info_timer.timeout.connect(self.update_storage_info)
         self._storage_info_timer.start()
 
+        # --- Таймер для фонового обслуживания хранилища (пересжатие и т.п.) ---
+        self._maintenance_timer = QTimer(self)
+        self._maintenance_timer.setInterval(self.MAINTENANCE_INTERVAL_MS)
+        self._maintenance_timer.timeout.connect(self.start_maintenance)
+        self._maintenance_timer.start()
+
         # Первоначальное обновление информации о хранилище (выполняется синхронно)
         self.update_storage_info()
 
-    def _calculate_hash(self, file_path: Path) -> str | None:
-        try:
-            sha256 = hashlib.sha256()
-            with open(file_path, "rb") as f:
-                for chunk in iter(lambda: f.read(8192), b""):
-                    sha256.update(chunk)
-            return sha256.hexdigest()
-        except (OSError, IOError):
-            return None
-
     def _format_size(self, size_bytes: int) -> str:
         """Форматирует размер файла в удобочитаемый вид."""
         if size_bytes < 1024:
@@ -219,17 +606,45 @@ class HistoryManager(QObject):
         else:
             return self.tr("{0:.1f} GB").format(size_bytes / (1024 ** 3))
 
+    def _format_duration(self, seconds: float) -> str:
+        seconds = int(round(seconds))
+        if seconds < 60:
+            return self.tr("{0} с").format(seconds)
+        if seconds < 3600:
+            return self.tr("{0} мин {1} с").format(seconds // 60, seconds % 60)
+        return self.tr("{0} ч {1} мин").format(seconds // 3600, seconds % 3600 // 60)
+
+    def format_scan_progress(self, snapshot: ScanProgress) -> str:
+        """Текст снимка хода сканирования: обработано файлов, скорость и оставшееся время."""
+        if snapshot.files_total:
+            text = self.tr("Просканировано {0} из {1} файлов").format(snapshot.files_done, snapshot.files_total)
+        else:
+            text = self.tr("Просканировано {0} файлов").format(snapshot.files_done)
+        text += self.tr(" ({0:.0f} файл/с, {1}/с)").format(
+            snapshot.files_per_second, self._format_size(int(snapshot.bytes_per_second))
+        )
+        if snapshot.eta_seconds is not None and snapshot.files_done < snapshot.files_total:
+            text += self.tr(", осталось ~{0}").format(self._format_duration(snapshot.eta_seconds))
+        return text
+
+    @Slot(object)
+    def _on_scan_worker_progress(self, snapshot: ScanProgress):
+        self.scan_statistics.emit(snapshot)
+        self.scan_progress.emit(self.format_scan_progress(snapshot))
+
     def _request_stop_all_workers(self):
         """Отправляет неблокирующий запрос на остановку всем активным рабочим."""
         if self._is_scan_running and self._scan_worker:
             self._scan_worker.stop()
         if self._is_cleanup_running and self._cleanup_worker:
             self._cleanup_worker.stop()
+        if self._is_maintenance_running and self._maintenance_worker:
+            self._maintenance_worker.stop()
 
-    def start_scan(self, items_to_scan: List[Dict]):
-        if self._is_scan_running or self._is_cleanup_running:
+    def start_scan(self, items_to_scan: List[Dict], rules: Optional[WatchRules] = None):
+        if self._is_scan_running or self._is_cleanup_running or self._is_maintenance_running:
             self._pending_operation = "scan"
-            self._pending_args = (items_to_scan,)
+            self._pending_args = (items_to_scan, rules)
             self._request_stop_all_workers()
             return
 
@@ -240,46 +655,290 @@ class HistoryManager(QObject):
         self._is_scan_running = True
         self.scan_started.emit()
         self._scan_thread = QThread(self)
-        self._scan_worker = ScanWorker(self, items_to_scan)
+        self._scan_worker = ScanWorker(self, items_to_scan, rules=rules)
         self._scan_worker.moveToThread(self._scan_thread)
         self._scan_thread.started.connect(self._scan_worker.run)
         self._scan_worker.finished.connect(self._on_scan_finished_internal)
         self._scan_worker.scan_notification.connect(self.history_notification)
-        self._scan_worker.progress.connect(self.scan_progress)
+        self._scan_worker.progress.connect(self._on_scan_worker_progress)
         self._scan_thread.start()
 
-    def start_cleanup(self, watched_items: List[Dict]):
-        if self._is_scan_running or self._is_cleanup_running:
+    def start_cleanup(self, watched_items: List[Dict], rules: Optional[WatchRules] = None):
+        if self._is_scan_running or self._is_cleanup_running or self._is_maintenance_running:
             self._pending_operation = "cleanup"
-            self._pending_args = (watched_items,)
+            self._pending_args = (watched_items, rules)
             self._request_stop_all_workers()
             return
 
         self._is_cleanup_running = True
         self.cleanup_started.emit()
         self._cleanup_thread = QThread(self)
-        self._cleanup_worker = CleanupWorker(self, watched_items)
+        self._cleanup_worker = CleanupWorker(self, watched_items, rules)
         self._cleanup_worker.moveToThread(self._cleanup_thread)
         self._cleanup_thread.started.connect(self._cleanup_worker.run)
         self._cleanup_worker.finished.connect(self._on_cleanup_finished_internal)
         self._cleanup_worker.cleanup_notification.connect(self.history_notification)
         self._cleanup_thread.start()
 
+    @Slot()
+    def start_maintenance(self):
+        """
+        Запускает фоновое обслуживание хранилища. Обслуживание имеет низший приоритет:
+        если идет сканирование или очистка, запуск просто пропускается до следующего срабатывания таймера.
+        """
+        if self._is_scan_running or self._is_cleanup_running or self._is_maintenance_running:
+            return
+
+        self._is_maintenance_running = True
+        self._maintenance_thread = QThread(self)
+        self._maintenance_worker = MaintenanceWorker(self)
+        self._maintenance_worker.moveToThread(self._maintenance_thread)
+        self._maintenance_thread.started.connect(self._maintenance_worker.run)
+        self._maintenance_worker.finished.connect(self._on_maintenance_finished_internal)
+        self._maintenance_worker.maintenance_notification.connect(self.history_notification)
+        self._maintenance_thread.start()
+
+    def get_maintenance_tasks(self) -> List:
+        """
+        Список задач фонового обслуживания. Каждая задача принимает функцию
+        should_stop и возвращает сообщение для пользователя (или None).
+        """
+        # Пересжатие идет раньше упаковки: упакованные файлы больше не пересжимаются
+        return [self.rekey_objects, self.capture_baselines, self.recompress_cold_objects, self.repack_objects,
+                self.remove_orphan_chunks, self.reconcile_storage_usage]
+
+    def set_compression_codec(self, codec_name: str):
+        """Задает кодек сжатия новых объектов по имени из настроек ("auto", "zstd", "zlib", "none")."""
+        self.object_store.set_codec(compression.codec_from_name(codec_name))
+
+    def set_use_mmap(self, enabled: bool):
+        """Включает чтение крупных исходных файлов через отображение в память (см. file_io.iter_blocks)."""
+        self.object_store.use_mmap = bool(enabled)
+
+    def set_hash_algorithm(self, algorithm_name: str):
+        """
+        Задает алгоритм хеширования новых объектов по имени из настроек ("sha256", "blake3")
+        и сохраняет его как свойство хранилища. Существующие объекты переадресуются в фоне (rekey_objects).
+        Главным остается свойство хранилища: недоступный алгоритм не применяется, иначе отсутствие
+        модуля переадресовало бы все хранилище на алгоритм по умолчанию.
+        """
+        store_algorithm = self._store_hash_algorithm
+        if algorithm_name != store_algorithm:
+            if hashing.is_available(algorithm_name):
+                with self._db_connection_lock:
+                    try:
+                        self._db_connection.execute(
+                            "INSERT OR REPLACE INTO store_properties (name, value) VALUES (?, ?)",
+                            (self.HASH_ALGORITHM_PROPERTY, algorithm_name)
+                        )
+                        self._db_connection.commit()
+                    except sqlite3.Error as e:
+                        self._db_connection.rollback()
+                        self.history_notification.emit(self.tr("Ошибка сохранения настроек хранилища: {0}").format(e), QSystemTrayIcon.Warning)
+                        return
+                    self._store_hash_algorithm = algorithm_name
+                    self.object_store.set_hash_algorithm(algorithm_name)
+                return
+            self.history_notification.emit(
+                self.tr("Алгоритм хеширования {0} недоступен, хранилище продолжает использовать {1}").format(
+                    algorithm_name, store_algorithm),
+                QSystemTrayIcon.Warning
+            )
+        if not hashing.is_available(store_algorithm):
+            self.history_notification.emit(
+                self.tr("Алгоритм хеширования хранилища {0} недоступен: новые версии хешируются {1}, "
+                        "переадресация отложена").format(store_algorithm, self.object_store.hash_algorithm),
+                QSystemTrayIcon.Warning
+            )
+
+    def rekey_objects(self, should_stop_callback=None) -> Optional[str]:
+        """
+        Переадресует объекты, хеш которых посчитан не текущим алгоритмом хранилища.
+        Хеш считается без блокировки БД, а переадресация каждого объекта - короткая транзакция,
+        поэтому хранилище остается доступным на все время миграции. Возвращает сообщение или None.
+        """
+        algorithm = self.object_store.hash_algorithm
+        if algorithm != self._store_hash_algorithm:
+            return None # Алгоритм хранилища недоступен: объекты не переадресуются на замену
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT hash FROM objects WHERE hash_algorithm != ? AND refcount > 0", (algorithm,))
+            old_hashes = [row[0] for row in cursor.fetchall()]
+
+        rekeyed_count = 0
+        for old_hash in old_hashes:
+            if should_stop_callback and should_stop_callback():
+                break
+            try:
+                computed = self.object_store.compute_rekey(old_hash, algorithm)
+            except OSError:
+                continue # Объект удален или поврежден - попробуем в следующий раз
+            if computed is None:
+                continue
+            new_hash, chunk_rekeys, quick_hash = computed
+            with self._db_connection_lock:
+                merged = self.object_store.rekey_object(old_hash, new_hash, algorithm, chunk_rekeys, quick_hash,
+                                                        self._repoint_versions)
+                if merged is None:
+                    continue
+                if merged:
+                    # Содержимое уже хранилось под новым хешем: старая копия больше не нужна
+                    self._remove_unreferenced_object(old_hash)
+                    self._db_connection.commit()
+                rekeyed_count += 1
+
+        if rekeyed_count == 0:
+            return None
+        return self.tr("Переадресовано объектов хранилища: {0}.").format(rekeyed_count)
+
+    def capture_baselines(self, should_stop_callback=None) -> Optional[str]:
+        """
+        Фоновый захват содержимого индексных базовых версий (режим BASELINE_BACKGROUND): за один запуск
+        сохраняется не больше BASELINE_CAPTURE_BATCH_FILES файлов и BASELINE_CAPTURE_BATCH_BYTES байт.
+        Каждый файл сохраняется отдельной короткой транзакцией. Возвращает сообщение или None.
+        """
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT id, original_path FROM tracked_files WHERE capture_pending = 1 LIMIT ?",
+                           (self.BASELINE_CAPTURE_BATCH_FILES,))
+            pending_files = cursor.fetchall()
+
+        captured_count, captured_bytes = 0, 0
+        for file_id, original_path_str in pending_files:
+            if (should_stop_callback and should_stop_callback()) or captured_bytes >= self.BASELINE_CAPTURE_BATCH_BYTES:
+                break
+            file_path = Path(original_path_str)
+            # Файл могли изменить (и сохранить версию) или удалить из истории, пока шли предыдущие
+            if not self._is_capture_pending(file_id):
+                continue
+            # Чтение, хеширование и запись содержимого - без блокировки БД, как при сканировании
+            try:
+                fingerprint = self._get_fingerprint(file_path.stat())
+                staged = self.object_store.stage_file(file_path)
+            except OSError:
+                if not file_path.exists():
+                    # Файла больше нет: захватывать нечего
+                    with self._db_connection_lock:
+                        self._db_connection.execute("UPDATE tracked_files SET capture_pending = 0 WHERE id = ?", (file_id,))
+                        self._db_connection.commit()
+                continue
+            with self._db_connection_lock:
+                # Пока файл читался, событие наблюдателя могло уже сохранить его версию
+                if not self._is_capture_pending(file_id):
+                    self.object_store.discard_staged(staged)
+                    continue
+                stored = self._store_file_content(file_path, staged=staged)
+                if stored and self._add_version_record(file_path, *stored, fingerprint):
+                    captured_count += 1
+                    captured_bytes += stored[1]
+
+        if captured_count == 0:
+            return None
+        self.update_storage_info()
+        return self.tr("Сохранено исходное содержимое файлов: {0} ({1}).").format(captured_count, self._format_size(captured_bytes))
+
+    def _is_capture_pending(self, file_id: int) -> bool:
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT capture_pending FROM tracked_files WHERE id = ?", (file_id,))
+            row = cursor.fetchone()
+            return bool(row and row[0])
+
+    def _repoint_versions(self, old_hash: str, new_hash: str):
+        # Триггеры счетчика ссылок не срабатывают на UPDATE: счетчик переносит ObjectStore.rekey_object
+        self._db_connection.execute("UPDATE versions SET sha256_hash = ? WHERE sha256_hash = ?", (new_hash, old_hash))
+
+    def recompress_cold_objects(self, should_stop_callback=None) -> Optional[str]:
+        """
+        Пересжимает "холодные" объекты (без новых версий дольше COLD_OBJECT_AGE)
+        максимальным уровнем сжатия. Возвращает сообщение о результате или None.
+        """
+        cold_before = (datetime.now() - self.COLD_OBJECT_AGE).isoformat()
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT sha256_hash FROM versions GROUP BY sha256_hash HAVING MAX(timestamp) < ?", (cold_before,))
+            cold_hashes = [row[0] for row in cursor.fetchall()]
+
+        freed_bytes, recompressed_count = 0, 0
+        for sha256_hash in cold_hashes:
+            if should_stop_callback and should_stop_callback():
+                break
+            count, saved = self.object_store.recompress_object(sha256_hash)
+            recompressed_count += count
+            freed_bytes += saved
+        with self._db_connection_lock:
+            self._db_connection.commit() # Фиксируем счетчик объема и параметры хранения объектов
+
+        if recompressed_count == 0:
+            return None
+        return self.tr("Пересжато объектов хранилища: {0}, освобождено {1}.").format(recompressed_count, self._format_size(freed_bytes))
+
+    def repack_objects(self, should_stop_callback=None) -> Optional[str]:
+        """
+        Переносит небольшие и холодные файлы хранилища в пакеты и уплотняет пакеты,
+        в которых накопились удаленные записи. Возвращает сообщение о результате или None.
+        """
+        packed_count = self.object_store.pack_loose_objects(should_stop_callback)
+        freed_bytes = 0
+        if not (should_stop_callback and should_stop_callback()):
+            freed_bytes = self.object_store.compact_packs(should_stop_callback)
+        if packed_count == 0 and freed_bytes == 0:
+            return None
+        return self.tr("Упаковано файлов хранилища: {0}, освобождено при уплотнении {1}.").format(packed_count, self._format_size(freed_bytes))
+
+    def remove_orphan_chunks(self, should_stop_callback=None) -> Optional[str]:
+        """Удаляет файлы блоков, оставшиеся от прерванных сохранений. Возвращает сообщение о результате или None."""
+        removed_count = self.object_store.remove_orphan_chunks(should_stop_callback)
+        if removed_count == 0:
+            return None
+        return self.tr("Удалено неиспользуемых блоков хранилища: {0}.").format(removed_count)
+
+    def reconcile_storage_usage(self, should_stop_callback=None) -> Optional[str]:
+        """
+        Сверяет счетчик объема хранилища с фактическим размером файлов (не чаще STORAGE_RECONCILE_INTERVAL).
+        Счетчик может разойтись с диском после сбоя или отката транзакции. Сообщений не возвращает.
+        """
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT value FROM storage_stats WHERE name = ?", (self.STORAGE_RECONCILED_AT_KEY,))
+            row = cursor.fetchone()
+        if row and datetime.now() - datetime.fromtimestamp(row[0]) < self.STORAGE_RECONCILE_INTERVAL:
+            return None
+
+        counter_before = self.object_store.get_stored_bytes() or 0
+        measured_bytes = self.object_store.measure_stored_bytes(should_stop_callback)
+        if measured_bytes is None:
+            return None
+        with self._db_connection_lock:
+            # Изменения, сделанные во время обхода, переносятся поверх измеренного значения
+            counter_after = self.object_store.get_stored_bytes() or 0
+            self.object_store.set_stored_bytes(measured_bytes + counter_after - counter_before)
+            self._db_connection.execute(
+                "INSERT OR REPLACE INTO storage_stats (name, value) VALUES (?, ?)",
+                (self.STORAGE_RECONCILED_AT_KEY, int(datetime.now().timestamp()))
+            )
+            self._db_connection.commit()
+        return None
+
+    def _get_storage_size(self) -> int:
+        """Объем хранилища: счетчик файлов объектов плюс размер файлов базы данных."""
+        total_bytes = self.object_store.get_stored_bytes() or 0
+        for suffix in ("", "-wal", "-journal"):
+            try:
+                total_bytes += os.path.getsize(str(self.db_path) + suffix)
+            except OSError:
+                pass
+        return total_bytes
+
     @Slot()
     def update_storage_info(self):
         """
         Рассчитывает текущее использование хранилища относительно свободного места на диске
-        и отправляет сигнал.
+        и отправляет сигнал. Размер хранилища берется из счетчика, без обхода папок.
         """
         try:
-            # 1. Рассчитываем размер папки хранилища Undoit
-            total_undoit_storage_size_bytes = 0
-            if self.storage_path.exists():
-                for dirpath, dirnames, filenames in os.walk(self.storage_path):
-                    for f in filenames:
-                        fp = Path(dirpath) / f
-                        if fp.is_file() and not fp.is_symlink():
-                            total_undoit_storage_size_bytes += fp.stat().st_size
+            # 1. Размер хранилища Undoit
+            total_undoit_storage_size_bytes = self._get_storage_size()
 
             # 2. Получаем информацию о диске, на котором находится хранилище
             # Передаем корень диска в psutil.disk_usage
@@ -316,7 +975,7 @@ class HistoryManager(QObject):
                 tooltip_percentage
             )
 
-        except (OSError, psutil.Error, FileNotFoundError) as e:
+        except (OSError, psutil.Error, sqlite3.Error) as e:
             self.history_notification.emit(
                 self.tr("Ошибка при получении информации о хранилище: {0}").format(e),
                 QSystemTrayIcon.Warning
@@ -357,6 +1016,21 @@ class HistoryManager(QObject):
 
         self._execute_pending_operation()
 
+    @Slot()
+    def _on_maintenance_finished_internal(self):
+        self._is_maintenance_running = False
+        if self._maintenance_worker:
+            self._maintenance_worker.deleteLater()
+        if self._maintenance_thread:
+            self._maintenance_thread.quit()
+            self._maintenance_thread.wait() # Безопасно ждать здесь
+            self._maintenance_thread.deleteLater()
+        self._maintenance_worker, self._maintenance_thread = None, None
+
+        self.update_storage_info() # Обслуживание меняет размер хранилища
+
+        self._execute_pending_operation()
+
     @Slot()
     def _on_cleanup_finished_internal(self):
         self._is_cleanup_running = False
@@ -383,24 +1057,347 @@ class HistoryManager(QObject):
             # _add_version_from_path теперь сам испускает сигналы, если файл новый
             self._add_version_from_path(file_path)
 
+    def get_scan_checkpoint(self, item_path: str, rules_key: str) -> Optional[str]:
+        """
+        Папка, после которой нужно продолжить прерванное сканирование элемента, или None.
+        Точка, сохраненная при других правилах исключений, не используется.
+        """
+        with self._db_connection_lock:
+            row = self._db_connection.execute(
+                "SELECT rules_key, last_directory FROM scan_checkpoints WHERE item_path = ?", (item_path,)
+            ).fetchone()
+        if row is None or row[0] != rules_key:
+            return None
+        return row[1]
+
+    def save_scan_checkpoint(self, item_path: str, rules_key: str, last_directory: Optional[str]):
+        """
+        Запоминает последнюю полностью сохраненную папку элемента. last_directory=None
+        означает завершенное сканирование: точка сбрасывается, а поколение увеличивается.
+        Выбрасывает sqlite3.Error.
+        """
+        with self._db_connection_lock:
+            try:
+                self._db_connection.execute(
+                    """
+                    INSERT INTO scan_checkpoints (item_path, rules_key, generation, last_directory)
+                    VALUES (?, ?, ?, ?)
+                    ON CONFLICT (item_path) DO UPDATE SET rules_key = excluded.rules_key,
+                        generation = generation + excluded.generation, last_directory = excluded.last_directory
+                    """,
+                    (item_path, rules_key, 1 if last_directory is None else 0, last_directory)
+                )
+                self._db_connection.commit()
+            except sqlite3.Error:
+                self._db_connection.rollback()
+                raise
+
+    def get_scan_generation(self, item_path: str, rules_key: str) -> int:
+        """Число завершенных сканирований элемента при текущих правилах исключений (0 - при других или ни одного)."""
+        with self._db_connection_lock:
+            row = self._db_connection.execute(
+                "SELECT rules_key, generation FROM scan_checkpoints WHERE item_path = ?", (item_path,)
+            ).fetchone()
+        return row[1] if row and row[0] == rules_key else 0
+
+    @staticmethod
+    def _path_range(root: Path) -> Tuple[str, str, str]:
+        """
+        (root, нижняя граница, верхняя граница) для выборки путей внутри root диапазоном
+        индекса [root + разделитель, root + следующий символ), без обхода всей таблицы.
+        """
+        root_str = str(root)
+        prefix = root_str if root_str.endswith(os.sep) else root_str + os.sep
+        return root_str, prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+    def count_tracked_paths_under(self, root: Path) -> int:
+        """Число отслеживаемых путей, совпадающих с root или лежащих внутри него."""
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute(
+                "SELECT COUNT(*) FROM tracked_files WHERE original_path = ? OR (original_path >= ? AND original_path < ?)",
+                self._path_range(root)
+            )
+            return cursor.fetchone()[0]
+
+    def get_tracked_paths_under(self, root: Path) -> Set[str]:
+        """Отслеживаемые пути, совпадающие с root или лежащие внутри него."""
+        return set(self.get_tracked_fingerprints_under(root))
+
+    def get_tracked_fingerprints_under(self, root: Path) -> Dict[str, Optional[Tuple[int, int, int, int]]]:
+        """Отслеживаемые пути внутри root (или сам root) с сохраненными отпечатками (None, если отпечатка нет)."""
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute(
+                """
+                SELECT original_path, fp_size, fp_mtime_ns, fp_inode, fp_ctime_ns FROM tracked_files
+                WHERE original_path = ? OR (original_path >= ? AND original_path < ?)
+                """,
+                self._path_range(root)
+            )
+            return {row[0]: (row[1:] if row[1] is not None else None) for row in cursor.fetchall()}
+
+    def get_dir_index(self, root: Path, rules_key: str, known_files: Iterable[str]) -> scanner.DirIndex:
+        """
+        Индекс папок элемента для сканирования. Сохраненные mtime используются, только если элемент
+        уже полностью сканировался при тех же правилах исключений: иначе в индексе могут не быть
+        папок, ставших видимыми, и все папки читаются заново.
+        """
+        mtimes = {}
+        if self.get_scan_generation(str(root), rules_key) > 0:
+            with self._db_connection_lock:
+                cursor = self._db_connection.cursor()
+                cursor.execute("SELECT path, mtime_ns FROM dir_index WHERE path = ? OR (path >= ? AND path < ?)",
+                               self._path_range(root))
+                mtimes = dict(cursor.fetchall())
+        return scanner.DirIndex(mtimes, known_files, time.time_ns() - self.FINGERPRINT_RACY_WINDOW_NS)
+
+    def save_dir_index(self, root: Path, dir_index: scanner.DirIndex, skipped_dirs: Set[str], prune: bool):
+        """
+        Сохраняет mtime папок, пройденных сканированием элемента. Папки из skipped_dirs (не все файлы
+        записаны) и папки с недавним mtime забываются, чтобы в следующий раз их прочитать. С prune
+        удаляются и папки, которых при обходе не оказалось. Выбрасывает sqlite3.Error.
+        """
+        updated, forgotten = [], []
+        for dir_path, mtime_ns in dir_index.visited.items():
+            if mtime_ns is None or dir_path in skipped_dirs:
+                if dir_path in dir_index.mtimes:
+                    forgotten.append((dir_path,))
+            elif dir_index.mtimes.get(dir_path) != mtime_ns:
+                updated.append((dir_path, mtime_ns))
+        if prune:
+            forgotten.extend((dir_path,) for dir_path in dir_index.mtimes if dir_path not in dir_index.visited)
+        if not updated and not forgotten:
+            return
+        with self._db_connection_lock:
+            try:
+                self._db_connection.executemany("INSERT OR REPLACE INTO dir_index (path, mtime_ns) VALUES (?, ?)", updated)
+                self._db_connection.executemany("DELETE FROM dir_index WHERE path = ?", forgotten)
+                self._db_connection.commit()
+            except sqlite3.Error:
+                self._db_connection.rollback()
+                raise
+
+    @classmethod
+    def baseline_from_name(cls, name: Optional[str]) -> str:
+        """Режим базовой версии по значению из настроек элемента; неизвестное значение означает полную копию."""
+        return name if name in cls.BASELINE_MODES else cls.BASELINE_FULL
+
+    def stage_initial_version(self, file_path_str: str, file_stat: Optional[os.stat_result] = None,
+                              baseline: str = BASELINE_FULL) -> StagedVersion:
+        """
+        Читает и хеширует содержимое нового файла без блокировки БД, поэтому может выполняться
+        в нескольких потоках одновременно (см. ScanWorker). file_stat - уже полученные данные stat файла.
+        В индексных режимах baseline содержимое не копируется: запоминается только отпечаток
+        (и хеш в режиме BASELINE_HASH). Возвращает данные для commit_initial_version. Выбрасывает OSError.
+        """
+        file_path = Path(file_path_str)
+        if file_stat is None:
+            file_stat = file_path.stat()
+        fingerprint = self._get_fingerprint(file_stat)
+        if baseline == self.BASELINE_HASH:
+            return StagedVersion(file_path, fingerprint, None, self._hash_file(file_path))
+        if baseline in (self.BASELINE_BACKGROUND, self.BASELINE_METADATA):
+            return StagedVersion(file_path, fingerprint, None, capture_pending=baseline == self.BASELINE_BACKGROUND)
+        return StagedVersion(file_path, fingerprint, self.object_store.stage_file(file_path, file_stat.st_size))
+
+    def commit_initial_version(self, staged_version: StagedVersion):
+        """Публикует содержимое, подготовленное stage_initial_version, и добавляет первую версию файла."""
+        file_path, fingerprint, staged = staged_version[:3]
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT id FROM tracked_files WHERE original_path = ?", (str(file_path),))
+            if cursor.fetchone():
+                self.discard_staged_version(staged_version) # Файл успели добавить, пока он читался
+                return
+            if staged is None:
+                self._add_baseline_record(file_path, fingerprint, staged_version.baseline_hash, staged_version.capture_pending)
+                return
+            try:
+                stored = self.object_store.commit_staged(staged)
+            except (OSError, sqlite3.Error):
+                self._db_connection.rollback()
+                self.object_store.discard_staged(staged)
+                raise
+            self._add_version_record(file_path, *stored, fingerprint)
+
+    def stage_changed_version(self, file_path_str: str, file_stat: Optional[os.stat_result] = None) -> StagedUpdate:
+        """
+        Читает отслеживаемый файл с изменившимся отпечатком (сверка при сканировании) без блокировки БД.
+        Совпадение с последней версией (или индексной базовой) проверяется быстрым хешем или хешем,
+        и тогда содержимое не копируется. Небольшие текстовые файлы не читаются: их дельту
+        строит commit_changed_version. Выбрасывает OSError.
+        """
+        file_path = Path(file_path_str)
+        if file_stat is None:
+            file_stat = file_path.stat()
+        fingerprint = self._get_fingerprint(file_stat)
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT baseline_hash FROM tracked_files WHERE original_path = ?", (str(file_path),))
+            tracked_row = cursor.fetchone()
+            cursor.execute("SELECT v.sha256_hash FROM versions v JOIN tracked_files tf ON v.file_id = tf.id WHERE tf.original_path = ? ORDER BY v.timestamp DESC LIMIT 1", (str(file_path),))
+            last_version = cursor.fetchone()
+
+        last_hash = last_version[0] if last_version else None
+        if last_hash is None and tracked_row and tracked_row[0] and self._hash_file(file_path) == tracked_row[0]:
+            return StagedUpdate(file_path, fingerprint, None, None, unchanged=True)
+        if last_hash and self.object_store.matches_quick_hash(last_hash, file_path):
+            return StagedUpdate(file_path, fingerprint, None, last_hash, unchanged=True)
+        base_hash = last_hash if file_path.suffix.lower() in self.DELTA_EXTENSIONS else None
+        if self.object_store.uses_delta(file_stat.st_size, base_hash):
+            return StagedUpdate(file_path, fingerprint, None, base_hash)
+        return StagedUpdate(file_path, fingerprint, self.object_store.stage_file(file_path, file_stat.st_size), base_hash)
+
+    def commit_changed_version(self, update: StagedUpdate) -> bool:
+        """
+        Публикует содержимое, подготовленное stage_changed_version, и добавляет новую версию файла
+        (без уведомлений: их обобщает сканирование). Если содержимое не изменилось, сохраняется только отпечаток.
+        Возвращает True, если добавлена новая версия. Выбрасывает OSError.
+        """
+        file_path = update.file_path
+        with self._db_connection_lock:
+            if update.unchanged:
+                self._save_fingerprint(file_path, update.fingerprint)
+                return False
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT v.sha256_hash FROM versions v JOIN tracked_files tf ON v.file_id = tf.id WHERE tf.original_path = ? ORDER BY v.timestamp DESC LIMIT 1", (str(file_path),))
+            last_version = cursor.fetchone()
+            stored = self._store_file_content(file_path, update.base_hash, update.staged)
+            if not stored:
+                raise OSError(self.tr("не удалось прочитать файл {0}").format(file_path.name))
+            if last_version and last_version[0] == stored[0]:
+                self._save_fingerprint(file_path, update.fingerprint)
+                return False
+            result_tuple = self._add_version_record(file_path, *stored, update.fingerprint)
+            if not result_tuple:
+                raise OSError(self.tr("не удалось сохранить версию файла {0}").format(file_path.name))
+        was_new_file, file_id = result_tuple
+        if not was_new_file:
+            self.version_added.emit(file_id)
+        return True
+
+    def discard_staged_version(self, staged_version: StagedVersion):
+        if staged_version.staged is not None:
+            self.object_store.discard_staged(staged_version.staged)
+
+    def _add_baseline_record(self, file_path: Path, fingerprint: Optional[Tuple[int, int, int, int]],
+                             baseline_hash: Optional[str], capture_pending: bool):
+        """Добавляет отслеживаемый файл с индексной базовой версией (без версий в истории). Выбрасывает sqlite3.Error."""
+        try:
+            self._db_connection.execute(
+                """
+                INSERT INTO tracked_files (original_path, fp_size, fp_mtime_ns, fp_inode, fp_ctime_ns, baseline_hash, capture_pending)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """,
+                (str(file_path), *(fingerprint or (None,) * 4), baseline_hash, int(capture_pending))
+            )
+            self._db_connection.commit()
+        except sqlite3.Error:
+            self._db_connection.rollback()
+            raise
+
+    def _hash_file(self, file_path: Path) -> str:
+        """Хеш содержимого файла алгоритмом хранилища, без сохранения содержимого. Выбрасывает OSError."""
+        hasher = hashing.new_hasher(self.object_store.hash_algorithm)
+        with file_io.open_sequential(file_path) as f:
+            for block in file_io.iter_blocks(f, self.object_store.use_mmap):
+                hasher.update(block)
+        return hasher.hexdigest()
+
+    @Slot(str)
+    def queue_file_version(self, file_path_str: str):
+        """
+        Ставит сохранение версии файла в очередь фонового потока (для событий наблюдателя):
+        чтение и нарезка большого файла не должны останавливать интерфейс. Повторные события
+        для файла, который еще ждет в очереди, не добавляют новых заданий.
+        """
+        with self._version_queue_lock:
+            if file_path_str in self._queued_versions:
+                return
+            self._queued_versions.add(file_path_str)
+        self._version_executor.submit(self._run_queued_file_version, file_path_str)
+
+    def _run_queued_file_version(self, file_path_str: str):
+        with self._version_queue_lock:
+            # Событие, пришедшее во время сохранения, снова поставит файл в очередь
+            self._queued_versions.discard(file_path_str)
+        try:
+            self.add_file_version(file_path_str)
+        except Exception as e:
+            self.history_notification.emit(self.tr("Ошибка при сохранении версии файла {0}: {1}").format(file_path_str, e), QSystemTrayIcon.Critical)
+
     @Slot(str)
     def add_file_version(self, file_path_str: str):
         file_path = Path(file_path_str)
         if not file_path.is_file(): return
-
-        file_hash = self._calculate_hash(file_path)
-        if not file_hash:
-            self.history_notification.emit(self.tr("Ошибка: не удалось рассчитать хеш для файла {0}").format(file_path.name), QSystemTrayIcon.Warning)
+        try:
+            # Отпечаток снимается до чтения: изменение во время чтения даст другой отпечаток в следующий раз
+            file_stat = file_path.stat()
+            fingerprint = self._get_fingerprint(file_stat)
+        except OSError:
             return
 
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT fp_size, fp_mtime_ns, fp_inode, fp_ctime_ns, baseline_hash FROM tracked_files WHERE original_path = ?", (str(file_path),))
+            tracked_row = cursor.fetchone()
+            # Событие без изменения содержимого (atime, повторное сохранение без записи): файл не читается
+            if tracked_row and self._same_fingerprint(fingerprint, tracked_row[:4]): return
+
+            cursor.execute("SELECT v.sha256_hash FROM versions v JOIN tracked_files tf ON v.file_id = tf.id WHERE tf.original_path = ? ORDER BY v.timestamp DESC LIMIT 1", (str(file_path),))
+            last_version = cursor.fetchone()
+
+        # Индексная базовая версия с хешем: пока содержимое совпадает с ним, оно не копируется.
+        # Хеш читает весь файл, поэтому считается без блокировки БД
+        try:
+            if not last_version and tracked_row and tracked_row[4] and self._hash_file(file_path) == tracked_row[4]:
+                with self._db_connection_lock:
+                    self._save_fingerprint(file_path, fingerprint)
+                return
+        except OSError:
+            pass # Ошибка чтения будет обработана при сохранении содержимого
+
+        # Большой файл сначала сверяется быстрым хешем: неизмененный файл не нарезается и не хешируется заново.
+        # Быстрый хеш читает весь файл, поэтому считается без блокировки БД
+        try:
+            if last_version and self.object_store.matches_quick_hash(last_version[0], file_path):
+                with self._db_connection_lock:
+                    self._save_fingerprint(file_path, fingerprint)
+                return
+        except OSError:
+            pass # Ошибка чтения будет обработана при сохранении содержимого
+
+        # Предыдущая версия служит базой для дельты, если файл текстовый
+        base_hash = last_version[0] if last_version and file_path.suffix.lower() in self.DELTA_EXTENSIONS else None
+        # Файл, который не сохраняется дельтой, читается, хешируется и записывается во временные файлы
+        # без блокировки БД: под блокировкой остается только публикация и запись версии
+        staged = None
+        if not self.object_store.uses_delta(file_stat.st_size, base_hash):
+            try:
+                staged = self.object_store.stage_file(file_path)
+            except OSError:
+                self.history_notification.emit(self.tr("Ошибка: не удалось прочитать файл {0}").format(file_path.name), QSystemTrayIcon.Warning)
+                return
+
         was_new_file, file_id, error_message = False, -1, None
         with self._db_connection_lock:
+            # Пока файл читался, версия могла быть сохранена другим путем (например, сканированием)
             cursor = self._db_connection.cursor()
             cursor.execute("SELECT v.sha256_hash FROM versions v JOIN tracked_files tf ON v.file_id = tf.id WHERE tf.original_path = ? ORDER BY v.timestamp DESC LIMIT 1", (str(file_path),))
             last_version = cursor.fetchone()
-            if last_version and last_version[0] == file_hash: return
 
-            result_tuple = self._add_version_from_path(file_path, file_hash)
+            # Файл читается один раз: хеш считается при записи содержимого в хранилище
+            stored = self._store_file_content(file_path, base_hash, staged)
+            if not stored:
+                self.history_notification.emit(self.tr("Ошибка: не удалось прочитать файл {0}").format(file_path.name), QSystemTrayIcon.Warning)
+                return
+            file_hash, file_size = stored
+            if last_version and last_version[0] == file_hash:
+                self._save_fingerprint(file_path, fingerprint)
+                return
+
+            result_tuple = self._add_version_record(file_path, file_hash, file_size, fingerprint)
             if result_tuple:
                 # _add_version_from_path уже испустил file_list_updated если was_new_file
                 was_new_file, file_id = result_tuple
@@ -454,25 +1451,37 @@ class HistoryManager(QObject):
                 self.files_deleted.emit([(file_id, original_path_str)])
             # --- ИЗМЕНЕНИЕ КОНЕЦ ---
 
-        # 3. Проверяем, есть ли еще ссылки на этот объект (хеш) в других версиях
-        cursor.execute("SELECT COUNT(*) FROM versions WHERE sha256_hash = ?", (sha256_hash,))
-        references_count = cursor.fetchone()[0]
-
-        if references_count == 0:
-            # Если ссылок больше нет, можно удалить физический файл из объектов
-            object_path = self.get_object_path(sha256_hash)
-            if object_path and object_path.exists():
-                try:
-                    os.remove(object_path)
-                    # Проверяем, пуста ли папка хеша, и удаляем ее, если да
-                    object_subdir = object_path.parent
-                    if not list(object_subdir.iterdir()): # Если папка пуста
-                        os.rmdir(object_subdir)
-                    self.history_notification.emit(self.tr("Файл хранилища {0} удален.").format(sha256_hash), QSystemTrayIcon.Information)
-                except OSError as e:
-                    self.history_notification.emit(self.tr("Не удалось удалить файл хранилища {0}: {1}").format(sha256_hash, e), QSystemTrayIcon.Warning)
+        # 3. Если на объект (хеш) больше нет ссылок, удаляем физический объект (файл или его блоки)
+        try:
+            for removed_hash in self._remove_unreferenced_object(sha256_hash):
+                self.history_notification.emit(self.tr("Файл хранилища {0} удален.").format(removed_hash), QSystemTrayIcon.Information)
+        except OSError as e:
+            self.history_notification.emit(self.tr("Не удалось удалить файл хранилища {0}: {1}").format(sha256_hash, e), QSystemTrayIcon.Warning)
         return True
 
+    def _remove_unreferenced_object(self, sha256_hash: str) -> List[str]:
+        """
+        Удаляет физический объект, если на него не ссылается ни одна версия
+        и он не служит базой для дельт. Удаление дельты может освободить ее базовую
+        версию, поэтому проверка продолжается вниз по цепочке.
+        Предполагает, что соединение с БД уже заблокировано.
+        Возвращает список хешей удаленных объектов. Выбрасывает OSError.
+        """
+        removed_hashes = []
+        cursor = self._db_connection.cursor()
+        while sha256_hash:
+            # Счетчик ссылок ведут триггеры таблицы versions, поэтому проверка - поиск по первичному ключу
+            cursor.execute("SELECT refcount FROM objects WHERE hash = ?", (sha256_hash,))
+            row = cursor.fetchone()
+            if row and row[0] > 0:
+                break
+            if self.object_store.has_dependents(sha256_hash) or not self.object_store.contains(sha256_hash):
+                break
+            base_hash = self.object_store.remove(sha256_hash)
+            removed_hashes.append(sha256_hash)
+            sha256_hash = base_hash
+        return removed_hashes
+
     def delete_file_version(self, version_id: int, file_id: int, sha256_hash: str) -> bool:
         """
         Удаляет конкретную версию файла из базы данных и соответствующий объект из хранилища.
@@ -625,27 +1634,23 @@ class HistoryManager(QObject):
     def _cleanup_orphan_objects(self, hashes_to_check: Set[str]):
         """Удаляет физические файлы из хранилища, если на них больше нет ссылок в БД."""
         with self._db_connection_lock:
-            cursor = self._db_connection.cursor()
             for sha256_hash in hashes_to_check:
-                cursor.execute("SELECT COUNT(*) FROM versions WHERE sha256_hash = ?", (sha256_hash,))
-                references_count = cursor.fetchone()[0]
-
-                if references_count == 0:
-                    object_path = self.get_object_path(sha256_hash)
-                    if object_path and object_path.exists():
-                        try:
-                            os.remove(object_path)
-                            object_subdir = object_path.parent
-                            if not list(object_subdir.iterdir()):
-                                os.rmdir(object_subdir)
-                            self.history_notification.emit(self.tr("Файл хранилища {0} удален (объект-сирота).").format(sha256_hash), QSystemTrayIcon.Information)
-                        except OSError as e:
-                            self.history_notification.emit(self.tr("Не удалось удалить файл хранилища {0} (объект-сирота): {1}").format(sha256_hash, e), QSystemTrayIcon.Warning)
+                try:
+                    for removed_hash in self._remove_unreferenced_object(sha256_hash):
+                        self.history_notification.emit(self.tr("Файл хранилища {0} удален (объект-сирота).").format(removed_hash), QSystemTrayIcon.Information)
+                except OSError as e:
+                    self.history_notification.emit(self.tr("Не удалось удалить файл хранилища {0} (объект-сирота): {1}").format(sha256_hash, e), QSystemTrayIcon.Warning)
+            # Фиксируем удаление манифестов и дельт удаленных объектов
+            self._db_connection.commit()
 
     def get_all_tracked_files(self) -> List[tuple]:
         with self._db_connection_lock:
             cursor = self._db_connection.cursor()
-            cursor.execute("SELECT id, original_path FROM tracked_files ORDER BY original_path ASC")
+            # Файлы с индексной базовой версией (без версий) в истории не показываются
+            cursor.execute("""
+                SELECT id, original_path FROM tracked_files tf
+                WHERE EXISTS (SELECT 1 FROM versions v WHERE v.file_id = tf.id)
+                ORDER BY original_path ASC""")
             return cursor.fetchall()
 
     def get_versions_for_file(self, file_id: int) -> List[tuple]:
@@ -655,9 +1660,38 @@ class HistoryManager(QObject):
             cursor.execute("SELECT id, timestamp, sha256_hash, file_size FROM versions WHERE file_id = ? ORDER BY timestamp DESC", (file_id,))
             return cursor.fetchall()
 
-    def get_object_path(self, sha256_hash: str) -> Path | None:
-        object_path = self.objects_path / sha256_hash[:2] / sha256_hash[2:]
-        return object_path if object_path.exists() else None
+    def has_object(self, sha256_hash: str) -> bool:
+        """Проверяет, есть ли в хранилище содержимое версии с данным хешем."""
+        return self.object_store.contains(sha256_hash)
+
+    def open_object(self, sha256_hash: str) -> Optional[BinaryIO]:
+        """Открывает содержимое версии как поток (с распаковкой на лету)."""
+        return self.object_store.open(sha256_hash)
+
+    def export_object(self, sha256_hash: str, target_path: Path, mtime: Optional[float] = None) -> bool:
+        """
+        Потоково записывает содержимое версии в файл (для "Сохранить как" и восстановления).
+        Файл подменяется атомарно (см. ObjectStore.export); mtime - время изменения результата.
+        Возвращает False, если объекта нет в хранилище. Выбрасывает OSError.
+        """
+        return self.object_store.export(sha256_hash, target_path, mtime)
+
+    def get_object_path(self, sha256_hash: str, suffix: str = "") -> Path | None:
+        """
+        Возвращает путь к файлу с содержимым версии.
+        Сжатые объекты, дельты и объекты, хранящиеся блоками, потоково распаковываются
+        во временный файл, который будет удален вместе с остальными временными файлами предпросмотра.
+        """
+        object_path = self.object_store.get_loose_path(sha256_hash)
+        if object_path:
+            return object_path
+        try:
+            temp_path = self.object_store.materialize(sha256_hash, suffix)
+        except OSError:
+            return None
+        if temp_path:
+            self._add_temp_preview_file(temp_path)
+        return temp_path
 
     def _add_temp_preview_file(self, temp_file_path: Path):
         """Добавляет временный файл предпросмотра в список для последующей очистки."""
@@ -675,26 +1709,35 @@ class HistoryManager(QObject):
         self._temp_preview_files.clear()
 
 
-    def get_file_content_for_preview(self, object_path: Path, original_file_extension: str) -> Tuple[str, Optional[str]]:
+    def get_file_content_for_preview(self, sha256_hash: str, original_file_extension: str) -> Tuple[str, Optional[str]]:
         """
-        Извлекает содержимое файла для предпросмотра.
+        Извлекает содержимое версии для предпросмотра.
         Возвращает кортеж (тип_контента, данные_контента).
         Тип контента: "text", "image", "error", "unsupported".
-        Данные контента: строка для текста, путь к временному изображению.
+        Данные контента: строка для текста, путь к (временному) изображению.
         """
         file_extension = original_file_extension.lower()
         extracted_content = None
 
         try:
             if file_extension in self.TEXT_EXTENSIONS:
-                with open(object_path, 'r', encoding='utf-8', errors='replace') as f:
+                # Читаем только начало версии прямо из потока, без распаковки всего объекта
+                raw_stream = self.open_object(sha256_hash)
+                if raw_stream is None:
+                    return "error", self.tr("Объект {0} не найден в хранилище.").format(sha256_hash[:8])
+                with io.TextIOWrapper(raw_stream, encoding='utf-8', errors='replace') as f:
                     extracted_content = f.read(1024 * 10)
                 if extracted_content:
                     return "text", extracted_content
                 else:
                     return "unsupported", self.tr("Файл пуст или текст не найден.")
 
-            elif file_extension in self.IMAGE_EXTENSIONS:
+            # Остальным форматам нужен файл на диске: сжатые объекты распаковываются во временный файл
+            object_path = self.get_object_path(sha256_hash, file_extension)
+            if object_path is None:
+                return "error", self.tr("Объект {0} не найден в хранилище.").format(sha256_hash[:8])
+
+            if file_extension in self.IMAGE_EXTENSIONS:
                 return "image", str(object_path)
 
             elif file_extension in self.PDF_EXTENSIONS:
@@ -780,21 +1823,67 @@ class HistoryManager(QObject):
             return "error", self.tr("Критическая ошибка при предпросмотре файла: {0}").format(e)
 
 
-    def _add_version_from_path(self, file_path: Path, precalculated_hash: str = None) -> Optional[Tuple[bool, int]]:
-        file_hash = precalculated_hash or self._calculate_hash(file_path)
-        if not file_hash: return None
+    def _add_version_from_path(self, file_path: Path) -> Optional[Tuple[bool, int]]:
         try:
-            file_size = file_path.stat().st_size
-        except (FileNotFoundError, OSError):
+            fingerprint = self._get_fingerprint(file_path.stat())
+        except OSError:
             return None
-        object_subdir = self.objects_path / file_hash[:2]
-        object_path = object_subdir / file_hash[2:]
-        if not object_path.exists():
-            try:
-                object_subdir.mkdir(exist_ok=True)
-                shutil.copy2(file_path, object_path)
-            except IOError:
-                return None
+        stored = self._store_file_content(file_path)
+        if not stored: return None
+        return self._add_version_record(file_path, *stored, fingerprint)
+
+    def _get_fingerprint(self, file_stat: os.stat_result) -> Optional[Tuple[int, int, int, int]]:
+        """
+        Отпечаток файла (размер, mtime_ns, inode, ctime_ns) или None, если файл изменен слишком недавно,
+        чтобы отпечатку можно было доверять (см. FINGERPRINT_RACY_WINDOW_NS).
+        """
+        if time.time_ns() - file_stat.st_mtime_ns < self.FINGERPRINT_RACY_WINDOW_NS:
+            return None
+        # Идентификатор файла NTFS занимает все 64 бита, а SQLite хранит знаковые целые
+        inode = file_stat.st_ino - (1 << 64) if file_stat.st_ino >= 1 << 63 else file_stat.st_ino
+        return file_stat.st_size, file_stat.st_mtime_ns, inode, file_stat.st_ctime_ns
+
+    @staticmethod
+    def _same_fingerprint(fingerprint: Optional[Tuple[int, int, int, int]],
+                          saved_fingerprint: Optional[Tuple[int, int, int, int]]) -> bool:
+        """
+        Совпадают ли отпечатки. Нулевой inode означает, что он неизвестен (в Windows его
+        не заполняет DirEntry.stat()), и тогда сравниваются остальные поля.
+        """
+        if not fingerprint or not saved_fingerprint or saved_fingerprint[0] is None:
+            return False
+        if fingerprint[2] == 0 or saved_fingerprint[2] == 0:
+            return fingerprint[:2] + fingerprint[3:] == tuple(saved_fingerprint[:2]) + tuple(saved_fingerprint[3:])
+        return tuple(fingerprint) == tuple(saved_fingerprint)
+
+    def _save_fingerprint(self, file_path: Path, fingerprint: Optional[Tuple[int, int, int, int]]):
+        """Запоминает отпечаток файла, содержимое которого совпадает с последней версией."""
+        try:
+            self._db_connection.execute(
+                "UPDATE tracked_files SET fp_size = ?, fp_mtime_ns = ?, fp_inode = ?, fp_ctime_ns = ? WHERE original_path = ?",
+                (*(fingerprint or (None,) * 4), str(file_path))
+            )
+            self._db_connection.commit()
+        except sqlite3.Error:
+            self._db_connection.rollback()
+
+    def _store_file_content(self, file_path: Path, base_hash: Optional[str] = None,
+                            staged: Optional[StagedObject] = None) -> Optional[Tuple[str, int]]:
+        """
+        Сохраняет содержимое файла в хранилище объектов за один проход чтения.
+        staged - содержимое, заранее подготовленное ObjectStore.stage_file без блокировки: оно только публикуется.
+        Возвращает (хеш, размер) или None при ошибке. Предполагает, что соединение с БД уже заблокировано.
+        """
+        try:
+            return self.object_store.ingest_file(file_path, base_hash, staged)
+        except (OSError, sqlite3.Error):
+            self._db_connection.rollback()
+            if staged is not None:
+                self.object_store.discard_staged(staged)
+            return None
+
+    def _add_version_record(self, file_path: Path, file_hash: str, file_size: int,
+                            fingerprint: Optional[Tuple[int, int, int, int]] = None) -> Optional[Tuple[bool, int]]:
         cursor = self._db_connection.cursor()
         cursor.execute("SELECT id FROM tracked_files WHERE original_path = ?", (str(file_path),))
         file_id_result = cursor.fetchone()
@@ -804,6 +1893,13 @@ class HistoryManager(QObject):
             file_id = cursor.lastrowid
         else:
             file_id = file_id_result[0]
+            # У файла с индексной базовой версией это первая версия: в истории он появляется только сейчас
+            cursor.execute("SELECT 1 FROM versions WHERE file_id = ? LIMIT 1", (file_id,))
+            was_new_file = cursor.fetchone() is None
+        cursor.execute(
+            "UPDATE tracked_files SET fp_size = ?, fp_mtime_ns = ?, fp_inode = ?, fp_ctime_ns = ?, capture_pending = 0 WHERE id = ?",
+            (*(fingerprint or (None,) * 4), file_id)
+        )
         timestamp = datetime.now().isoformat()
         cursor.execute("INSERT INTO versions (file_id, timestamp, sha256_hash, file_size) VALUES (?, ?, ?, ?)", (file_id, timestamp, file_hash, file_size))
         try:
@@ -816,13 +1912,11 @@ class HistoryManager(QObject):
             self._db_connection.rollback()
             return None
 
-    def clean_unwatched_files_in_db(self, watched_items: List[Dict], should_stop_callback=None) -> Tuple[List, int]:
+    def clean_unwatched_files_in_db(self, watched_items: List[Dict], should_stop_callback=None,
+                                    rules: Optional[WatchRules] = None) -> Tuple[List, int]:
         messages, files_deleted_count, files_to_delete_info = [], 0, [] # Modified: files_to_delete_info will store (file_id, original_path)
-        watched_files = {Path(item['path']).resolve() for item in watched_items if item['type'] == 'file'}
-        watched_folders = [
-            (Path(item['path']).resolve(), {Path(ex).resolve() for ex in item.get('exclusions', [])})
-            for item in watched_items if item['type'] == 'folder'
-        ]
+        if rules is None:
+            rules = WatchRules(watched_items)
         with self._db_connection_lock:
             cursor = self._db_connection.cursor()
             cursor.execute("SELECT id, original_path FROM tracked_files")
@@ -831,20 +1925,7 @@ class HistoryManager(QObject):
                 if should_stop_callback and should_stop_callback():
                     messages.append((self.tr("Очистка прервана пользователем."), QSystemTrayIcon.Warning))
                     return messages, files_deleted_count
-                try:
-                    original_path = Path(original_path_str).resolve()
-                except (OSError, RuntimeError): continue # Пропускаем пути, которые больше не существуют
-                is_watched = False
-                if original_path in watched_files:
-                    is_watched = True
-                else:
-                    for folder_path, exclusion_paths in watched_folders:
-                        if original_path.is_relative_to(folder_path):
-                            is_excluded = any(original_path.is_relative_to(ex_path) for ex_path in exclusion_paths)
-                            if not is_excluded:
-                                is_watched = True
-                                break
-                if not is_watched:
+                if not rules.is_watched(original_path_str):
                     files_to_delete_info.append((file_id, original_path_str)) # <--- ДОБАВЛЕНО
 
             if files_to_delete_info: # Original `file_ids_to_delete` list is now derived from files_to_delete_info
@@ -877,6 +1958,35 @@ class HistoryManager(QObject):
         except OSError as e:
             self.history_notification.emit(self.tr("Ошибка создания папки хранилища: {0}").format(e), QSystemTrayIcon.Critical)
 
+    def _setup_object_store(self):
+        try:
+            self.object_store.setup()
+            # Быстрое создание объектов клонированием, если том хранилища это поддерживает
+            self.object_store.probe_clone_support()
+        except OSError as e:
+            self.history_notification.emit(self.tr("Ошибка создания папки хранилища: {0}").format(e), QSystemTrayIcon.Critical)
+        with self._db_connection_lock:
+            try:
+                cursor = self._db_connection.cursor()
+                cursor.execute("SELECT value FROM store_properties WHERE name = ?", (self.HASH_ALGORITHM_PROPERTY,))
+                row = cursor.fetchone()
+                if row:
+                    self._store_hash_algorithm = row[0]
+                # Недоступный алгоритм хранилища заменяется алгоритмом по умолчанию только для новых объектов
+                self.object_store.set_hash_algorithm(self._store_hash_algorithm)
+            except sqlite3.Error as e:
+                self.history_notification.emit(self.tr("Ошибка инициализации базы данных: {0}").format(e), QSystemTrayIcon.Critical)
+
+    def _setup_storage_accounting(self):
+        """Заводит счетчик объема хранилища. Хранилище, созданное до его появления, однократно измеряется."""
+        with self._db_connection_lock:
+            try:
+                if self.object_store.get_stored_bytes() is None:
+                    self.object_store.set_stored_bytes(self.object_store.measure_stored_bytes())
+                    self._db_connection.commit()
+            except sqlite3.Error as e:
+                self.history_notification.emit(self.tr("Ошибка инициализации базы данных: {0}").format(e), QSystemTrayIcon.Critical)
+
     def _setup_database(self):
         with self._db_connection_lock:
             try:
@@ -889,19 +1999,83 @@ class HistoryManager(QObject):
                         FOREIGN KEY (file_id) REFERENCES tracked_files (id) ON DELETE CASCADE
                     )""")
                 cursor.execute("CREATE INDEX IF NOT EXISTS idx_tracked_files_path ON tracked_files (original_path)")
-                cursor.execute("CREATE INDEX IF NOT EXISTS idx_versions_file_id ON versions (file_id)")
+                self._setup_objects_table(cursor)
+                # Манифесты объектов, хранящихся блоками: упорядоченный список блоков каждого объекта
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS object_chunks (
+                        object_hash TEXT NOT NULL, seq INTEGER NOT NULL,
+                        chunk_hash TEXT NOT NULL, chunk_size INTEGER NOT NULL,
+                        PRIMARY KEY (object_hash, seq)
+                    )""")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_object_chunks_chunk ON object_chunks (chunk_hash)")
+                # Объекты, хранящиеся дельтой относительно базовой версии
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS object_deltas (
+                        object_hash TEXT PRIMARY KEY, base_hash TEXT NOT NULL, chain_depth INTEGER NOT NULL
+                    )""")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_object_deltas_base ON object_deltas (base_hash)")
+                # Пакеты и отсортированный индекс упакованных файлов хранилища: (вид, хеш) -> (пакет, смещение, длина)
+                cursor.execute("CREATE TABLE IF NOT EXISTS packs (id INTEGER PRIMARY KEY, name TEXT NOT NULL UNIQUE, size INTEGER NOT NULL)")
+                cursor.execute("""
+                    CREATE TABLE IF NOT EXISTS packed_objects (
+                        kind INTEGER NOT NULL, hash TEXT NOT NULL, pack_id INTEGER NOT NULL,
+                        entry_offset INTEGER NOT NULL, entry_length INTEGER NOT NULL,
+                        PRIMARY KEY (kind, hash),
+                        FOREIGN KEY (pack_id) REFERENCES packs (id)
+                    ) WITHOUT ROWID""")
+                cursor.execute("CREATE INDEX IF NOT EXISTS idx_packed_objects_pack ON packed_objects (pack_id)")
+                # Счетчики хранилища (объем файлов объектов, время последней сверки с диском)
+                cursor.execute("CREATE TABLE IF NOT EXISTS storage_stats (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
                 self._db_connection.commit()
+                # Базовая схема выше создается идемпотентно; все дальнейшие изменения - миграции из app/schema.py
+                schema.migrate(self._db_connection, self._report_migration_progress)
             except sqlite3.Error as e:
                 self.history_notification.emit(self.tr("Ошибка инициализации базы данных: {0}").format(e), QSystemTrayIcon.Critical)
 
+    def _report_migration_progress(self, description: str, fraction: float):
+        self.scan_progress.emit(self.tr("Обновление базы данных: {0} ({1:.0f}%)").format(description, fraction * 100))
+
+    def _setup_objects_table(self, cursor: sqlite3.Cursor):
+        """
+        Таблица objects: по строке на каждый сохраненный объект со счетчиком ссылок из versions
+        и параметрами хранения. Счетчик ссылок ведут триггеры в той же транзакции, что и изменения versions
+        (включая каскадное удаление версий вместе с tracked_files).
+        """
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'objects'")
+        is_new_table = cursor.fetchone() is None
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS objects (
+                hash TEXT PRIMARY KEY, size INTEGER NOT NULL, refcount INTEGER NOT NULL DEFAULT 0,
+                stored_size INTEGER, codec INTEGER
+            ) WITHOUT ROWID""")
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_versions_ref_add AFTER INSERT ON versions BEGIN
+                INSERT INTO objects (hash, size, refcount) VALUES (NEW.sha256_hash, NEW.file_size, 1)
+                ON CONFLICT (hash) DO UPDATE SET refcount = refcount + 1;
+            END""")
+        cursor.execute("""
+            CREATE TRIGGER IF NOT EXISTS trg_versions_ref_remove AFTER DELETE ON versions BEGIN
+                UPDATE objects SET refcount = refcount - 1 WHERE hash = OLD.sha256_hash;
+            END""")
+        if is_new_table:
+            # База создана до появления таблицы objects: заполняем счетчики по существующим версиям
+            cursor.execute("""
+                INSERT INTO objects (hash, size, refcount)
+                SELECT sha256_hash, MAX(file_size), COUNT(*) FROM versions GROUP BY sha256_hash""")
+
     def close(self):
         self._request_stop_all_workers()
+        # Начатое сохранение версии доводится до конца, ожидающие в очереди отменяются
+        self._version_executor.shutdown(wait=True, cancel_futures=True)
         if self._scan_thread and self._scan_thread.isRunning():
             self._scan_thread.wait(500)
         if self._cleanup_thread and self._cleanup_thread.isRunning():
             self._cleanup_thread.wait(500)
+        if self._maintenance_thread and self._maintenance_thread.isRunning():
+            self._maintenance_thread.wait(500)
 
-        self._storage_info_timer.stop() # Останавливаем таймер
+        self._storage_info_timer.stop() # Останавливаем таймеры
+        self._maintenance_timer.stop()
 
         if self._db_connection:
             with self._db_connection_lock:
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Файлы .gitignore и .ignore внутри отслеживаемых папок
+import os
+import re
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+from app.path_patterns import glob_to_regex
+
+# Правила .ignore читаются после .gitignore и поэтому имеют приоритет (как в ripgrep)
+IGNORE_FILE_NAMES = (".gitignore", ".ignore")
+
+_FLAGS = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+
+# Подпись игнор-файлов папки: (имя, mtime_ns, размер) каждого из них; по ней замечаются изменения
+Signature = Tuple[Tuple[str, int, int], ...]
+
+
+def parse_ignore_lines(lines: Iterable[str]) -> List[Tuple[str, bool]]:
+    """
+    Разбирает строки игнор-файла по правилам git: пустые строки и комментарии ("#") пропускаются,
+    "!" отменяет игнорирование, "/" на конце - только папки, "/" в начале или середине привязывает
+    шаблон к папке игнор-файла, "\\" экранирует следующий символ.
+    Возвращает (регулярное выражение для пути относительно папки игнор-файла, отменяет ли правило).
+    Путь папки сравнивается с "/" на конце.
+    """
+    rules = []
+    for line in lines:
+        line = line.rstrip("\r\n")
+        # Конечные пробелы отбрасываются, если не экранированы
+        while line.endswith(" ") and not line.endswith("\\ "):
+            line = line[:-1]
+        if not line or line.startswith("#"):
+            continue
+        negate = line.startswith("!")
+        if negate:
+            line = line[1:]
+        if line.startswith("\\#") or line.startswith("\\!"):
+            line = line[1:]
+        dir_only = line.endswith("/")
+        body = line.rstrip("/")
+        if not body:
+            continue
+        anchored = "/" in body
+        body = body.lstrip("/")
+        regex = glob_to_regex(body)
+        if not anchored:
+            regex = "(?:.*/)?" + regex
+        rules.append((regex + ("/" if dir_only else "/?"), negate))
+    return rules
+
+
+class IgnoreFile:
+    """
+    Правила игнор-файлов одной папки, скомпилированные в одно выражение. Альтернативы идут
+    в обратном порядке, поэтому первая совпавшая - последнее подходящее правило, которое
+    по правилам git и решает судьбу пути.
+    """
+    def __init__(self, rules: Sequence[Tuple[str, bool]]):
+        rules = list(reversed(rules))
+        self._regex = re.compile("|".join("({0})".format(regex) for regex, _ in rules), _FLAGS)
+        self._negate = [negate for _, negate in rules]
+
+    def match(self, rel_path: str) -> Optional[bool]:
+        """True - путь игнорируется, False - явно не игнорируется ("!"), None - ни одно правило не подошло."""
+        m = self._regex.fullmatch(rel_path)
+        return None if m is None else not self._negate[m.lastindex - 1]
+
+
+class IgnoreMatcher:
+    """
+    Игнор-файлы отслеживаемой папки с семантикой git: правила файла действуют на его папку
+    и все вложенные, правила более глубокого файла важнее, а содержимое игнорируемой папки
+    игнорируется целиком (его нельзя вернуть через "!"). Папка .git игнорируется всегда.
+
+    Скомпилированные правила кешируются по папке (ключ - компоненты пути относительно корня).
+    Сканирование обновляет запись папки по подписи игнор-файлов из ее DirEntry (refresh),
+    наблюдатель сбрасывает ее при событии с игнор-файлом (invalidate), а остальные проверки
+    читают игнор-файлы папки только при первом обращении к ней.
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self._dirs: Dict[Tuple[str, ...], Tuple[Signature, Optional[IgnoreFile]]] = {}
+
+    def _load(self, rel_dir: Tuple[str, ...]) -> Tuple[Signature, Optional[IgnoreFile]]:
+        dir_path = os.path.join(self.root, *rel_dir)
+        signature, rules = [], []
+        for name in IGNORE_FILE_NAMES:
+            file_path = os.path.join(dir_path, name)
+            try:
+                file_stat = os.stat(file_path)
+                with open(file_path, "r", encoding="utf-8", errors="replace") as f:
+                    rules.extend(parse_ignore_lines(f))
+            except OSError:
+                continue # Файла нет или он недоступен
+            signature.append((name, file_stat.st_mtime_ns, file_stat.st_size))
+        return tuple(signature), (IgnoreFile(rules) if rules else None)
+
+    def _ignore_file(self, rel_dir: Tuple[str, ...]) -> Optional[IgnoreFile]:
+        entry = self._dirs.get(rel_dir)
+        if entry is None:
+            entry = self._dirs[rel_dir] = self._load(rel_dir)
+        return entry[1]
+
+    def refresh(self, rel_dir: Tuple[str, ...], signature: Signature):
+        """Перечитывает игнор-файлы папки, если их подпись (по данным обхода) отличается от кешированной."""
+        entry = self._dirs.get(rel_dir)
+        if entry is None or entry[0] != signature:
+            self._dirs[rel_dir] = self._load(rel_dir)
+
+    def invalidate(self, rel_dir: Tuple[str, ...]):
+        self._dirs.pop(rel_dir, None)
+
+    def is_entry_ignored(self, rel_parts: Sequence[str], is_dir: bool) -> bool:
+        """Игнорируется ли сам путь (его папки не проверяются - при обходе они уже проверены)."""
+        if is_dir and rel_parts[-1] == ".git":
+            return True
+        for depth in range(len(rel_parts) - 1, -1, -1):
+            ignore_file = self._ignore_file(tuple(rel_parts[:depth]))
+            if ignore_file is not None:
+                decision = ignore_file.match("/".join(rel_parts[depth:]) + ("/" if is_dir else ""))
+                if decision is not None:
+                    return decision
+        return False
+
+    def is_ignored(self, rel_parts: Sequence[str]) -> bool:
+        """Игнорируется ли файл: он сам или одна из его папок."""
+        return any(self.is_entry_ignored(rel_parts[:length], length < len(rel_parts))
+                   for length in range(1, len(rel_parts) + 1))
+
+
+def directory_signature(entries: Iterable[Tuple[str, os.stat_result]]) -> Signature:
+    """Подпись игнор-файлов папки по (имя, stat) ее файлов."""
+    return tuple(sorted((name, file_stat.st_mtime_ns, file_stat.st_size)
+                        for name, file_stat in entries if name in IGNORE_FILE_NAMES))
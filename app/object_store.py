@@ -0,0 +1,1368 @@
+# -*- coding: utf-8 -*-
+# Хранилище объектов (содержимого версий), адресуемых по хешу
+import io
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import BinaryIO, Callable, Dict, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+
+from app import compression, delta, file_io, hashing, packfile
+from app.chunker import FastCDC
+
+
+class ChunkedObjectReader(io.RawIOBase):
+    """
+    Поток только для чтения, который последовательно склеивает блоки
+    разбитого на части объекта, не загружая его целиком в память.
+    """
+
+    def __init__(self, open_chunk: Callable[[str], BinaryIO], chunk_hashes: List[str]):
+        super().__init__()
+        self._open_chunk = open_chunk
+        self._chunk_hashes = list(chunk_hashes)
+        self._current = None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer) -> int:
+        while True:
+            if self._current is None:
+                if not self._chunk_hashes:
+                    return 0
+                self._current = self._open_chunk(self._chunk_hashes.pop(0))
+            read = self._current.readinto(buffer)
+            if read:
+                return read
+            self._current.close()
+            self._current = None
+
+    def close(self):
+        if self._current is not None:
+            self._current.close()
+            self._current = None
+        super().close()
+
+
+class StagedObject(NamedTuple):
+    """
+    Содержимое файла, прочитанное и записанное во временные файлы хранилища, но еще не опубликованное
+    (см. ObjectStore.stage_file). Для разбитого объекта новые блоки уже лежат на местах,
+    а temp_name равен None.
+    """
+    object_hash: str
+    data_size: int
+    algorithm: str
+    codec: Optional[int]
+    temp_name: Optional[str]
+    chunks: Optional[List[Tuple[str, int]]] # Манифест (хеш_блока, размер_блока) разбитого объекта
+    new_chunks_size: int # Размер записанных этим файлом блоков на диске
+    quick_hash: Optional[str]
+    new_chunks: Tuple[Tuple[str, int], ...] = () # (хеш, размер на диске) блоков, записанных этим файлом
+
+
+class ObjectStore:
+    """
+    Управляет физическим хранением содержимого версий.
+
+    Небольшие файлы хранятся целиком в objects/<aa>/<хеш>. Крупные файлы
+    нарезаются на блоки по содержимому (FastCDC): блоки лежат в chunks/<aa>/<хеш блока>,
+    а список блоков версии (манифест) хранится в таблице object_chunks.
+    Поэтому правка одного байта в большом файле добавляет в хранилище
+    только изменившийся блок, а не еще одну полную копию.
+
+    Версии текстовых файлов могут храниться как бинарная дельта относительно
+    предыдущей версии (таблица object_deltas). Каждая DELTA_KEYFRAME_INTERVAL-я
+    версия цепочки сохраняется целиком, поэтому для восстановления любой версии
+    нужно применить не больше DELTA_KEYFRAME_INTERVAL - 1 дельт.
+
+    Все файлы хранилища (целые объекты, блоки, дельты) сжимаются выбранным
+    кодеком с небольшим заголовком (см. app/compression.py), кроме уже сжатых
+    данных: их выдает сигнатура формата или высокая энтропия выборки.
+
+    Новые файлы пишутся отдельно (objects/, chunks/), а фоновое обслуживание
+    переносит небольшие и холодные файлы в пакеты packs/pack-*.pack (см. app/packfile.py)
+    с индексом в таблице packed_objects. Чтение ищет файл сначала среди отдельных,
+    затем в индексе пакетов, поэтому для остального кода упаковка прозрачна.
+
+    Объем файлов хранилища ведется счетчиком в таблице storage_stats: он меняется
+    в той же транзакции, что и записи об объектах, поэтому узнать размер хранилища
+    можно без обхода папок (см. get_stored_bytes, measure_stored_bytes).
+
+    Объекты и блоки адресуются хешем содержимого; алгоритм хеширования (SHA-256 или BLAKE3,
+    см. app/hashing.py) - свойство хранилища, а каким алгоритмом адресован каждый объект,
+    записано в таблицах objects и object_chunks. После смены алгоритма существующие объекты
+    переадресуются в фоне (см. compute_rekey, rekey_object).
+
+    Методы не делают commit: транзакцией управляет HistoryManager.
+    Исключение - упаковка и уплотнение пакетов: они фиксируют индекс сами,
+    потому что отдельные файлы и старые пакеты можно удалять только после этого.
+    """
+    OBJECTS_DIR = "objects"
+    CHUNKS_DIR = "chunks"
+    PACKS_DIR = "packs"
+
+    # Виды файлов хранилища в индексе пакетов
+    KIND_OBJECT = 0
+    KIND_CHUNK = 1
+
+    STORED_BYTES_KEY = "stored_bytes" # Счетчик объема файлов хранилища в таблице storage_stats
+    # Файлы меньше этого размера хранятся целиком: для них нарезка не окупается.
+    CHUNKING_THRESHOLD = 8 * 1024 * 1024
+    # Новые блоки копятся до этого объема, чтобы проверять наличие в пакетах одним запросом к БД
+    CHUNK_BATCH_SIZE = 16 * 1024 * 1024
+
+    # --- Параметры дельта-цепочек ---
+    DELTA_KEYFRAME_INTERVAL = 20
+    DELTA_MIN_SIZE = 4 * 1024 # Для маленьких файлов дельта не дает заметной экономии
+    DELTA_MAX_SIZE = 2 * 1024 * 1024 # Дельта строится в памяти при сохранении: кодирование занимает десятки миллисекунд
+    DELTA_MAX_RATIO = 0.5 # Дельта сохраняется, только если она хотя бы вдвое меньше версии
+    DELTA_HEAD_CACHE_SIZE = 16 * 1024 * 1024 # Содержимое последних версий, от которых строятся следующие дельты
+
+    # --- Параметры упаковки ---
+    PACK_SMALL_OBJECT_SIZE = 64 * 1024 # Небольшие файлы упаковываются, как только перестают быть "горячими"
+    PACK_HOT_AGE = 60 * 60 # Секунды: свежие файлы остаются отдельными, пока их версии активно меняются
+    PACK_COLD_AGE = 7 * 24 * 60 * 60 # Секунды: файлы старше этого срока упаковываются независимо от размера
+    PACK_MAX_ENTRY_SIZE = 16 * 1024 * 1024 # Более крупные файлы всегда остаются отдельными
+    PACK_MAX_SIZE = 256 * 1024 * 1024
+    PACK_GARBAGE_RATIO = 0.3 # Пакет переписывается, когда такая доля его объема занята удаленными записями
+    PACK_SMALL_PACK_SIZE = 16 * 1024 * 1024 # Мелкие пакеты объединяются при уплотнении
+
+    # Секунды: блок без ссылок моложе этого срока может принадлежать объекту, который сейчас сохраняется
+    ORPHAN_CHUNK_MIN_AGE = 24 * 60 * 60
+
+    def __init__(self, storage_path: Path, db_connection: sqlite3.Connection, db_lock: threading.RLock):
+        self.storage_path = storage_path
+        self.objects_path = storage_path / self.OBJECTS_DIR
+        self.chunks_path = storage_path / self.CHUNKS_DIR
+        self.packs_path = storage_path / self.PACKS_DIR
+        self._db_connection = db_connection
+        self._db_connection_lock = db_lock
+        self._chunker = FastCDC()
+        self.codec = compression.default_codec()
+        self.hash_algorithm = hashing.DEFAULT_ALGORITHM
+        # Читать ли большие исходные файлы через mmap (см. file_io.iter_blocks, настройка use_mmap).
+        # Выключено по умолчанию: в Windows отображенный файл нельзя обрезать, пока идет чтение
+        self.use_mmap = False
+        # Способы копирования без чтения в память процесса, работающие на томе хранилища (см. probe_clone_support)
+        self.clone_methods: Tuple[str, ...] = ()
+        self._clone_unsupported_devices: Set[int] = set()
+        # Блоки, которые сейчас записывает один из потоков (хеш -> событие окончания записи):
+        # одинаковый блок из двух файлов, читаемых параллельно, записывается один раз
+        self._in_flight_chunks: Dict[str, threading.Event] = {}
+        self._in_flight_lock = threading.Lock()
+        # Содержимое последних сохраненных версий (хеш -> данные), в порядке использования: следующая версия
+        # того же файла кодируется относительно него без восстановления цепочки дельт
+        self._delta_heads: "OrderedDict[str, bytes]" = OrderedDict()
+        self._delta_heads_size = 0
+
+    def set_codec(self, codec: int):
+        """Задает кодек для новых объектов. Уже сохраненные объекты читаются любым кодеком."""
+        self.codec = codec if compression.is_codec_available(codec) else compression.default_codec()
+
+    def set_hash_algorithm(self, algorithm: str):
+        """Задает алгоритм хеширования новых объектов. Недоступный алгоритм заменяется SHA-256."""
+        self.hash_algorithm = hashing.algorithm_from_name(algorithm)
+
+    def setup(self):
+        """Создает служебные папки хранилища."""
+        self.objects_path.mkdir(parents=True, exist_ok=True)
+        self.chunks_path.mkdir(parents=True, exist_ok=True)
+        self.packs_path.mkdir(parents=True, exist_ok=True)
+
+    def probe_clone_support(self):
+        """
+        Проверяет, умеет ли том хранилища копировать файлы без чтения данных в память процесса:
+        клонированием экстентов (FICLONE на btrfs, XFS) или копированием в ядре (copy_file_range).
+        Каждый способ проверяется на пробном файле, и результат сверяется с исходными данными.
+        """
+        probe_data = bytes(range(256)) * 32
+        supported = []
+        for method in file_io.available_clone_methods():
+            source_fd, source_name = tempfile.mkstemp(dir=self.objects_path, suffix=".tmp")
+            target_fd, target_name = tempfile.mkstemp(dir=self.objects_path, suffix=".tmp")
+            try:
+                with os.fdopen(source_fd, "w+b") as source, os.fdopen(target_fd, "w+b") as target:
+                    source.write(probe_data)
+                    source.flush()
+                    file_io.clone_file(method, source.fileno(), target.fileno())
+                    target.seek(0)
+                    if target.read() == probe_data:
+                        supported.append(method)
+            except OSError:
+                pass
+            finally:
+                self._discard_temp(source_name)
+                self._discard_temp(target_name)
+        self.clone_methods = tuple(supported)
+
+    # --- Учет занятого места ---
+
+    def _add_stored_bytes(self, size_delta: int):
+        if size_delta:
+            with self._db_connection_lock:
+                self._db_connection.execute(
+                    "UPDATE storage_stats SET value = value + ? WHERE name = ?", (size_delta, self.STORED_BYTES_KEY)
+                )
+
+    def get_stored_bytes(self) -> Optional[int]:
+        """Объем файлов хранилища по счетчику или None, если счетчик еще не заведен."""
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT value FROM storage_stats WHERE name = ?", (self.STORED_BYTES_KEY,))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def set_stored_bytes(self, stored_bytes: int):
+        with self._db_connection_lock:
+            self._db_connection.execute(
+                "INSERT OR REPLACE INTO storage_stats (name, value) VALUES (?, ?)", (self.STORED_BYTES_KEY, stored_bytes)
+            )
+
+    def measure_stored_bytes(self, should_stop_callback=None) -> Optional[int]:
+        """
+        Подсчитывает фактический объем файлов хранилища обходом папок (для сверки счетчика).
+        Временные файлы не учитываются. Возвращает None, если подсчет прерван.
+        """
+        total_bytes = 0
+        for root in (self.objects_path, self.chunks_path, self.packs_path):
+            for dirpath, _, filenames in os.walk(root):
+                if should_stop_callback and should_stop_callback():
+                    return None
+                for filename in filenames:
+                    if filename.endswith(".tmp"):
+                        continue
+                    try:
+                        total_bytes += os.stat(os.path.join(dirpath, filename)).st_size
+                    except OSError:
+                        pass # Файл удален во время обхода
+        return total_bytes
+
+    # --- Адресация ---
+
+    def _loose_path(self, object_hash: str) -> Path:
+        return self.objects_path / object_hash[:2] / object_hash[2:]
+
+    def _chunk_path(self, chunk_hash: str) -> Path:
+        return self.chunks_path / chunk_hash[:2] / chunk_hash[2:]
+
+    def _kind_path(self, kind: int, object_hash: str) -> Path:
+        return self._chunk_path(object_hash) if kind == self.KIND_CHUNK else self._loose_path(object_hash)
+
+    def _get_pack_location(self, kind: int, object_hash: str) -> Optional[Tuple[str, int, int]]:
+        """Возвращает (имя_пакета, смещение, длина) упакованного файла или None."""
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("""
+                SELECT p.name, o.entry_offset, o.entry_length
+                FROM packed_objects o JOIN packs p ON p.id = o.pack_id
+                WHERE o.kind = ? AND o.hash = ?""", (kind, object_hash))
+            return cursor.fetchone()
+
+    def _has_stored(self, kind: int, object_hash: str) -> bool:
+        """Проверяет наличие файла хранилища: отдельного или упакованного."""
+        return self._kind_path(kind, object_hash).exists() or self._get_pack_location(kind, object_hash) is not None
+
+    def _open_stored(self, kind: int, object_hash: str) -> BinaryIO:
+        """
+        Открывает файл хранилища (отдельный или запись пакета) для чтения распакованного содержимого.
+        Выбрасывает FileNotFoundError, если файла нет.
+        """
+        # Под блокировкой БД: упаковка не удалит отдельный файл между проверкой и открытием
+        with self._db_connection_lock:
+            stored_path = self._kind_path(kind, object_hash)
+            if stored_path.exists():
+                return compression.open_stored(stored_path)
+            location = self._get_pack_location(kind, object_hash)
+            if location is None:
+                raise FileNotFoundError("Файл хранилища не найден: {0}".format(object_hash))
+            pack_name, offset, length = location
+            return compression.open_decoded(packfile.open_entry(self.packs_path / pack_name, offset, length))
+
+    def _get_manifest(self, object_hash: str) -> List[Tuple[str, int]]:
+        """Возвращает упорядоченный список (хеш_блока, размер_блока) объекта."""
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute(
+                "SELECT chunk_hash, chunk_size FROM object_chunks WHERE object_hash = ? ORDER BY seq",
+                (object_hash,)
+            )
+            return cursor.fetchall()
+
+    def is_chunked(self, object_hash: str) -> bool:
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT 1 FROM object_chunks WHERE object_hash = ? LIMIT 1", (object_hash,))
+            return cursor.fetchone() is not None
+
+    def _get_delta_info(self, object_hash: str) -> Optional[Tuple[str, int]]:
+        """Возвращает (хеш_базовой_версии, глубина_цепочки) для дельта-объекта или None."""
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT base_hash, chain_depth FROM object_deltas WHERE object_hash = ?", (object_hash,))
+            return cursor.fetchone()
+
+    def has_dependents(self, object_hash: str) -> bool:
+        """Проверяет, служит ли объект базой для дельт других объектов."""
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT 1 FROM object_deltas WHERE base_hash = ? LIMIT 1", (object_hash,))
+            return cursor.fetchone() is not None
+
+    def contains(self, object_hash: str) -> bool:
+        """Проверяет, сохранено ли содержимое с данным хешем."""
+        return self._has_stored(self.KIND_OBJECT, object_hash) or self.is_chunked(object_hash)
+
+    def get_loose_path(self, object_hash: str) -> Optional[Path]:
+        """
+        Путь к объекту, который хранится отдельным файлом целиком и без сжатия
+        (его можно читать напрямую), или None.
+        """
+        object_path = self._loose_path(object_hash)
+        if not object_path.exists() or self._get_delta_info(object_hash):
+            return None
+        try:
+            return object_path if compression.is_plain_file(object_path) else None
+        except OSError:
+            return None
+
+    # --- Запись ---
+
+    def ingest_file(self, file_path: Path, base_hash: Optional[str] = None,
+                    staged: Optional[StagedObject] = None) -> Tuple[str, int]:
+        """
+        Сохраняет содержимое файла за один проход чтения: хеш считается одновременно
+        с записью во временный файл хранилища, затем объект атомарно публикуется под своим хешем
+        (или копия отбрасывается, если такой объект уже есть). Поэтому файл читается один раз,
+        и в хранилище попадает ровно то содержимое, от которого посчитан хеш.
+        base_hash - хеш предыдущей версии того же файла; если он передан,
+        версия может быть сохранена как дельта относительно нее.
+        staged - содержимое файла, заранее подготовленное stage_file (без блокировки): оно только публикуется.
+        Возвращает (хеш, размер). Выбрасывает OSError при ошибке ввода-вывода.
+        """
+        if staged is not None:
+            return self.commit_staged(staged)
+        file_size = file_path.stat().st_size
+        if self.uses_delta(file_size, base_hash):
+            # Небольшой файл: чтение, кодирование и запись дельты идут под блокировкой, база не исчезнет
+            with self._db_connection_lock:
+                return self._ingest_with_delta(file_path, base_hash)
+        return self.commit_staged(self.stage_file(file_path, file_size))
+
+    def uses_delta(self, file_size: int, base_hash: Optional[str]) -> bool:
+        """
+        Будет ли ingest_file пытаться сохранить файл дельтой. Остальные файлы вызывающая сторона
+        может подготовить stage_file без блокировки, а под блокировкой лишь опубликовать (commit_staged).
+        """
+        return bool(base_hash) and file_size < self.CHUNKING_THRESHOLD and self.DELTA_MIN_SIZE <= file_size <= self.DELTA_MAX_SIZE
+
+    def stage_file(self, file_path: Path, file_size: Optional[int] = None) -> StagedObject:
+        """
+        Первая половина сохранения содержимого: чтение, хеширование и запись во временные файлы.
+        Не меняет БД и не требует блокировки, поэтому разные файлы можно обрабатывать в нескольких
+        потоках одновременно. Результат публикуется commit_staged или отбрасывается discard_staged.
+        file_size - известный вызывающей стороне размер файла (выбирает способ хранения).
+        Выбрасывает OSError.
+        """
+        if file_size is None:
+            file_size = file_path.stat().st_size
+        if file_size >= self.CHUNKING_THRESHOLD:
+            return self._stage_chunked(file_path)
+        return self._stage_loose(file_path, file_size)
+
+    def commit_staged(self, staged: StagedObject) -> Tuple[str, int]:
+        """
+        Публикует подготовленное содержимое и записывает объект в БД (без commit).
+        Если такой объект уже есть, временная копия отбрасывается. Возвращает (хеш, размер).
+        Выбрасывает OSError (в том числе если блок, на который рассчитывал манифест, был удален) и sqlite3.Error.
+        """
+        with self._db_connection_lock:
+            if staged.chunks is None:
+                if self.contains(staged.object_hash):
+                    self._discard_temp(staged.temp_name)
+                else:
+                    stored_size = self._publish(staged.temp_name, self._loose_path(staged.object_hash))
+                    self._register_object(staged.object_hash, staged.data_size, stored_size, staged.codec, staged.algorithm)
+                return staged.object_hash, staged.data_size
+
+            self._add_stored_bytes(staged.new_chunks_size)
+            if self.contains(staged.object_hash):
+                if staged.quick_hash:
+                    self._set_quick_hash(staged.object_hash, staged.quick_hash)
+                return staged.object_hash, staged.data_size
+            # Уже сохраненный блок мог быть удален вместе с другим объектом, пока файл читался
+            for chunk_hash, _ in staged.chunks:
+                if not self._has_stored(self.KIND_CHUNK, chunk_hash):
+                    raise FileNotFoundError("Блок хранилища удален во время сохранения: {0}".format(chunk_hash))
+            cursor = self._db_connection.cursor()
+            cursor.executemany(
+                "INSERT INTO object_chunks (object_hash, seq, chunk_hash, chunk_size, hash_algorithm) VALUES (?, ?, ?, ?, ?)",
+                [(staged.object_hash, seq, chunk_hash, size, staged.algorithm)
+                 for seq, (chunk_hash, size) in enumerate(staged.chunks)]
+            )
+            # Блоки сжимаются по отдельности, поэтому общего кодека у объекта нет
+            self._register_object(staged.object_hash, staged.data_size, staged.new_chunks_size, None,
+                                  staged.algorithm, staged.quick_hash)
+        return staged.object_hash, staged.data_size
+
+    def discard_staged(self, staged: StagedObject):
+        """
+        Отбрасывает неопубликованную копию (после остановки или неудачного commit_staged, когда его
+        изменения БД уже откачены). Записанные ею блоки удаляются, если на них еще не сослался другой объект.
+        """
+        if staged.temp_name:
+            self._discard_temp(staged.temp_name)
+        if staged.new_chunks:
+            self._release_new_chunks(staged.new_chunks)
+
+    def _release_new_chunks(self, new_chunks: Iterable[Tuple[str, int]]):
+        """
+        Удаляет блоки неопубликованного объекта, на которые нет ссылок в object_chunks. Блок, которым
+        уже воспользовался другой объект (он счел блок сохраненным и не учел его объем), остается
+        и учитывается в счетчике объема: счетчик пополняет только публикация записавшего блок объекта.
+        """
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            adopted_size = 0
+            for chunk_hash, stored_size in new_chunks:
+                cursor.execute("SELECT 1 FROM object_chunks WHERE chunk_hash = ? LIMIT 1", (chunk_hash,))
+                if cursor.fetchone() is not None:
+                    adopted_size += stored_size
+                    continue
+                try:
+                    self._remove_uncounted_file(self._chunk_path(chunk_hash))
+                except OSError:
+                    pass # Блок удалит очистка неиспользуемых блоков (remove_orphan_chunks)
+            if adopted_size:
+                self._add_stored_bytes(adopted_size)
+                self._db_connection.commit()
+
+    def _remove_uncounted_file(self, file_path: Path):
+        """Удаляет файл хранилища, не учтенный в счетчике объема, и опустевшую папку хеша."""
+        os.remove(file_path)
+        subdir = file_path.parent
+        if not any(subdir.iterdir()):
+            os.rmdir(subdir)
+
+    def remove_orphan_chunks(self, should_stop_callback=None) -> int:
+        """
+        Удаляет отдельные файлы блоков, на которые не ссылается ни один объект (например, оставшиеся
+        после сбоя во время сохранения). Свежие файлы не трогаются: их блоки может сейчас публиковать
+        другой поток. Такие файлы не учтены в счетчике объема, поэтому он не меняется.
+        Возвращает число удаленных файлов.
+        """
+        if not self.chunks_path.is_dir():
+            return 0
+        fresh_after = time.time() - self.ORPHAN_CHUNK_MIN_AGE
+        removed_count = 0
+        for dirpath, _, filenames in os.walk(self.chunks_path):
+            if should_stop_callback and should_stop_callback():
+                break
+            prefix = os.path.basename(dirpath)
+            for filename in filenames:
+                if filename.endswith(".tmp"):
+                    continue
+                chunk_hash = prefix + filename
+                chunk_path = self._chunk_path(chunk_hash)
+                with self._db_connection_lock:
+                    with self._in_flight_lock:
+                        if chunk_hash in self._in_flight_chunks:
+                            continue
+                    cursor = self._db_connection.cursor()
+                    cursor.execute("SELECT 1 FROM object_chunks WHERE chunk_hash = ? LIMIT 1", (chunk_hash,))
+                    if cursor.fetchone() is not None:
+                        continue
+                    try:
+                        if chunk_path.stat().st_mtime > fresh_after:
+                            continue
+                        self._remove_uncounted_file(chunk_path)
+                        removed_count += 1
+                    except OSError:
+                        pass
+        return removed_count
+
+    def _stage_loose(self, file_path: Path, file_size: int) -> StagedObject:
+        algorithm = self.hash_algorithm
+        hasher = hashing.new_hasher(algorithm)
+        with file_io.open_sequential(file_path) as source:
+            codec = self.codec
+            if codec != compression.CODEC_NONE and compression.is_file_incompressible(source, file_size):
+                codec = compression.CODEC_NONE
+            cloned = None
+            if codec == compression.CODEC_NONE and self.clone_methods:
+                cloned = self._clone_to_temp(source, hasher)
+            if cloned:
+                temp_name, data_size = cloned
+            else:
+                temp_name, data_size = self._encode_to_temp(self.objects_path, source, codec, hasher=hasher)
+        return StagedObject(hasher.hexdigest(), data_size, algorithm, codec, temp_name, None, 0, None)
+
+    def _clone_to_temp(self, source: BinaryIO, hasher) -> Optional[Tuple[str, int]]:
+        """
+        Быстрый путь для объектов, которые хранятся без сжатия: копирует файл во временный
+        файл хранилища клонированием или в ядре, а хеш считает по готовой копии. При клонировании
+        копия - это снимок файла, поэтому хеш всегда соответствует сохраненному содержимому.
+        Возвращает (имя_временного_файла, размер) или None, если нужно копировать обычным способом.
+        """
+        source_device = os.fstat(source.fileno()).st_dev
+        if source_device in self._clone_unsupported_devices:
+            return None
+        fd, temp_name = tempfile.mkstemp(dir=self.objects_path, suffix=".tmp")
+        with os.fdopen(fd, "r+b") as target:
+            for method in self.clone_methods:
+                try:
+                    file_io.clone_file(method, source.fileno(), target.fileno())
+                    break
+                except OSError as e:
+                    target.truncate(0) # copy_file_range мог успеть скопировать часть данных
+                    if not file_io.is_unsupported_error(e):
+                        self._discard_temp(temp_name)
+                        return None
+            else:
+                # Файл на другом томе или в файловой системе без поддержки - больше не пробуем
+                self._clone_unsupported_devices.add(source_device)
+                self._discard_temp(temp_name)
+                return None
+
+            target.seek(0)
+            data_size = 0
+            for block in file_io.iter_blocks(target):
+                if data_size == 0 and compression.needs_raw_header(bytes(block[:compression.HEADER_SIZE])):
+                    break # Содержимое похоже на заголовок хранилища: нужна запись с заголовком
+                hasher.update(block)
+                data_size += len(block)
+            else:
+                return temp_name, data_size
+        self._discard_temp(temp_name)
+        return None
+
+    def _ingest_with_delta(self, file_path: Path, base_hash: str) -> Tuple[str, int]:
+        """Читает небольшой текстовый файл в память и сохраняет его дельтой или целиком."""
+        with file_io.open_sequential(file_path) as f:
+            data = f.read()
+        algorithm = self.hash_algorithm
+        object_hash = hashing.hash_bytes(algorithm, data)
+        if not self.contains(object_hash):
+            stored = self._put_delta(object_hash, data, base_hash)
+            if not stored:
+                stored = self._write_bytes_encoded(self._loose_path(object_hash), data)
+            self._register_object(object_hash, len(data), *stored, algorithm)
+        self._remember_delta_head(object_hash, data)
+        return object_hash, len(data)
+
+    def _put_delta(self, object_hash: str, target_data: bytes, base_hash: str) -> Optional[Tuple[int, int]]:
+        """
+        Пытается сохранить версию как дельту относительно base_hash.
+        Возвращает (размер_на_диске, кодек) или None, если версию выгоднее (или пора) сохранить целиком.
+        """
+        if self.is_chunked(base_hash) or not self.contains(base_hash):
+            return None
+
+        base_info = self._get_delta_info(base_hash)
+        chain_depth = (base_info[1] if base_info else 0) + 1
+        if chain_depth >= self.DELTA_KEYFRAME_INTERVAL:
+            return None # Пора сохранить опорную (полную) версию
+
+        base_data = self._delta_heads.get(base_hash)
+        if base_data is None:
+            try:
+                base_data = self._read_delta_chain(base_hash)
+            except delta.DeltaError:
+                return None
+        delta_data = delta.encode(base_data, target_data, int(len(target_data) * self.DELTA_MAX_RATIO))
+        if delta_data is None:
+            return None
+
+        stored = self._write_bytes_encoded(self._loose_path(object_hash), delta_data)
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute(
+                "INSERT INTO object_deltas (object_hash, base_hash, chain_depth) VALUES (?, ?, ?)",
+                (object_hash, base_hash, chain_depth)
+            )
+        return stored
+
+    def _remember_delta_head(self, object_hash: str, data: bytes):
+        """
+        Кеширует содержимое версии, от которой будет строиться следующая дельта.
+        Объекты адресуются по содержимому, поэтому запись кеша не устаревает.
+        """
+        if object_hash in self._delta_heads:
+            self._delta_heads.move_to_end(object_hash)
+            return
+        self._delta_heads[object_hash] = data
+        self._delta_heads_size += len(data)
+        while self._delta_heads_size > self.DELTA_HEAD_CACHE_SIZE:
+            _, evicted = self._delta_heads.popitem(last=False)
+            self._delta_heads_size -= len(evicted)
+
+    def _stage_chunked(self, file_path: Path) -> StagedObject:
+        """
+        Нарезает файл на блоки, сохраняя новые блоки по мере чтения; манифест записывает commit_staged.
+        Блоки адресуются по содержимому, поэтому для уже сохраненного объекта новых блоков не появляется.
+        Попутно считается быстрый хеш файла (если доступен) для проверки неизменности (см. matches_quick_hash).
+        Наличие блоков проверяется без блокировки БД (упакованные - одним запросом на пачку блоков):
+        окончательно их наличие проверяет commit_staged.
+        """
+        algorithm = self.hash_algorithm
+        hasher = hashing.new_hasher(algorithm)
+        quick_hasher = hashing.new_quick_hasher()
+        manifest = []
+        new_chunks = []
+        batch: Dict[str, bytes] = {} # Захваченные этим потоком блоки, которых нет среди отдельных файлов
+        batch_size = 0
+        try:
+            with file_io.open_sequential(file_path) as f:
+                for chunk in self._chunker.iter_chunks(f):
+                    hasher.update(chunk)
+                    if quick_hasher is not None:
+                        quick_hasher.update(chunk)
+                    chunk_hash = hashing.hash_bytes(algorithm, chunk)
+                    manifest.append((chunk_hash, len(chunk)))
+                    if chunk_hash in batch:
+                        continue
+                    while not self._chunk_path(chunk_hash).exists():
+                        in_flight = self._claim_chunk(chunk_hash)
+                        if in_flight is None:
+                            batch[chunk_hash] = chunk
+                            batch_size += len(chunk)
+                            break
+                        # Свои блоки записываются до ожидания: иначе два потока могут ждать друг друга
+                        new_chunks.extend(self._write_chunk_batch(batch))
+                        batch_size = 0
+                        in_flight.wait()
+                    if batch_size >= self.CHUNK_BATCH_SIZE:
+                        new_chunks.extend(self._write_chunk_batch(batch))
+                        batch_size = 0
+                new_chunks.extend(self._write_chunk_batch(batch))
+        finally:
+            self._release_chunk_claims(batch)
+
+        quick_hash = quick_hasher.hexdigest() if quick_hasher is not None else None
+        data_size = sum(size for _, size in manifest)
+        new_chunks_size = sum(size for _, size in new_chunks)
+        return StagedObject(hasher.hexdigest(), data_size, algorithm, None, None, manifest, new_chunks_size, quick_hash,
+                            tuple(new_chunks))
+
+    def _claim_chunk(self, chunk_hash: str) -> Optional[threading.Event]:
+        """
+        Отмечает блок как записываемый этим потоком. Если его уже записывает другой поток,
+        возвращает событие окончания той записи.
+        """
+        with self._in_flight_lock:
+            in_flight = self._in_flight_chunks.get(chunk_hash)
+            if in_flight is None:
+                self._in_flight_chunks[chunk_hash] = threading.Event()
+            return in_flight
+
+    def _release_chunk_claims(self, batch: Dict[str, bytes]):
+        with self._in_flight_lock:
+            events = [self._in_flight_chunks.pop(chunk_hash) for chunk_hash in batch]
+        batch.clear()
+        for in_flight in events:
+            in_flight.set()
+
+    def _write_chunk_batch(self, batch: Dict[str, bytes]) -> List[Tuple[str, int]]:
+        """
+        Записывает захваченные блоки, которых нет ни отдельными файлами, ни в пакетах, и снимает захват.
+        Счетчик объема не меняется (его пополняет commit_staged).
+        Возвращает (хеш_блока, размер_файла) записанных блоков.
+        """
+        if not batch:
+            return []
+        written = []
+        try:
+            packed_chunks = self._get_packed_chunks(list(batch))
+            for chunk_hash, chunk in batch.items():
+                chunk_path = self._chunk_path(chunk_hash)
+                # Проверка после захвата: блок, записанный другим потоком, уже лежит на месте
+                if chunk_hash in packed_chunks or chunk_path.exists():
+                    continue
+                stored_size = self._write_bytes_encoded(chunk_path, chunk, count_stored=False)[0]
+                written.append((chunk_hash, stored_size))
+        finally:
+            self._release_chunk_claims(batch)
+        return written
+
+    def _get_packed_chunks(self, chunk_hashes: List[str]) -> Set[str]:
+        """Возвращает те из блоков, что хранятся в пакетах."""
+        placeholders = ", ".join("?" * len(chunk_hashes))
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute(
+                "SELECT hash FROM packed_objects WHERE kind = ? AND hash IN ({0})".format(placeholders),
+                [self.KIND_CHUNK] + chunk_hashes
+            )
+            return {row[0] for row in cursor.fetchall()}
+
+    def _register_object(self, object_hash: str, data_size: int, stored_size: int, codec: Optional[int],
+                         algorithm: str, quick_hash: Optional[str] = None):
+        """
+        Записывает в таблицу objects параметры хранения нового объекта и алгоритм его хеша.
+        Счетчик ссылок ведут триггеры таблицы versions.
+        """
+        with self._db_connection_lock:
+            self._db_connection.execute("""
+                INSERT INTO objects (hash, size, refcount, stored_size, codec, hash_algorithm, quick_hash)
+                VALUES (?, ?, 0, ?, ?, ?, ?)
+                ON CONFLICT (hash) DO UPDATE SET stored_size = excluded.stored_size, codec = excluded.codec,
+                    hash_algorithm = excluded.hash_algorithm, quick_hash = excluded.quick_hash""",
+                (object_hash, data_size, stored_size, codec, algorithm, quick_hash)
+            )
+
+    def _set_quick_hash(self, object_hash: str, quick_hash: str):
+        with self._db_connection_lock:
+            self._db_connection.execute("UPDATE objects SET quick_hash = ? WHERE hash = ?", (quick_hash, object_hash))
+
+    def matches_quick_hash(self, object_hash: str, file_path: Path) -> bool:
+        """
+        Быстрая проверка, что файл не отличается от сохраненного объекта: размер и быстрый хеш (xxh3)
+        файла совпадают с записанными для объекта. Быстрый хеш в несколько раз дешевле криптографического,
+        поэтому неизмененный большой файл не приходится нарезать и хешировать заново.
+        Возвращает False, если быстрого хеша нет или он недоступен. Выбрасывает OSError.
+        """
+        if not hashing.quick_hash_available():
+            return False
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT size, quick_hash FROM objects WHERE hash = ?", (object_hash,))
+            row = cursor.fetchone()
+        if not row or not row[1] or row[0] != file_path.stat().st_size:
+            return False
+        # Страницы файла остаются в кеше: если файл изменился, его сразу прочитает сохранение версии
+        with file_io.open_sequential(file_path, drop_cache=False) as f:
+            return hashing.quick_hash_stream(f, self.use_mmap) == row[1]
+
+    def _write_bytes_encoded(self, target_path: Path, data: bytes, count_stored: bool = True) -> Tuple[int, int]:
+        """Сохраняет данные из памяти, сжимая их, если это имеет смысл. Возвращает (размер_на_диске, кодек)."""
+        codec = self.codec
+        if codec != compression.CODEC_NONE and compression.is_data_incompressible(data):
+            codec = compression.CODEC_NONE
+        target_path.parent.mkdir(exist_ok=True)
+        temp_name, _ = self._encode_to_temp(target_path.parent, io.BytesIO(data), codec)
+        return self._publish(temp_name, target_path, count_stored), codec
+
+    def _encode_to_temp(self, temp_dir: Path, source: BinaryIO, codec: int, level: Optional[int] = None,
+                        hasher=None) -> Tuple[str, int]:
+        """
+        Пишет поток в формате хранилища во временный файл в temp_dir (на том же томе, что и хранилище),
+        попутно передавая исходные данные в hasher. Возвращает (имя_временного_файла, размер_исходных_данных).
+        """
+        fd, temp_name = tempfile.mkstemp(dir=temp_dir, suffix=".tmp")
+        data_size = 0
+        try:
+            with os.fdopen(fd, "wb") as f:
+                writer = compression.EncodingWriter(f, codec, level)
+                for block in file_io.iter_blocks(source, self.use_mmap):
+                    if hasher is not None:
+                        hasher.update(block)
+                    writer.write(block)
+                    data_size += len(block)
+                writer.finish()
+        except OSError:
+            self._discard_temp(temp_name)
+            raise
+        return temp_name, data_size
+
+    def _publish(self, temp_name: str, target_path: Path, count_stored: bool = True) -> int:
+        """
+        Атомарно переименовывает готовый временный файл, чтобы в хранилище не попадали недописанные объекты.
+        Если count_stored, размер файла добавляется к счетчику объема. Возвращает размер файла.
+        """
+        try:
+            target_path.parent.mkdir(exist_ok=True)
+            stored_size = os.path.getsize(temp_name)
+            os.replace(temp_name, target_path)
+        except OSError:
+            self._discard_temp(temp_name)
+            raise
+        if count_stored:
+            self._add_stored_bytes(stored_size)
+        return stored_size
+
+    @staticmethod
+    def _discard_temp(temp_name: str):
+        try:
+            os.remove(temp_name)
+        except OSError:
+            pass
+
+    # --- Чтение ---
+
+    def _read_delta_chain(self, object_hash: str) -> bytes:
+        """
+        Восстанавливает содержимое объекта в памяти, применяя цепочку дельт
+        к ближайшей полной версии. Используется только для небольших текстовых файлов.
+        """
+        chain = []
+        current_hash = object_hash
+        delta_info = self._get_delta_info(current_hash)
+        while delta_info:
+            chain.append(current_hash)
+            current_hash = delta_info[0]
+            delta_info = self._get_delta_info(current_hash)
+
+        with self._open_stored(self.KIND_OBJECT, current_hash) as f:
+            data = f.read()
+        for delta_hash in reversed(chain):
+            with self._open_stored(self.KIND_OBJECT, delta_hash) as f:
+                data = delta.apply(data, f.read())
+        return data
+
+    def open(self, object_hash: str) -> Optional[BinaryIO]:
+        """Открывает объект как бинарный поток для последовательного чтения."""
+        if self._has_stored(self.KIND_OBJECT, object_hash):
+            if self._get_delta_info(object_hash):
+                try:
+                    return io.BytesIO(self._read_delta_chain(object_hash))
+                except delta.DeltaError as e:
+                    raise OSError("Не удалось восстановить версию {0}: {1}".format(object_hash, e)) from e
+            return self._open_stored(self.KIND_OBJECT, object_hash)
+        manifest = self._get_manifest(object_hash)
+        if not manifest:
+            return None
+        chunk_hashes = [chunk_hash for chunk_hash, _ in manifest]
+        return io.BufferedReader(ChunkedObjectReader(lambda chunk_hash: self._open_stored(self.KIND_CHUNK, chunk_hash), chunk_hashes))
+
+    def export(self, object_hash: str, target_path: Path, mtime: Optional[float] = None) -> bool:
+        """
+        Потоково распаковывает объект в указанный файл. Содержимое пишется во временный файл
+        в той же папке, который затем атомарно подменяет целевой: ошибка посередине не портит
+        существующий файл. Права существующего файла сохраняются; mtime - время изменения результата.
+        Возвращает False, если объекта нет в хранилище. Выбрасывает OSError.
+        """
+        source = self.open(object_hash)
+        if source is None:
+            return False
+        with source:
+            fd, temp_name = tempfile.mkstemp(dir=target_path.parent, prefix=".undoit-", suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as target:
+                    file_io.copy_stream(source, target)
+                if target_path.exists():
+                    shutil.copymode(target_path, temp_name)
+                if mtime is not None:
+                    os.utime(temp_name, (mtime, mtime))
+                os.replace(temp_name, target_path)
+            except BaseException:
+                try:
+                    os.remove(temp_name)
+                except OSError:
+                    pass
+                raise
+        return True
+
+    def materialize(self, object_hash: str, suffix: str = "") -> Optional[Path]:
+        """
+        Собирает объект во временный файл и возвращает путь к нему.
+        Вызывающая сторона отвечает за удаление файла.
+        """
+        source = self.open(object_hash)
+        if source is None:
+            return None
+        with source, tempfile.NamedTemporaryFile(suffix=suffix, delete=False) as tmp:
+            file_io.copy_stream(source, tmp)
+            return Path(tmp.name)
+
+    # --- Фоновое пересжатие ---
+
+    def get_physical_paths(self, object_hash: str) -> List[Path]:
+        """
+        Отдельные файлы, в которых хранится объект: сам объект (или дельта) либо его блоки.
+        Упакованные файлы не возвращаются.
+        """
+        loose_path = self._loose_path(object_hash)
+        if loose_path.exists():
+            return [loose_path]
+        chunk_paths = [self._chunk_path(chunk_hash) for chunk_hash, _ in self._get_manifest(object_hash)]
+        return [chunk_path for chunk_path in chunk_paths if chunk_path.exists()]
+
+    def recompress_object(self, object_hash: str) -> Tuple[int, int]:
+        """
+        Пересжимает отдельные файлы объекта максимальным уровнем текущего кодека
+        и обновляет параметры хранения в таблице objects.
+        Возвращает (количество_пересжатых_файлов, освобождено_байт).
+        """
+        with self._db_connection_lock:
+            stored_paths = self.get_physical_paths(object_hash)
+            is_chunked = self.is_chunked(object_hash)
+        recompressed_count, freed_bytes = 0, 0
+        for stored_path in stored_paths:
+            try:
+                saved = self.recompress_file(stored_path)
+            except OSError:
+                continue # Объект мог быть удален или занят - попробуем в следующий раз
+            if saved:
+                freed_bytes += saved
+                recompressed_count += 1
+        if recompressed_count:
+            with self._db_connection_lock:
+                self._db_connection.execute(
+                    "UPDATE objects SET stored_size = MAX(stored_size - ?, 0), codec = ? WHERE hash = ?",
+                    (freed_bytes, None if is_chunked else self.codec, object_hash)
+                )
+        return recompressed_count, freed_bytes
+
+    def recompress_file(self, stored_path: Path) -> int:
+        """
+        Пересжимает файл хранилища максимальным уровнем текущего кодека.
+        Возвращает количество освобожденных байт (0, если пересжатие не нужно или не выгодно).
+        Выбрасывает OSError.
+        """
+        codec = self.codec
+        if codec == compression.CODEC_NONE or not stored_path.exists():
+            return 0
+        max_level = compression.MAX_LEVELS[codec]
+        header = compression.read_header(stored_path)
+        if header and header[0] == codec and header[1] >= max_level:
+            return 0 # Уже сжат максимально
+        if header is None or header[0] == compression.CODEC_NONE:
+            with compression.open_stored(stored_path) as source:
+                sample = source.read(compression.SAMPLE_SIZE)
+            if compression.is_incompressible(sample, sample):
+                return 0
+
+        old_size = stored_path.stat().st_size
+        fd, temp_name = tempfile.mkstemp(dir=stored_path.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f, compression.open_stored(stored_path) as source:
+                writer = compression.EncodingWriter(f, codec, max_level)
+                for block in file_io.iter_blocks(source):
+                    writer.write(block)
+                writer.finish()
+            new_size = os.path.getsize(temp_name)
+            # Сохраняем время изменения: по нему упаковка определяет "холодные" файлы
+            stored_stat = stored_path.stat()
+            os.utime(temp_name, ns=(stored_stat.st_atime_ns, stored_stat.st_mtime_ns))
+            # Замена под блокировкой БД, чтобы не пересечься с удалением объекта
+            with self._db_connection_lock:
+                if new_size <= old_size and stored_path.exists():
+                    os.replace(temp_name, stored_path)
+                    self._add_stored_bytes(new_size - old_size)
+                    return old_size - new_size
+        finally:
+            if os.path.exists(temp_name):
+                os.remove(temp_name)
+        return 0
+
+    # --- Упаковка ---
+
+    def _iter_loose_files(self) -> Iterator[Tuple[int, str, Path, os.stat_result]]:
+        """Отдает (вид, хеш, путь, stat) всех отдельных файлов хранилища."""
+        for kind, root in ((self.KIND_OBJECT, self.objects_path), (self.KIND_CHUNK, self.chunks_path)):
+            if not root.is_dir():
+                continue
+            with os.scandir(root) as prefixes:
+                prefix_dirs = [entry for entry in prefixes if entry.is_dir()]
+            for prefix_dir in prefix_dirs:
+                with os.scandir(prefix_dir.path) as entries:
+                    for entry in entries:
+                        if entry.name.endswith(".tmp") or not entry.is_file():
+                            continue
+                        yield kind, prefix_dir.name + entry.name, Path(entry.path), entry.stat()
+
+    def _is_pack_candidate(self, stored_size: int, modified_time: float, now: float) -> bool:
+        age = now - modified_time
+        if stored_size <= self.PACK_SMALL_OBJECT_SIZE:
+            return age >= self.PACK_HOT_AGE
+        return stored_size <= self.PACK_MAX_ENTRY_SIZE and age >= self.PACK_COLD_AGE
+
+    def pack_loose_objects(self, should_stop_callback=None) -> int:
+        """
+        Переносит небольшие и холодные отдельные файлы (объекты, дельты, блоки) в новые пакеты.
+        Отдельный файл удаляется только после того, как индекс пакета зафиксирован в БД.
+        Возвращает количество упакованных файлов. Выбрасывает OSError и sqlite3.Error.
+        """
+        now = time.time()
+        candidates = [(kind, object_hash, stored_path)
+                      for kind, object_hash, stored_path, stored_stat in self._iter_loose_files()
+                      if self._is_pack_candidate(stored_stat.st_size, stored_stat.st_mtime, now)]
+
+        packed_count = 0
+        writer, entries = None, []
+        try:
+            for kind, object_hash, stored_path in candidates:
+                if should_stop_callback and should_stop_callback():
+                    break
+                if self._get_pack_location(kind, object_hash) is not None:
+                    # Файл уже упакован, но не был удален (например, был открыт для чтения)
+                    self._remove_loose_copies([stored_path])
+                    continue
+                try:
+                    with open(stored_path, "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    continue # Объект удален, пока шла упаковка
+                if writer is None:
+                    writer = packfile.PackWriter(self.packs_path)
+                offset, length = writer.add(kind, object_hash, data)
+                entries.append((kind, object_hash, stored_path, offset, length))
+                if writer.size >= self.PACK_MAX_SIZE:
+                    packed_count += self._commit_new_pack(writer, entries)
+                    writer, entries = None, []
+            if writer is not None:
+                packed_count += self._commit_new_pack(writer, entries)
+                writer = None
+        finally:
+            if writer is not None:
+                writer.abort()
+        return packed_count
+
+    def _commit_new_pack(self, writer: packfile.PackWriter, entries: List[Tuple[int, str, Path, int, int]]) -> int:
+        """Закрывает пакет, сохраняет его индекс и удаляет упакованные отдельные файлы."""
+        writer.close()
+        packed_paths = []
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            try:
+                cursor.execute("INSERT INTO packs (name, size) VALUES (?, ?)", (writer.name, writer.size))
+                pack_id = cursor.lastrowid
+                self._add_stored_bytes(writer.size)
+                for kind, object_hash, stored_path, offset, length in entries:
+                    if not stored_path.exists():
+                        continue # Объект удален, пока пакет записывался: его запись останется мусором
+                    cursor.execute(
+                        "INSERT OR IGNORE INTO packed_objects (kind, hash, pack_id, entry_offset, entry_length) VALUES (?, ?, ?, ?, ?)",
+                        (kind, object_hash, pack_id, offset, length)
+                    )
+                    packed_paths.append(stored_path)
+                self._db_connection.commit()
+            except sqlite3.Error:
+                self._db_connection.rollback()
+                os.remove(writer.path)
+                raise
+            self._remove_loose_copies(packed_paths)
+        return len(packed_paths)
+
+    def _remove_loose_copies(self, stored_paths: List[Path]):
+        with self._db_connection_lock:
+            for stored_path in stored_paths:
+                try:
+                    self._remove_file_and_empty_dir(stored_path)
+                except OSError:
+                    pass # Файл занят или уже удален - попробуем при следующей упаковке
+            self._db_connection.commit()
+
+    def compact_packs(self, should_stop_callback=None) -> int:
+        """
+        Удаляет пакеты без живых записей, переписывает пакеты с большой долей удаленных записей
+        и объединяет мелкие пакеты. Возвращает количество освобожденных байт.
+        Выбрасывает OSError и sqlite3.Error.
+        """
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("""
+                SELECT p.id, p.name, p.size, COUNT(o.hash),
+                       COALESCE(SUM(o.entry_length + LENGTH(o.hash) / 2 + ?), 0)
+                FROM packs p LEFT JOIN packed_objects o ON o.pack_id = p.id
+                GROUP BY p.id ORDER BY p.id""", (packfile.entry_header_size(""),))
+            packs = cursor.fetchall()
+
+        freed_bytes = 0
+        to_rewrite, small_packs = [], []
+        for pack_id, pack_name, pack_size, entry_count, live_bytes in packs:
+            if entry_count == 0:
+                freed_bytes += self._drop_pack(pack_id, pack_name, pack_size)
+            elif pack_size - len(packfile.PACK_MAGIC) - live_bytes >= pack_size * self.PACK_GARBAGE_RATIO:
+                to_rewrite.append((pack_id, pack_name, pack_size))
+            elif pack_size < self.PACK_SMALL_PACK_SIZE:
+                small_packs.append((pack_id, pack_name, pack_size))
+        if len(small_packs) > 1:
+            to_rewrite.extend(small_packs)
+        if to_rewrite:
+            freed_bytes += self._rewrite_packs(to_rewrite, should_stop_callback)
+        freed_bytes += self._remove_orphan_pack_files({pack[1] for pack in packs})
+        return freed_bytes
+
+    def _rewrite_packs(self, source_packs: List[Tuple[int, str, int]], should_stop_callback=None) -> int:
+        """Копирует живые записи пакетов в новые пакеты и удаляет старые. Возвращает освобожденные байты."""
+        freed_bytes = 0
+        writer, moves, done_packs = None, [], []
+        try:
+            for pack_id, pack_name, pack_size in source_packs:
+                if should_stop_callback and should_stop_callback():
+                    break
+                with self._db_connection_lock:
+                    cursor = self._db_connection.cursor()
+                    cursor.execute(
+                        "SELECT kind, hash, entry_offset, entry_length FROM packed_objects WHERE pack_id = ? ORDER BY entry_offset",
+                        (pack_id,)
+                    )
+                    entries = cursor.fetchall()
+                if writer is None:
+                    writer = packfile.PackWriter(self.packs_path)
+                with open(self.packs_path / pack_name, "rb") as pack_file:
+                    for kind, object_hash, offset, length in entries:
+                        new_offset, _ = writer.add(kind, object_hash, packfile.read_entry(pack_file, offset, length))
+                        moves.append((pack_id, offset, kind, object_hash, new_offset))
+                done_packs.append((pack_id, pack_name, pack_size))
+                if writer.size >= self.PACK_MAX_SIZE:
+                    freed_bytes += self._commit_rewritten_pack(writer, moves, done_packs)
+                    writer, moves, done_packs = None, [], []
+            if writer is not None:
+                freed_bytes += self._commit_rewritten_pack(writer, moves, done_packs)
+                writer = None
+        finally:
+            if writer is not None:
+                writer.abort()
+        return freed_bytes
+
+    def _commit_rewritten_pack(self, writer: packfile.PackWriter, moves: List[Tuple[int, int, int, str, int]],
+                               done_packs: List[Tuple[int, str, int]]) -> int:
+        """Переключает индекс на новый пакет и удаляет старые пакеты."""
+        writer.close()
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            try:
+                cursor.execute("INSERT INTO packs (name, size) VALUES (?, ?)", (writer.name, writer.size))
+                new_pack_id = cursor.lastrowid
+                self._add_stored_bytes(writer.size)
+                # Условие на старое расположение: запись, удаленная во время переписывания, не воскреснет
+                cursor.executemany("""
+                    UPDATE packed_objects SET pack_id = ?, entry_offset = ?
+                    WHERE pack_id = ? AND entry_offset = ? AND kind = ? AND hash = ?""",
+                    [(new_pack_id, new_offset, pack_id, offset, kind, object_hash)
+                     for pack_id, offset, kind, object_hash, new_offset in moves]
+                )
+                self._db_connection.commit()
+            except sqlite3.Error:
+                self._db_connection.rollback()
+                os.remove(writer.path)
+                raise
+            freed_bytes = sum(self._drop_pack(pack_id, pack_name, pack_size) for pack_id, pack_name, pack_size in done_packs)
+        return max(freed_bytes - writer.size, 0)
+
+    def _drop_pack(self, pack_id: int, pack_name: str, pack_size: int) -> int:
+        """Удаляет пакет без живых записей. Возвращает его размер или 0, если удалить не удалось."""
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT 1 FROM packed_objects WHERE pack_id = ? LIMIT 1", (pack_id,))
+            if cursor.fetchone() is not None:
+                return 0
+            try:
+                os.remove(self.packs_path / pack_name)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                return 0 # Пакет открыт для чтения - удалим при следующем уплотнении
+            cursor.execute("DELETE FROM packs WHERE id = ?", (pack_id,))
+            self._add_stored_bytes(-pack_size)
+            self._db_connection.commit()
+        return pack_size
+
+    def _remove_orphan_pack_files(self, known_pack_names) -> int:
+        """Удаляет пакеты, индекс которых не успел сохраниться (например, из-за сбоя)."""
+        freed_bytes = 0
+        if not self.packs_path.is_dir():
+            return 0
+        with os.scandir(self.packs_path) as entries:
+            orphans = [entry for entry in entries if packfile.is_pack_name(entry.name) and entry.name not in known_pack_names]
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            for entry in orphans:
+                cursor.execute("SELECT 1 FROM packs WHERE name = ?", (entry.name,))
+                if cursor.fetchone() is not None:
+                    continue
+                try:
+                    pack_size = entry.stat().st_size
+                    os.remove(entry.path)
+                    freed_bytes += pack_size
+                except OSError:
+                    pass
+        return freed_bytes
+
+    # --- Переадресация при смене алгоритма хеширования ---
+
+    def compute_rekey(self, object_hash: str, algorithm: str) -> Optional[Tuple[str, Dict[str, str], Optional[str]]]:
+        """
+        Читает объект и считает его хеш алгоритмом algorithm (без блокировки БД на время чтения).
+        Для разбитого объекта также считает новые ключи блоков, адресованных другим алгоритмом,
+        и быстрый хеш. Возвращает (новый_хеш, {старый_ключ_блока: новый}, быстрый_хеш)
+        или None, если объекта нет. Выбрасывает OSError.
+        """
+        hasher = hashing.new_hasher(algorithm)
+        chunk_rekeys = {}
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute(
+                "SELECT chunk_hash, hash_algorithm FROM object_chunks WHERE object_hash = ? ORDER BY seq", (object_hash,)
+            )
+            manifest = cursor.fetchall()
+        if not manifest:
+            source = self.open(object_hash)
+            if source is None:
+                return None
+            with source:
+                for block in file_io.iter_blocks(source):
+                    hasher.update(block)
+            return hasher.hexdigest(), chunk_rekeys, None
+
+        quick_hasher = hashing.new_quick_hasher()
+        for chunk_hash, chunk_algorithm in manifest:
+            with self._open_stored(self.KIND_CHUNK, chunk_hash) as f:
+                chunk = f.read()
+            hasher.update(chunk)
+            if quick_hasher is not None:
+                quick_hasher.update(chunk)
+            if chunk_algorithm != algorithm:
+                chunk_rekeys[chunk_hash] = hashing.hash_bytes(algorithm, chunk)
+        return hasher.hexdigest(), chunk_rekeys, quick_hasher.hexdigest() if quick_hasher is not None else None
+
+    def rekey_object(self, old_hash: str, new_hash: str, algorithm: str, chunk_rekeys: Dict[str, str],
+                     quick_hash: Optional[str], repoint_references: Callable[[str, str], None]) -> Optional[bool]:
+        """
+        Переадресует объект (результат compute_rekey) под хеш нового алгоритма в одной транзакции
+        и фиксирует ее. Файлы не копируются: отдельные файлы переименовываются, а у упакованных
+        меняется только ключ в индексе. repoint_references(старый, новый) переводит на новый хеш
+        ссылки вне хранилища (версии) в той же транзакции.
+        Если объект с новым хешем уже есть, ссылки объединяются с ним, а старый объект остается
+        без ссылок: вызывающая сторона должна удалить его. Блоки, совпавшие с уже сохраненными,
+        удаляются после фиксации.
+        Возвращает True при объединении, False при переадресации, None, если объект уже переадресован
+        или удален. Выбрасывает OSError и sqlite3.Error.
+        """
+        moves = []
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            cursor.execute("SELECT hash_algorithm FROM objects WHERE hash = ?", (old_hash,))
+            row = cursor.fetchone()
+            if not row or row[0] == algorithm:
+                return None
+            cursor.execute("SELECT 1 FROM objects WHERE hash = ?", (new_hash,))
+            merged = cursor.fetchone() is not None
+            if merged and not self.contains(new_hash):
+                return None # Запись есть, а содержимого нет: объединять не с чем
+            try:
+                duplicate_chunks = self._rekey_chunks(chunk_rekeys, algorithm, moves)
+                if merged:
+                    if not self._get_delta_info(new_hash) and not self.is_chunked(new_hash):
+                        # Новая копия хранится целиком, поэтому дельты можно строить на ней без риска циклов;
+                        # иначе дельты остаются на старом объекте, и он удаляется вместе с ними
+                        cursor.execute("UPDATE object_deltas SET base_hash = ? WHERE base_hash = ?", (new_hash, old_hash))
+                    cursor.execute("""
+                        UPDATE objects SET refcount = refcount + (SELECT refcount FROM objects WHERE hash = ?)
+                        WHERE hash = ?""", (old_hash, new_hash))
+                    cursor.execute("UPDATE objects SET refcount = 0 WHERE hash = ?", (old_hash,))
+                else:
+                    self._move_stored(self.KIND_OBJECT, old_hash, new_hash, moves)
+                    cursor.execute("UPDATE object_chunks SET object_hash = ? WHERE object_hash = ?", (new_hash, old_hash))
+                    cursor.execute("UPDATE object_deltas SET object_hash = ? WHERE object_hash = ?", (new_hash, old_hash))
+                    cursor.execute("UPDATE object_deltas SET base_hash = ? WHERE base_hash = ?", (new_hash, old_hash))
+                    cursor.execute(
+                        "UPDATE objects SET hash = ?, hash_algorithm = ?, quick_hash = COALESCE(?, quick_hash) WHERE hash = ?",
+                        (new_hash, algorithm, quick_hash, old_hash)
+                    )
+                repoint_references(old_hash, new_hash)
+                self._db_connection.commit()
+            except (OSError, sqlite3.Error):
+                self._db_connection.rollback()
+                for old_path, new_path in reversed(moves):
+                    os.replace(new_path, old_path)
+                raise
+
+            for chunk_hash in duplicate_chunks:
+                try:
+                    self._remove_stored(self.KIND_CHUNK, chunk_hash)
+                except OSError:
+                    pass # Останется лишний файл; счетчик объема поправит сверка
+            self._db_connection.commit()
+        return merged
+
+    def _rekey_chunks(self, chunk_rekeys: Dict[str, str], algorithm: str, moves: List[Tuple[Path, Path]]) -> List[str]:
+        """
+        Переадресует блоки во всех манифестах. Возвращает старые ключи блоков,
+        содержимое которых уже хранится под новым ключом (их файлы удаляются после фиксации).
+        """
+        duplicate_chunks = []
+        cursor = self._db_connection.cursor()
+        for old_chunk, new_chunk in chunk_rekeys.items():
+            cursor.execute(
+                "SELECT 1 FROM object_chunks WHERE chunk_hash = ? AND hash_algorithm != ? LIMIT 1", (old_chunk, algorithm)
+            )
+            if cursor.fetchone() is None:
+                continue # Блок уже переадресован вместе с другим объектом
+            if self._has_stored(self.KIND_CHUNK, new_chunk):
+                duplicate_chunks.append(old_chunk)
+            else:
+                self._move_stored(self.KIND_CHUNK, old_chunk, new_chunk, moves)
+            cursor.execute(
+                "UPDATE object_chunks SET chunk_hash = ?, hash_algorithm = ? WHERE chunk_hash = ?",
+                (new_chunk, algorithm, old_chunk)
+            )
+        return duplicate_chunks
+
+    def _move_stored(self, kind: int, old_hash: str, new_hash: str, moves: List[Tuple[Path, Path]]):
+        """
+        Переносит файл хранилища под новый ключ: отдельный файл переименовывается (перенос
+        записывается в moves для отката), у упакованного меняется ключ индекса. Заголовок записи
+        в самом пакете сохраняет старый хеш до ближайшего переписывания пакета.
+        """
+        old_path = self._kind_path(kind, old_hash)
+        if old_path.exists():
+            new_path = self._kind_path(kind, new_hash)
+            new_path.parent.mkdir(exist_ok=True)
+            os.replace(old_path, new_path)
+            moves.append((old_path, new_path))
+        self._db_connection.execute(
+            "UPDATE packed_objects SET hash = ? WHERE kind = ? AND hash = ?", (new_hash, kind, old_hash)
+        )
+
+    # --- Удаление ---
+
+    def remove(self, object_hash: str) -> Optional[str]:
+        """
+        Удаляет объект. Блоки разбитого объекта удаляются, только если
+        на них не ссылается ни один другой манифест.
+        Для дельта-объекта возвращает хеш его базовой версии: вызывающая сторона
+        должна проверить, не осталась ли она без ссылок.
+        Выбрасывает OSError при ошибке удаления файла.
+        """
+        base_hash = self._remove_object_files(object_hash)
+        with self._db_connection_lock:
+            self._db_connection.execute("DELETE FROM objects WHERE hash = ? AND refcount <= 0", (object_hash,))
+        return base_hash
+
+    def _remove_object_files(self, object_hash: str) -> Optional[str]:
+        if self._has_stored(self.KIND_OBJECT, object_hash):
+            delta_info = self._get_delta_info(object_hash)
+            self._remove_stored(self.KIND_OBJECT, object_hash)
+            if delta_info:
+                with self._db_connection_lock:
+                    self._db_connection.execute("DELETE FROM object_deltas WHERE object_hash = ?", (object_hash,))
+                return delta_info[0]
+            return None
+
+        with self._db_connection_lock:
+            cursor = self._db_connection.cursor()
+            chunk_hashes = {chunk_hash for chunk_hash, _ in self._get_manifest(object_hash)}
+            cursor.execute("DELETE FROM object_chunks WHERE object_hash = ?", (object_hash,))
+            for chunk_hash in chunk_hashes:
+                cursor.execute("SELECT 1 FROM object_chunks WHERE chunk_hash = ? LIMIT 1", (chunk_hash,))
+                if cursor.fetchone() is None:
+                    self._remove_stored(self.KIND_CHUNK, chunk_hash)
+        return None
+
+    def _remove_stored(self, kind: int, object_hash: str):
+        """
+        Удаляет отдельный файл и запись индекса пакетов. Место записи в пакете
+        освобождается позже, при уплотнении пакета.
+        """
+        with self._db_connection_lock:
+            stored_path = self._kind_path(kind, object_hash)
+            if stored_path.exists():
+                self._remove_file_and_empty_dir(stored_path)
+            self._db_connection.execute("DELETE FROM packed_objects WHERE kind = ? AND hash = ?", (kind, object_hash))
+
+    def _remove_file_and_empty_dir(self, file_path: Path):
+        stored_size = file_path.stat().st_size
+        os.remove(file_path)
+        self._add_stored_bytes(-stored_size)
+        # Проверяем, пуста ли папка хеша, и удаляем ее, если да
+        subdir = file_path.parent
+        if not any(subdir.iterdir()):
+            os.rmdir(subdir)
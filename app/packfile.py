@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+# Пакетные файлы хранилища: много небольших объектов в одном файле
+import io
+import os
+import struct
+import tempfile
+import uuid
+from pathlib import Path
+from typing import BinaryIO, Tuple
+
+# Формат пакета: PACK_MAGIC, затем записи подряд. Каждая запись - заголовок
+# (вид, длина хеша, хеш, длина данных) и данные объекта в формате хранилища
+# (с заголовком сжатия, см. app/compression.py). Пакет только дописывается и после
+# закрытия не меняется; смещения и длины записей хранятся в отсортированном индексе
+# (таблица packed_objects), а заголовки записей позволяют проверить пакет без индекса.
+PACK_MAGIC = b"UPAK\x01"
+PACK_SUFFIX = ".pack"
+
+_ENTRY_PREFIX = struct.Struct(">BB")
+_ENTRY_LENGTH = struct.Struct(">Q")
+
+
+class PackError(OSError):
+    """Пакет поврежден или запись не совпадает с индексом."""
+
+
+def entry_header_size(object_hash: str) -> int:
+    return _ENTRY_PREFIX.size + len(object_hash) // 2 + _ENTRY_LENGTH.size
+
+
+class PackEntryReader(io.RawIOBase):
+    """
+    Поток только для чтения одной записи пакета.
+    Поддерживает seek в пределах записи, поэтому его можно передать в compression.open_decoded.
+    """
+
+    def __init__(self, pack_file: BinaryIO, offset: int, length: int):
+        super().__init__()
+        self._file = pack_file
+        self._offset = offset
+        self._length = length
+        self._position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, position: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            position += self._position
+        elif whence == io.SEEK_END:
+            position += self._length
+        self._position = min(max(position, 0), self._length)
+        return self._position
+
+    def readinto(self, buffer) -> int:
+        size = min(len(buffer), self._length - self._position)
+        if size <= 0:
+            return 0
+        self._file.seek(self._offset + self._position)
+        read = self._file.readinto(memoryview(buffer)[:size])
+        if not read:
+            raise PackError("Неожиданный конец пакета")
+        self._position += read
+        return read
+
+    def close(self):
+        self._file.close()
+        super().close()
+
+
+class PackWriter:
+    """
+    Записывает новый пакет во временный файл; close() делает его видимым под итоговым именем.
+    Индекс записей (смещения и длины) вызывающая сторона сохраняет сама после close().
+    """
+
+    def __init__(self, packs_path: Path):
+        self.name = "pack-{0}{1}".format(uuid.uuid4().hex, PACK_SUFFIX)
+        self.path = packs_path / self.name
+        packs_path.mkdir(exist_ok=True)
+        fd, self._temp_name = tempfile.mkstemp(dir=packs_path, suffix=".tmp")
+        self._file = os.fdopen(fd, "wb")
+        self._file.write(PACK_MAGIC)
+        self.size = len(PACK_MAGIC)
+        self.entry_count = 0
+
+    def add(self, kind: int, object_hash: str, data: bytes) -> Tuple[int, int]:
+        """Добавляет запись и возвращает (смещение_данных, длина_данных)."""
+        raw_hash = bytes.fromhex(object_hash)
+        self._file.write(_ENTRY_PREFIX.pack(kind, len(raw_hash)))
+        self._file.write(raw_hash)
+        self._file.write(_ENTRY_LENGTH.pack(len(data)))
+        offset = self.size + entry_header_size(object_hash)
+        self._file.write(data)
+        self.size = offset + len(data)
+        self.entry_count += 1
+        return offset, len(data)
+
+    def close(self):
+        """Сбрасывает пакет на диск и переименовывает его. Выбрасывает OSError."""
+        try:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            os.replace(self._temp_name, self.path)
+        except OSError:
+            self.abort()
+            raise
+
+    def abort(self):
+        """Отменяет запись пакета и удаляет временный файл."""
+        if not self._file.closed:
+            self._file.close()
+        try:
+            os.remove(self._temp_name)
+        except OSError:
+            pass
+
+
+def read_entry(pack_file: BinaryIO, offset: int, length: int) -> bytes:
+    """Читает данные записи целиком (для переупаковки). Выбрасывает OSError."""
+    pack_file.seek(offset)
+    data = pack_file.read(length)
+    if len(data) != length:
+        raise PackError("Запись выходит за границы пакета")
+    return data
+
+
+def open_entry(pack_path: Path, offset: int, length: int) -> BinaryIO:
+    """Открывает запись пакета как буферизованный поток с поддержкой seek."""
+    return io.BufferedReader(PackEntryReader(open(pack_path, "rb"), offset, length))
+
+
+def is_pack_name(file_name: str) -> bool:
+    return file_name.startswith("pack-") and file_name.endswith(PACK_SUFFIX)
+
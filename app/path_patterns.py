@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Шаблоны исключения и включения путей внутри отслеживаемой папки
+import os
+import re
+from typing import Dict, Iterable, List, Optional
+
+REGEX_PREFIX = "re:" # Шаблон с этим префиксом - регулярное выражение, остальные - глобы
+
+# Пути сравниваются с учетом регистра так же, как их сравнивает файловая система ОС
+_FLAGS = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+
+
+def glob_to_regex(glob: str) -> str:
+    """
+    Переводит глоб в регулярное выражение для пути в формате POSIX:
+    "*" и "?" не пересекают "/", "**" - пересекает, "**/" - любое число папок (в том числе ни одной),
+    "[...]" и "[!...]" - наборы символов, "\\" экранирует следующий символ.
+    """
+    parts, i, n = [], 0, len(glob)
+    while i < n:
+        c = glob[i]
+        i += 1
+        if c == "*":
+            if i < n and glob[i] == "*":
+                i += 1
+                if i < n and glob[i] == "/":
+                    i += 1
+                    parts.append("(?:.*/)?")
+                else:
+                    parts.append(".*")
+            else:
+                parts.append("[^/]*")
+        elif c == "?":
+            parts.append("[^/]")
+        elif c == "\\" and i < n:
+            parts.append(re.escape(glob[i]))
+            i += 1
+        elif c == "[":
+            j = i
+            if j < n and glob[j] in "!^":
+                j += 1
+            if j < n and glob[j] == "]":
+                j += 1
+            j = glob.find("]", j)
+            if j == -1:
+                parts.append(re.escape(c))
+                continue
+            content = glob[i:j].replace("\\", "\\\\")
+            if content[0] in "!^":
+                content = "^" + content[1:]
+            parts.append("[" + content + "]")
+            i = j + 1
+        else:
+            parts.append(re.escape(c))
+    return "".join(parts)
+
+
+def pattern_to_regex(pattern: str) -> str:
+    """
+    Регулярное выражение для одного шаблона (см. PathPatterns). Выражение совпадает и со всем
+    содержимым подходящей папки, поэтому проверка пути не требует проверки его родителей.
+    """
+    if pattern.startswith(REGEX_PREFIX):
+        return "(?:{0})(?:/.*)?".format(pattern[len(REGEX_PREFIX):])
+    # Шаблон, оканчивающийся на "/", относится только к папкам: совпадает лишь ее содержимое
+    # (и путь папки, переданный с "/" на конце)
+    dir_only = pattern.endswith("/")
+    body = pattern.strip("/")
+    regex = glob_to_regex(body)
+    if "/" not in body:
+        regex = "(?:.*/)?" + regex # Имя на любом уровне
+    return regex + ("/.*" if dir_only else "(?:/.*)?")
+
+
+def pattern_error(pattern: str) -> Optional[str]:
+    """Текст ошибки, если шаблон некорректен, иначе None."""
+    if not pattern.strip("/"):
+        return "empty pattern"
+    try:
+        re.compile(pattern_to_regex(pattern))
+    except re.error as e:
+        return str(e)
+    return None
+
+
+def _compile(patterns: Iterable[str]):
+    # Все шаблоны объединяются в одно выражение: путь проверяется одним проходом, а не по шаблону за раз.
+    # Некорректные шаблоны пропускаются (настройки проверяют их при вводе).
+    regexes = [pattern_to_regex(p) for p in patterns if pattern_error(p) is None]
+    if not regexes:
+        return None
+    return re.compile("|".join("(?:{0})".format(r) for r in regexes), _FLAGS)
+
+
+class PathPatterns:
+    """
+    Шаблоны исключения и включения папки-элемента, скомпилированные в одно регулярное
+    выражение каждый. Шаблоны сравниваются с путем относительно папки в формате POSIX
+    ("src/app/main.py"):
+     - глоб без "/" ("node_modules", "*.tmp", "~$*.docx") - с именем на любом уровне;
+     - глоб с "/" (".git/objects", "build/**/*.o") - с путем от корня папки;
+     - "re:выражение" - регулярное выражение для пути от корня папки.
+    Совпадение с папкой распространяется на все ее содержимое, поэтому исключенное поддерево
+    отсекается целиком. Если заданы шаблоны включения, отслеживаются только подходящие под них файлы.
+    Путь папки передается с "/" на конце.
+    """
+    def __init__(self, exclude: Iterable[str] = (), include: Iterable[str] = ()):
+        self._exclude = _compile(exclude)
+        self._include = _compile(include)
+
+    @classmethod
+    def from_item(cls, item: Dict) -> Optional["PathPatterns"]:
+        """Шаблоны папки-элемента из watched_items или None, если шаблонов нет."""
+        exclude, include = item.get("exclude_patterns", []), item.get("include_patterns", [])
+        if not exclude and not include:
+            return None
+        return cls(exclude, include)
+
+    def is_excluded(self, rel_path: str) -> bool:
+        """Исключен ли путь (или одна из его папок) шаблонами исключения."""
+        return self._exclude is not None and self._exclude.fullmatch(rel_path) is not None
+
+    def is_file_watched(self, rel_path: str) -> bool:
+        """Отслеживается ли файл: не исключен и, если заданы шаблоны включения, подходит под один из них."""
+        if self.is_excluded(rel_path):
+            return False
+        return self._include is None or self._include.fullmatch(rel_path) is not None
+
+
+def to_posix(rel_path: str) -> str:
+    return rel_path if os.sep == "/" else rel_path.replace(os.sep, "/")
+
+
+def item_pattern_keys(item: Dict) -> List[str]:
+    """Шаблоны элемента одной строкой на шаблон: "-" - исключение, "+" - включение (для ключа правил)."""
+    return ["-" + p for p in item.get("exclude_patterns", [])] + ["+" + p for p in item.get("include_patterns", [])]
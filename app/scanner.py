@@ -0,0 +1,192 @@
+# -*- coding: utf-8 -*-
+# Обход отслеживаемых папок при сканировании
+import os
+import stat
+from collections import defaultdict
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from app.ignore_files import IGNORE_FILE_NAMES, IgnoreMatcher, directory_signature
+from app.path_patterns import PathPatterns, to_posix
+
+
+def normalize_path(path: str) -> str:
+    """Ключ для сравнения путей: абсолютный путь в регистре, принятом файловой системой ОС."""
+    return os.path.normcase(os.path.abspath(path))
+
+
+def build_exclusion_keys(root: str, exclusions: Iterable[str]) -> Set[str]:
+    """
+    Нормализует исключения один раз перед обходом. Для каждого исключения учитывается и путь
+    как есть, и путь после разрешения ссылок, и его положение относительно корня обхода,
+    если корень сам задан через символическую ссылку. Поэтому при обходе папки
+    сравниваются строками, без разрешения каждого пути.
+    """
+    root_abs = os.path.abspath(root)
+    root_real = os.path.realpath(root)
+    keys = set()
+    for exclusion in exclusions:
+        keys.add(normalize_path(exclusion))
+        exclusion_real = os.path.realpath(exclusion)
+        keys.add(normalize_path(exclusion_real))
+        if root_real != root_abs and _is_within(exclusion_real, root_real):
+            keys.add(normalize_path(os.path.join(root_abs, os.path.relpath(exclusion_real, root_real))))
+    return keys
+
+
+def _is_within(path: str, root: str) -> bool:
+    path, root = os.path.normcase(path), os.path.normcase(root)
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def relative_parts(root: str, path: str) -> Tuple[str, ...]:
+    """Компоненты пути относительно корня обхода; по ним сравнивается порядок папок в walk_files."""
+    relative = os.path.relpath(path, root)
+    return () if relative == os.curdir else tuple(relative.split(os.sep))
+
+
+class DirIndex:
+    """
+    Сохраненный индекс папок элемента: mtime_ns каждой папки на момент прошлого сканирования
+    и уже известные (отслеживаемые) файлы. mtime папки меняется только при добавлении, удалении
+    или переименовании записей в ней, поэтому неизмененная папка не читается: ее подпапки берутся
+    из индекса, а stat известных файлов запрашивается по отдельности (правка содержимого файла
+    mtime папки не меняет). В visited собираются mtime_ns папок, пройденных при обходе
+    (None - папка изменена слишком недавно, чтобы ее mtime можно было доверять).
+    """
+    def __init__(self, mtimes: Dict[str, int], known_files: Iterable[str], trusted_before_ns: int):
+        self.mtimes = mtimes
+        self.trusted_before_ns = trusted_before_ns
+        self.visited: Dict[str, Optional[int]] = {}
+        self._subdirs: Dict[str, List[str]] = defaultdict(list)
+        self._files: Dict[str, List[str]] = defaultdict(list)
+        for dir_path in mtimes:
+            self._subdirs[os.path.dirname(dir_path)].append(dir_path)
+        for file_path in known_files:
+            self._files[os.path.dirname(file_path)].append(file_path)
+
+    def record(self, dir_path: str, mtime_ns: int) -> bool:
+        """Запоминает mtime папки и сообщает, не изменилась ли она с прошлого сканирования."""
+        self.visited[dir_path] = mtime_ns if mtime_ns < self.trusted_before_ns else None
+        return self.mtimes.get(dir_path) == mtime_ns
+
+    def subdirs(self, dir_path: str) -> List[str]:
+        return self._subdirs.get(dir_path, [])
+
+    def known_files(self, dir_path: str) -> List[str]:
+        return self._files.get(dir_path, [])
+
+
+def walk_files(root: str, exclusion_keys: Set[str],
+               should_stop: Optional[Callable[[], bool]] = None,
+               resume_after: Optional[str] = None,
+               dir_index: Optional[DirIndex] = None,
+               patterns: Optional[PathPatterns] = None,
+               ignore: Optional[IgnoreMatcher] = None) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Обходит папку через os.scandir и отдает (путь, stat) обычных файлов. Данные stat берутся
+    из DirEntry (в Windows - без отдельного системного вызова) и передаются дальше, чтобы файл
+    не приходилось запрашивать повторно. Символические ссылки на папки не обходятся (так не
+    возникает циклов), специальные файлы (каналы, сокеты, устройства) пропускаются,
+    а папки, уже встреченные под другим путем (например, через точку монтирования), обходятся один раз.
+    Недоступные папки и файлы молча пропускаются.
+
+    Порядок обхода детерминирован: файлы папки отдаются вместе, до ее подпапок, а подпапки
+    обходятся по имени. Поэтому папки идут в порядке сравнения их relative_parts, и обход,
+    прерванный после папки resume_after, продолжается с нее: папки не позже нее пропускаются
+    (поддеревья, целиком лежащие раньше, даже не читаются).
+
+    С dir_index неизмененные с прошлого сканирования папки не читаются (см. DirIndex):
+    из них отдаются только известные файлы, а новых файлов в них быть не может.
+
+    С patterns папки, исключенные шаблонами, не читаются, а файлы проверяются по шаблонам
+    исключения и включения до того, как попадут дальше. С ignore так же отсекаются пути,
+    игнорируемые файлами .gitignore/.ignore; их правила обновляются по stat игнор-файлов,
+    полученному при чтении папки.
+    """
+    root_prefix_len = len(os.path.join(root, ""))
+    resume_key = relative_parts(root, resume_after) if resume_after else None
+    visited_dirs = set()
+    stack = [root]
+    while stack:
+        if should_stop and should_stop():
+            return
+        dir_path = stack.pop()
+        dir_key = relative_parts(root, dir_path) if resume_key is not None else None
+        rel_dir = relative_parts(root, dir_path) if ignore is not None else None
+        if dir_index is not None:
+            try:
+                is_unchanged = dir_index.record(dir_path, os.stat(dir_path).st_mtime_ns)
+            except OSError:
+                continue # Папка удалена или недоступна
+            if is_unchanged:
+                known_files, subdir_paths = dir_index.known_files(dir_path), dir_index.subdirs(dir_path)
+                if ignore is not None:
+                    known_files = [p for p in known_files if not ignore.is_entry_ignored(rel_dir + (os.path.basename(p),), False)]
+                    subdir_paths = [p for p in subdir_paths if not ignore.is_entry_ignored(rel_dir + (os.path.basename(p),), True)]
+                if resume_key is None or dir_key > resume_key:
+                    yield from _stat_known_files(known_files)
+                subdir_paths = sorted(subdir_paths, key=os.path.basename)
+                for subdir_path in reversed(subdir_paths):
+                    if not (resume_key is not None and _is_before(dir_key + (os.path.basename(subdir_path),), resume_key)):
+                        stack.append(subdir_path)
+                continue
+
+        files, subdirs, ignore_files = [], [], []
+        try:
+            # Папка читается целиком до передачи файлов дальше, чтобы не держать ее открытой
+            with os.scandir(dir_path) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if normalize_path(entry.path) not in exclusion_keys and \
+                                    not (patterns is not None and patterns.is_excluded(to_posix(entry.path[root_prefix_len:]) + "/")) and \
+                                    not (resume_key is not None and _is_before(dir_key + (entry.name,), resume_key)):
+                                subdirs.append(entry)
+                            continue
+                        if not entry.is_file():
+                            continue # Ссылка на папку, битая ссылка или специальный файл
+                        if ignore is not None and entry.name in IGNORE_FILE_NAMES:
+                            ignore_files.append((entry.name, entry.stat()))
+                        if patterns is not None and not patterns.is_file_watched(to_posix(entry.path[root_prefix_len:])):
+                            continue
+                        entry_stat = entry.stat()
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(entry_stat.st_mode):
+                        files.append((entry.path, entry_stat))
+        except OSError:
+            continue # Папка удалена или недоступна
+        if ignore is not None:
+            ignore.refresh(rel_dir, directory_signature(ignore_files))
+            files = [f for f in files if not ignore.is_entry_ignored(rel_dir + (os.path.basename(f[0]),), False)]
+            subdirs = [e for e in subdirs if not ignore.is_entry_ignored(rel_dir + (e.name,), True)]
+        if resume_key is None or dir_key > resume_key:
+            yield from files
+        subdirs.sort(key=lambda e: e.name)
+        for entry in reversed(subdirs):
+            try:
+                dir_stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            # В Windows DirEntry не заполняет st_ino: такие папки не отслеживаются
+            if dir_stat.st_ino:
+                dir_id = (dir_stat.st_dev, dir_stat.st_ino)
+                if dir_id in visited_dirs:
+                    continue
+                visited_dirs.add(dir_id)
+            stack.append(entry.path)
+
+
+def _stat_known_files(file_paths: List[str]) -> Iterator[Tuple[str, os.stat_result]]:
+    for file_path in file_paths:
+        try:
+            file_stat = os.stat(file_path)
+        except OSError:
+            continue # Файл удален
+        if stat.S_ISREG(file_stat.st_mode):
+            yield file_path, file_stat
+
+
+def _is_before(dir_key: Tuple[str, ...], resume_key: Tuple[str, ...]) -> bool:
+    """Папка и все ее поддерево обойдены раньше папки resume_key (она не является ее предком)."""
+    return dir_key < resume_key and resume_key[:len(dir_key)] != dir_key
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+# Версионированные миграции схемы базы данных хранилища
+import sqlite3
+from typing import Callable, List, NamedTuple, Optional
+
+# Функция прогресса: (описание_миграции, доля_выполнения_0_1)
+ProgressCallback = Callable[[str, float], None]
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    # Выполняет миграцию курсором; второй аргумент - функция report(доля_0_1) для долгих миграций
+    apply: Callable[[sqlite3.Cursor, Callable[[float], None]], None]
+
+
+def _add_versions_covering_indexes(cursor: sqlite3.Cursor, report: Callable[[float], None]):
+    # Поиск последней версии файла (add_file_version) читает только индекс
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_versions_file_time ON versions (file_id, timestamp DESC, sha256_hash)")
+    report(0.5)
+    # Поиск версий по хешу и выбор "холодных" объектов по времени последней версии
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_versions_hash_time ON versions (sha256_hash, timestamp)")
+    # Старый индекс по file_id полностью покрывается новым
+    cursor.execute("DROP INDEX IF EXISTS idx_versions_file_id")
+
+
+def _add_hash_algorithms(cursor: sqlite3.Cursor, report: Callable[[float], None]):
+    # Свойства хранилища (например, алгоритм хеширования новых объектов)
+    cursor.execute("CREATE TABLE IF NOT EXISTS store_properties (name TEXT PRIMARY KEY, value TEXT NOT NULL)")
+    # Каким алгоритмом адресован объект и его быстрый хеш (xxh3) для предварительной проверки
+    cursor.execute("ALTER TABLE objects ADD COLUMN hash_algorithm TEXT NOT NULL DEFAULT 'sha256'")
+    cursor.execute("ALTER TABLE objects ADD COLUMN quick_hash TEXT")
+    # Каким алгоритмом адресован блок в манифесте
+    cursor.execute("ALTER TABLE object_chunks ADD COLUMN hash_algorithm TEXT NOT NULL DEFAULT 'sha256'")
+
+
+def _add_file_fingerprints(cursor: sqlite3.Cursor, report: Callable[[float], None]):
+    # Отпечаток файла (размер, mtime, inode, ctime) на момент сохранения последней версии:
+    # совпадающий отпечаток означает, что содержимое можно не читать
+    for column in ("fp_size", "fp_mtime_ns", "fp_inode", "fp_ctime_ns"):
+        cursor.execute("ALTER TABLE tracked_files ADD COLUMN {0} INTEGER".format(column))
+
+
+def _add_scan_checkpoints(cursor: sqlite3.Cursor, report: Callable[[float], None]):
+    # Точка продолжения сканирования отслеживаемой папки: последняя полностью сохраненная папка
+    # в порядке обхода (NULL - сканирование не прервано), правила исключений, при которых она получена,
+    # и число завершенных сканирований (поколение)
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS scan_checkpoints (
+            item_path TEXT PRIMARY KEY,
+            rules_key TEXT NOT NULL,
+            generation INTEGER NOT NULL DEFAULT 0,
+            last_directory TEXT
+        )""")
+
+
+def _add_lazy_baselines(cursor: sqlite3.Cursor, report: Callable[[float], None]):
+    # Файл без версий - индексная базовая версия: известны отпечаток и, возможно, хеш содержимого,
+    # а само содержимое сохраняется при первом изменении или фоновым захватом (capture_pending = 1)
+    cursor.execute("ALTER TABLE tracked_files ADD COLUMN baseline_hash TEXT")
+    cursor.execute("ALTER TABLE tracked_files ADD COLUMN capture_pending INTEGER NOT NULL DEFAULT 0")
+
+
+def _add_dir_index(cursor: sqlite3.Cursor, report: Callable[[float], None]):
+    # mtime папок отслеживаемых элементов на момент последнего завершенного сканирования:
+    # неизмененные папки при следующем сканировании не читаются (см. scanner.DirIndex)
+    cursor.execute("CREATE TABLE IF NOT EXISTS dir_index (path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL)")
+
+
+# Упорядоченный список миграций. Номер версии хранится в PRAGMA user_version;
+# новые миграции добавляются только в конец списка.
+MIGRATIONS: List[Migration] = [
+    Migration(1, "Индексы для поиска версий", _add_versions_covering_indexes),
+    Migration(2, "Алгоритмы хеширования объектов", _add_hash_algorithms),
+    Migration(3, "Отпечатки отслеживаемых файлов", _add_file_fingerprints),
+    Migration(4, "Точки продолжения сканирования", _add_scan_checkpoints),
+    Migration(5, "Индексные базовые версии файлов", _add_lazy_baselines),
+    Migration(6, "Индекс папок для быстрого сканирования", _add_dir_index),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version if MIGRATIONS else 0
+
+
+def get_schema_version(connection: sqlite3.Connection) -> int:
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(connection: sqlite3.Connection, progress_callback: Optional[ProgressCallback] = None,
+            migrations: Optional[List[Migration]] = None) -> List[int]:
+    """
+    Применяет по порядку все миграции новее текущей версии схемы.
+    Каждая миграция выполняется в своей транзакции вместе с повышением user_version,
+    поэтому прерванная миграция откатывается целиком и будет повторена при следующем запуске.
+    Возвращает номера примененных миграций. Выбрасывает sqlite3.Error.
+    """
+    if migrations is None:
+        migrations = MIGRATIONS
+    current_version = get_schema_version(connection)
+    pending = [migration for migration in migrations if migration.version > current_version]
+    if not pending:
+        return []
+    if connection.in_transaction:
+        connection.commit()
+
+    applied = []
+    for migration in pending:
+        def report(fraction: float, description: str = migration.description):
+            if progress_callback:
+                progress_callback(description, min(max(fraction, 0.0), 1.0))
+
+        report(0.0)
+        cursor = connection.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            migration.apply(cursor, report)
+            # PRAGMA не поддерживает параметры; номер версии - целое число из списка миграций
+            cursor.execute("PRAGMA user_version = {0:d}".format(migration.version))
+            connection.commit()
+        except BaseException:
+            connection.rollback()
+            raise
+        report(1.0)
+        applied.append(migration.version)
+    return applied
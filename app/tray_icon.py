@@ -42,12 +42,15 @@ class TrayIcon(QSystemTrayIcon):
         self._last_formatted_undoit_storage_size = self.tr("Н/Д") # Размер хранилища Undoit
         self._last_formatted_free_disk_space = self.tr("Н/Д") # Свободное место на диске
         self._last_tooltip_percentage = 0.0 # Процент для тултипа (0.0-100.0)
+        self._scan_status_text = "" # Последний снимок хода сканирования для тултипа
 
         # 1. Инициализируем сервисы
         self.aggregator = NotificationAggregator(self)
         self.icon_generator = IconGenerator()
         self.history_manager = HistoryManager(storage_path)
-        self.watcher = FileWatcher(self._current_watched_items)
+        self.history_manager.set_compression_codec(self.config_manager.get("compression_codec", "auto"))
+        self.history_manager.set_use_mmap(self.config_manager.get("use_mmap", False))
+        self.watcher = FileWatcher(self._current_watched_items, self.config_manager.get_watch_rules())
         self.startup_manager = StartupManager(app_name, app_executable_path)
 
         # --- Таймер для обработки одиночного клика ---
@@ -70,7 +73,7 @@ class TrayIcon(QSystemTrayIcon):
         # 4. Соединяем компоненты
         self.aggregator.aggregated_notification_ready.connect(self._show_native_notification)
 
-        self.watcher.file_modified.connect(self.history_manager.add_file_version)
+        self.watcher.file_modified.connect(self.history_manager.queue_file_version)
         self.watcher.file_watcher_notification.connect(self._on_watcher_notification)
 
         self.history_manager.scan_started.connect(self._on_scan_started)
@@ -92,6 +95,8 @@ class TrayIcon(QSystemTrayIcon):
 
         # 6. Применяем настройки
         self._apply_initial_startup_setting()
+        # После подключения уведомлений: об отказе сменить алгоритм хранилища пользователь узнает
+        self.history_manager.set_hash_algorithm(self.config_manager.get("hash_algorithm", "sha256"))
 
         # 7. Отложенный запуск
         QTimer.singleShot(0, self._initial_startup_operations)
@@ -131,8 +136,11 @@ class TrayIcon(QSystemTrayIcon):
         self.show_notification(self.tr("Undoit - Тема"), msg, icon, topic="settings")
 
     @Slot(str)
-    def _on_scan_progress(self, file_name: str):
-        self.show_notification(self.tr("Undoit - Сканирование"), file_name, QSystemTrayIcon.Information, topic="scan_progress")
+    def _on_scan_progress(self, status_text: str):
+        # Ход сканирования показывается в тултипе: снимки приходят периодически и не должны
+        # превращаться в поток всплывающих уведомлений
+        self._scan_status_text = status_text
+        self._update_monitoring_ui_state()
 
     @Slot(str, QSystemTrayIcon.MessageIcon)
     def _on_watcher_notification(self, msg: str, icon: QSystemTrayIcon.MessageIcon):
@@ -163,7 +171,7 @@ class TrayIcon(QSystemTrayIcon):
     def _initial_startup_operations(self):
         self._update_monitoring_ui_state()
         if self._current_watched_items:
-            self.history_manager.start_scan(self._current_watched_items)
+            self.history_manager.start_scan(self._current_watched_items, self.config_manager.get_watch_rules())
         else:
             self.show_notification(
                 self.tr("Undoit - Отслеживание"),
@@ -293,7 +301,8 @@ class TrayIcon(QSystemTrayIcon):
 
         if self.history_manager._is_scan_running:
             self.setIcon(self.icon_generator.get_icon('saving'))
-            self.setToolTip(base_tooltip + self.tr("Идет сканирование файлов...\n") + storage_info_text)
+            scan_status_text = self._scan_status_text or self.tr("Идет сканирование файлов...")
+            self.setToolTip(base_tooltip + scan_status_text + "\n" + storage_info_text)
             self.toggle_watch_action.setText(self.tr("Сканирование..."))
             self.toggle_watch_action.setEnabled(False)
             return
@@ -336,9 +345,9 @@ class TrayIcon(QSystemTrayIcon):
 
 
     @Slot()
-    def _on_scan_started(self): self._update_monitoring_ui_state()
+    def _on_scan_started(self): self._scan_status_text = ""; self._update_monitoring_ui_state()
     @Slot()
-    def _on_scan_finished(self): self._update_monitoring_ui_state(); self._attempt_start_monitoring()
+    def _on_scan_finished(self): self._scan_status_text = ""; self._update_monitoring_ui_state(); self._attempt_start_monitoring()
     @Slot()
     def _on_cleanup_started(self): self._update_monitoring_ui_state()
     @Slot()
@@ -378,18 +387,20 @@ class TrayIcon(QSystemTrayIcon):
         only_exclusions_changed = not added_paths and not removed_paths
 
         # 1. Обновляем внутреннее состояние и передаем полный список наблюдателю
+        # Правила отслеживания компилируются один раз и общие для наблюдателя, сканирования и очистки
         self._current_watched_items = new_items
-        self.watcher.update_items(new_items)
+        watch_rules = self.config_manager.get_watch_rules()
+        self.watcher.update_items(new_items, watch_rules)
 
         # 2. Запускаем очистку, если что-то удалили ИЛИ изменили исключения.
         # ИЛИ если изменилось хоть что-то, чтобы гарантировать актуальность БД.
         if removed_paths or only_exclusions_changed or (len(old_paths) != len(new_paths)):
-            self.history_manager.start_cleanup(new_items)
+            self.history_manager.start_cleanup(new_items, watch_rules)
 
         # 3. Запускаем сканирование только для НОВЫХ добавленных элементов
         if added_paths:
             added_items = [item for item in new_items if item['path'] in added_paths]
-            self.history_manager.start_scan(added_items)
+            self.history_manager.start_scan(added_items, watch_rules)
 
         # 4. Пытаемся запустить/обновить мониторинг в любом случае
         self._attempt_start_monitoring()
@@ -1,6 +1,6 @@
 # -*- coding: utf-8 -*-
 # GUI: Окно истории версий
-import shutil
+import os
 from datetime import datetime
 from pathlib import Path
 from typing import Optional, List, Set, Tuple, Dict
@@ -43,7 +43,7 @@ class HistoryWindow(QMainWindow):
         self._current_selected_file_id: Optional[int] = None # ID текущего выбранного файла в списке файлов
         self._current_selected_version_data: Optional[Tuple[int, str, str, int]] = None # (version_id, timestamp_str, sha256_hash, file_size)
 
-        self.current_object_path: Optional[Path] = None # Путь к файлу в хранилище для текущей выбранной версии
+        self.current_object_hash: Optional[str] = None # Хеш объекта в хранилище для текущей выбранной версии
         self.current_original_file_path: Optional[Path] = None # Оригинальный путь к файлу для текущей выбранной версии
         self._current_original_pixmap: Optional[QPixmap] = None # Оригинальное изображение для предпросмотра (немасштабированное)
 
@@ -59,6 +59,8 @@ class HistoryWindow(QMainWindow):
         self.history_manager.version_added.connect(self.refresh_version_list_if_selected) # Обновление версий
         self.history_manager.version_deleted.connect(self.refresh_version_list_if_selected) # Удаление версий
         self.history_manager.files_deleted.connect(self.refresh_file_list_after_deletion) # Удаление файлов
+        self.history_manager.scan_progress.connect(self._on_scan_progress) # Ход сканирования в строке состояния
+        self.history_manager.scan_finished.connect(self.statusBar().clearMessage)
 
     def _init_ui(self):
         """Инициализирует пользовательский интерфейс."""
@@ -245,6 +247,10 @@ class HistoryWindow(QMainWindow):
                 return True
         return False
 
+    @Slot(str)
+    def _on_scan_progress(self, status_text: str):
+        self.statusBar().showMessage(status_text)
+
     @Slot(list)
     def refresh_file_list_after_deletion(self, deleted_files_info: List[Tuple[int, str]]): # <--- ИЗМЕНЕНО
         """
@@ -301,17 +307,15 @@ class HistoryWindow(QMainWindow):
         self.files_list.clear()
         self._all_tracked_files_data.clear()
 
-        # Получаем отслеживаемые элементы из ConfigManager
+        # Получаем отслеживаемые элементы и скомпилированные правила из ConfigManager
         watched_items = self.config_manager.get_watched_items()
+        watch_rules = self.config_manager.get_watch_rules()
 
         # Получаем все отслеживаемые файлы из HistoryManager
         all_tracked_files_raw = self.history_manager.get_all_tracked_files() # [(file_id, original_path)]
 
-        # Создаем словарь для быстрого поиска файлов по их полному пути
-        tracked_files_by_path = {Path(p).resolve(): (f_id, p) for f_id, p in all_tracked_files_raw}
-
-        # Словарь для хранения QTreeWidgetItem для папок
-        folder_tree_items: Dict[Path, QTreeWidgetItem] = {}
+        # Словарь для хранения QTreeWidgetItem для папок (по пути элемента из настроек)
+        folder_tree_items: Dict[str, QTreeWidgetItem] = {}
 
         # Специальная "папка" для индивидуальных файлов
         individual_files_item = QTreeWidgetItem([self.tr("Другие файлы")])
@@ -337,46 +341,25 @@ class HistoryWindow(QMainWindow):
                 # Сохраняем исходные данные элемента, включая исключения
                 folder_item.setData(0, Qt.ItemDataRole.UserRole, item_data) 
                 self.files_list.addTopLevelItem(folder_item)
-                folder_tree_items[path_obj] = folder_item
-
-        # 2. Распределяем отслеживаемые файлы по папкам или в "Другие файлы"
-        # Необходимо пройти по всем tracked_files_by_path, а не по all_tracked_files_raw напрямую,
-        # так как tracked_files_by_path содержит разрешенные пути.
-
-        # Сначала создадим список кортежей (resolved_path, (file_id, original_path))
-        # для более удобной итерации
-        all_resolved_tracked_files = [(resolved_path, data) for resolved_path, data in tracked_files_by_path.items()]
-
-        for resolved_file_path, (file_id, original_path_str) in all_resolved_tracked_files:
-            file_added_to_folder = False
-
-            # Проверяем, принадлежит ли файл какой-либо отслеживаемой папке (с учетом исключений)
-            for folder_path_obj, folder_item in folder_tree_items.items():
-                if resolved_file_path.is_relative_to(folder_path_obj):
-                    # Проверяем исключения для этой папки
-                    folder_item_data = folder_item.data(0, Qt.ItemDataRole.UserRole)
-                    exclusions = folder_item_data.get("exclusions", [])
-                    is_excluded = any(resolved_file_path.is_relative_to(Path(ex).resolve()) for ex in exclusions)
-
-                    if not is_excluded:
-                        file_child_item = QTreeWidgetItem([resolved_file_path.name])
-                        file_child_item.setIcon(0, self._file_icon)
-                        file_child_item.setToolTip(0, original_path_str)
-                        # Сохраняем file_id и оригинальный_путь в UserRole для файлов
-                        file_child_item.setData(0, Qt.ItemDataRole.UserRole, (file_id, original_path_str))
-                        folder_item.addChild(file_child_item)
-                        self._all_tracked_files_data[file_id] = (file_child_item, original_path_str)
-                        file_added_to_folder = True
-                        break # Файл найден в папке, дальше не ищем
-
-            # Если файл не добавлен ни в одну из отслеживаемых папок, добавляем его в "Другие файлы"
-            if not file_added_to_folder:
-                file_child_item = QTreeWidgetItem([resolved_file_path.name])
-                file_child_item.setIcon(0, self._file_icon)
-                file_child_item.setToolTip(0, original_path_str)
-                file_child_item.setData(0, Qt.ItemDataRole.UserRole, (file_id, original_path_str))
+                folder_tree_items[path_str] = folder_item
+
+        # 2. Распределяем отслеживаемые файлы по папкам или в "Другие файлы".
+        # Папка файла (с учетом исключений) определяется правилами по строке пути, без разрешения каждого файла.
+        for file_id, original_path_str in all_tracked_files_raw:
+            file_child_item = QTreeWidgetItem([os.path.basename(original_path_str)])
+            file_child_item.setIcon(0, self._file_icon)
+            file_child_item.setToolTip(0, original_path_str)
+            # Сохраняем file_id и оригинальный_путь в UserRole для файлов
+            file_child_item.setData(0, Qt.ItemDataRole.UserRole, (file_id, original_path_str))
+            self._all_tracked_files_data[file_id] = (file_child_item, original_path_str)
+
+            folder_item_data = watch_rules.folder_of(original_path_str)
+            folder_item = folder_tree_items.get(folder_item_data.get("path")) if folder_item_data else None
+            if folder_item is not None:
+                folder_item.addChild(file_child_item)
+            else:
+                # Файл не лежит ни в одной из отслеживаемых папок
                 individual_files_item.addChild(file_child_item)
-                self._all_tracked_files_data[file_id] = (file_child_item, original_path_str)
                 has_individual_files = True
 
         # Если есть индивидуальные файлы, добавляем их контейнер на верхний уровень
@@ -551,8 +534,8 @@ class HistoryWindow(QMainWindow):
         self._current_selected_version_data = version_data
         sha256_hash = version_data[2]
 
-        object_path = self.history_manager.get_object_path(sha256_hash)
-        self.current_object_path = object_path
+        # Сам объект не распаковываем: достаточно убедиться, что он есть в хранилище
+        self.current_object_hash = sha256_hash if self.history_manager.has_object(sha256_hash) else None
 
         # self.files_list.currentItem() теперь возвращает QTreeWidgetItem.
         file_tree_item = self.files_list.currentItem()
@@ -566,7 +549,7 @@ class HistoryWindow(QMainWindow):
         self.current_original_file_path = Path(original_path_str)
         original_file_extension = self.current_original_file_path.suffix
 
-        if not object_path:
+        if not self.current_object_hash:
             self._show_preview_message(
                 self.tr("Ошибка: не удалось найти файл с хешем {0}...").format(sha256_hash[:8])
             )
@@ -574,14 +557,14 @@ class HistoryWindow(QMainWindow):
             return
 
         content_type, content_data = self.history_manager.get_file_content_for_preview(
-            object_path, original_file_extension
+            sha256_hash, original_file_extension
         )
 
         if content_type == "text":
             self.text_preview_widget.setText(content_data)
             self.preview_stacked_widget.setCurrentIndex(0)
         elif content_type == "image":
-            pixmap = QPixmap(str(object_path))
+            pixmap = QPixmap(content_data)
             if not pixmap.isNull():
                 self._current_original_pixmap = pixmap
                 self._display_current_image()
@@ -610,7 +593,7 @@ class HistoryWindow(QMainWindow):
         self.text_preview_widget.clear()
         self.image_preview_widget.clear()
         self.info_preview_widget.clear()
-        self.current_object_path = None
+        self.current_object_hash = None
         self.current_original_file_path = None
         self._current_original_pixmap = None
         self.preview_stacked_widget.setCurrentIndex(0) # Показываем текстовый предпросмотр по умолчанию (пустой)
@@ -667,9 +650,9 @@ class HistoryWindow(QMainWindow):
             return
 
         original_path = self.current_original_file_path
-        object_path = self.current_object_path
+        object_hash = self.current_object_hash
 
-        if not original_path or not object_path:
+        if not original_path or not object_hash:
             QMessageBox.warning(self, self.tr("Действие невозможно"), self.tr("Не удалось определить пути к файлу."))
             return
 
@@ -682,11 +665,21 @@ class HistoryWindow(QMainWindow):
 
         if save_path:
             try:
-                shutil.copy2(object_path, save_path)
+                # Версия потоково распаковывается во временный файл, который затем подменяет выбранный
+                if not self.history_manager.export_object(object_hash, Path(save_path), self._selected_version_mtime()):
+                    QMessageBox.critical(self, self.tr("Ошибка"), self.tr("Версия не найдена в хранилище."))
+                    return
                 QMessageBox.information(self, self.tr("Успех"), self.tr("Файл успешно сохранен."))
-            except IOError as e:
+            except (IOError, OSError) as e:
                 QMessageBox.critical(self, self.tr("Ошибка"), self.tr("Не удалось сохранить файл:\n{0}").format(e))
 
+    def _selected_version_mtime(self) -> Optional[float]:
+        """Время сохранения выбранной версии (для mtime восстановленного файла) или None."""
+        try:
+            return datetime.fromisoformat(self._current_selected_version_data[1]).timestamp()
+        except (TypeError, ValueError, IndexError):
+            return None
+
     def _on_restore(self):
         """Слот для кнопки 'Восстановить'."""
         if not self._current_selected_version_data or not self._current_selected_file_id: # Обновлена проверка
@@ -700,9 +693,9 @@ class HistoryWindow(QMainWindow):
 
         original_path_str = str(self.current_original_file_path)
         original_path = self.current_original_file_path
-        object_path = self.current_object_path
+        object_hash = self.current_object_hash
 
-        if not original_path or not object_path:
+        if not original_path or not object_hash:
             QMessageBox.warning(self, self.tr("Действие невозможно"), self.tr("Не удалось определить пути к файлу."))
             return
 
@@ -720,7 +713,10 @@ class HistoryWindow(QMainWindow):
                 # Сначала сохраняем текущую версию файла, прежде чем ее перезаписать
                 self.history_manager.add_file_version(original_path_str)
 
-                shutil.copy2(object_path, original_path)
+                # Файл подменяется атомарно: при ошибке посередине текущее содержимое остается на месте
+                if not self.history_manager.export_object(object_hash, original_path, self._selected_version_mtime()):
+                    QMessageBox.critical(self, self.tr("Ошибка"), self.tr("Версия не найдена в хранилище."))
+                    return
 
                 QMessageBox.information(self, self.tr("Успех"), self.tr("Файл успешно восстановлен."))
             except (IOError, OSError) as e:
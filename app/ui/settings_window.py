@@ -6,12 +6,13 @@ from typing import Dict, List
 from PySide6.QtCore import (QEasingCurve, QPoint, QPointF, QPropertyAnimation,
                             Qt, Signal, Slot, Property)
 from PySide6.QtGui import QColor, QPainter, QPaintEvent, QIcon
-from PySide6.QtWidgets import (QApplication, QComboBox, QDialog, QFileDialog, QGroupBox,
-                               QHBoxLayout, QLabel, QListWidget,
-                               QListWidgetItem, QPushButton, QVBoxLayout,
+from PySide6.QtWidgets import (QApplication, QCheckBox, QComboBox, QDialog, QFileDialog, QGroupBox,
+                               QHBoxLayout, QInputDialog, QLabel, QLineEdit, QListWidget,
+                               QListWidgetItem, QMessageBox, QPushButton, QVBoxLayout,
                                QWidget, QStyle)
 
 from app.config_manager import ConfigManager
+from app.path_patterns import pattern_error
 
 
 class Switch(QWidget):
@@ -97,6 +98,15 @@ class SettingsWindow(QDialog):
         }
         self._lang_key_to_display_map = {v: k for k, v in self._lang_display_to_key_map.items()}
 
+        # Режимы базовой версии при первом сканировании (см. HistoryManager.BASELINE_MODES)
+        self._baseline_display_to_key_map = {
+            self.tr("Полная копия"): "full",
+            self.tr("Индекс, копия в фоне"): "background",
+            self.tr("Только хеш"): "hash",
+            self.tr("Только метаданные"): "metadata",
+        }
+        self._baseline_key_to_display_map = {v: k for k, v in self._baseline_display_to_key_map.items()}
+
         # Получаем стандартные иконки
         self.folder_icon = QApplication.style().standardIcon(QStyle.StandardPixmap.SP_DirIcon)
         self.file_icon = QApplication.style().standardIcon(QStyle.StandardPixmap.SP_FileIcon)
@@ -152,9 +162,49 @@ class SettingsWindow(QDialog):
 
         exclusions_group_layout.addWidget(self.exclusions_list)
         exclusions_group_layout.addLayout(exclusions_buttons_layout)
+
+        # Шаблоны исключения и включения (глобы или "re:выражение"), через ";"
+        patterns_tooltip = self.tr(
+            "Шаблоны через \";\": имя на любом уровне (node_modules, *.tmp, ~$*.docx), "
+            "путь от корня папки (.git/objects, build/**/*.o) или регулярное выражение с префиксом \"re:\"."
+        )
+        self.exclude_patterns_edit = QLineEdit()
+        self.exclude_patterns_edit.setPlaceholderText("node_modules; *.tmp; ~$*.docx")
+        self.exclude_patterns_edit.setToolTip(patterns_tooltip)
+        self.exclude_patterns_edit.editingFinished.connect(
+            lambda: self._on_patterns_edited("exclude_patterns", self.exclude_patterns_edit))
+        self.include_patterns_edit = QLineEdit()
+        self.include_patterns_edit.setPlaceholderText(self.tr("все файлы"))
+        self.include_patterns_edit.setToolTip(patterns_tooltip)
+        self.include_patterns_edit.editingFinished.connect(
+            lambda: self._on_patterns_edited("include_patterns", self.include_patterns_edit))
+        exclusions_group_layout.addWidget(QLabel(self.tr("Исключать по шаблону:")))
+        exclusions_group_layout.addWidget(self.exclude_patterns_edit)
+        exclusions_group_layout.addWidget(QLabel(self.tr("Отслеживать только:")))
+        exclusions_group_layout.addWidget(self.include_patterns_edit)
+
+        self.use_ignore_files_check = QCheckBox(self.tr("Учитывать файлы .gitignore и .ignore"))
+        self.use_ignore_files_check.setToolTip(self.tr(
+            "Пути, игнорируемые файлами .gitignore и .ignore внутри папки (по правилам git), не отслеживаются."
+        ))
+        self.use_ignore_files_check.toggled.connect(self._on_use_ignore_files_toggled)
+        exclusions_group_layout.addWidget(self.use_ignore_files_check)
         self.exclusions_group.setLayout(exclusions_group_layout)
         exclusions_layout.addWidget(self.exclusions_group)
 
+        # Что сохраняется при первом сканировании выбранного элемента: место на диске против надежности
+        baseline_layout = QHBoxLayout()
+        self.baseline_combo = QComboBox()
+        self.baseline_combo.addItems(list(self._baseline_display_to_key_map.keys()))
+        self.baseline_combo.setToolTip(self.tr(
+            "Индексные режимы не копируют файлы при первом сканировании: содержимое сохраняется "
+            "при первом изменении файла (или постепенно в фоне), а исходное содержимое до изменения может быть недоступно."
+        ))
+        self.baseline_combo.currentTextChanged.connect(self._on_baseline_changed)
+        baseline_layout.addWidget(QLabel(self.tr("Начальная версия:")))
+        baseline_layout.addWidget(self.baseline_combo)
+        exclusions_layout.addLayout(baseline_layout)
+
         items_main_layout.addLayout(items_list_layout, 2) # Левая панель в 2 раза шире
         items_main_layout.addLayout(exclusions_layout, 1) # Правая панель
         items_group.setLayout(items_main_layout)
@@ -252,13 +302,29 @@ class SettingsWindow(QDialog):
         selected_item = selected_items[0]
         item_data = selected_item.data(Qt.ItemDataRole.UserRole)
 
+        self.baseline_combo.blockSignals(True)
+        self.baseline_combo.setCurrentText(
+            self._baseline_key_to_display_map.get(item_data.get("baseline", "full"), self.tr("Полная копия"))
+        )
+        self.baseline_combo.blockSignals(False)
+
         if item_data.get("type") == "folder":
             self.exclusions_group.setEnabled(True)
             self.exclusions_group.setTitle(self.tr("Исключения для: {0}").format(Path(item_data["path"]).name))
             exclusions = item_data.get("exclusions", [])
             for ex_path in exclusions:
                 self.exclusions_list.addItem(QListWidgetItem(ex_path))
+            self.exclude_patterns_edit.setText("; ".join(item_data.get("exclude_patterns", [])))
+            self.include_patterns_edit.setText("; ".join(item_data.get("include_patterns", [])))
+            self.use_ignore_files_check.blockSignals(True)
+            self.use_ignore_files_check.setChecked(bool(item_data.get("use_ignore_files", False)))
+            self.use_ignore_files_check.blockSignals(False)
         else:
+            self.exclude_patterns_edit.clear()
+            self.include_patterns_edit.clear()
+            self.use_ignore_files_check.blockSignals(True)
+            self.use_ignore_files_check.setChecked(False)
+            self.use_ignore_files_check.blockSignals(False)
             self.exclusions_group.setEnabled(False)
             self.exclusions_group.setTitle(self.tr("Исключения (только для папок)"))
         
@@ -268,6 +334,7 @@ class SettingsWindow(QDialog):
         """Обновляет состояние кнопок (вкл/выкл)."""
         is_item_selected = len(self.items_list.selectedItems()) > 0
         self.remove_item_button.setEnabled(is_item_selected)
+        self.baseline_combo.setEnabled(is_item_selected)
 
         is_folder_selected = False
         if is_item_selected:
@@ -277,11 +344,69 @@ class SettingsWindow(QDialog):
         self.add_exclusion_button.setEnabled(is_folder_selected)
         self.remove_exclusion_button.setEnabled(is_folder_selected and len(self.exclusions_list.selectedItems()) > 0)
 
+    def _on_patterns_edited(self, key: str, line_edit: QLineEdit):
+        """Сохраняет шаблоны выбранной папки; некорректный шаблон не сохраняется."""
+        selected_items = self.items_list.selectedItems()
+        if not selected_items: return
+
+        list_item = selected_items[0]
+        item_data = list_item.data(Qt.ItemDataRole.UserRole)
+        patterns = [p.strip() for p in line_edit.text().split(";") if p.strip()]
+        for pattern in patterns:
+            error = pattern_error(pattern)
+            if error:
+                QMessageBox.warning(self, self.tr("Некорректный шаблон"),
+                                    self.tr("Шаблон \"{0}\" не сохранен: {1}").format(pattern, error))
+                line_edit.setText("; ".join(item_data.get(key, [])))
+                return
+        if patterns == item_data.get(key, []):
+            return
+        if patterns:
+            item_data[key] = patterns
+        else:
+            item_data.pop(key, None)
+        list_item.setData(Qt.ItemDataRole.UserRole, item_data)
+        self._save_changes()
+
+    @Slot(bool)
+    def _on_use_ignore_files_toggled(self, checked: bool):
+        selected_items = self.items_list.selectedItems()
+        if not selected_items: return
+
+        list_item = selected_items[0]
+        item_data = list_item.data(Qt.ItemDataRole.UserRole)
+        if checked:
+            item_data["use_ignore_files"] = True
+        else:
+            item_data.pop("use_ignore_files", None)
+        list_item.setData(Qt.ItemDataRole.UserRole, item_data)
+        self._save_changes()
+
+    @Slot(str)
+    def _on_baseline_changed(self, display_text: str):
+        selected_items = self.items_list.selectedItems()
+        if not selected_items: return
+
+        list_item = selected_items[0]
+        item_data = list_item.data(Qt.ItemDataRole.UserRole)
+        item_data["baseline"] = self._baseline_display_to_key_map.get(display_text, "full")
+        list_item.setData(Qt.ItemDataRole.UserRole, item_data)
+        self._save_changes()
+
     @Slot()
     def _add_folder(self):
         dir_path = QFileDialog.getExistingDirectory(self, self.tr("Выберите папку для отслеживания"))
-        if dir_path:
-            self._add_item_to_list({"path": dir_path, "type": "folder", "exclusions": []})
+        if not dir_path: return
+        # Режим начальной версии выбирается до сохранения: сохранение сразу запускает сканирование папки
+        display_names = list(self._baseline_display_to_key_map.keys())
+        display_text, accepted = QInputDialog.getItem(
+            self, self.tr("Начальная версия"),
+            self.tr("Как сохранить текущее содержимое папки при первом сканировании?"),
+            display_names, 0, False
+        )
+        if not accepted: return
+        baseline = self._baseline_display_to_key_map.get(display_text, "full")
+        self._add_item_to_list({"path": dir_path, "type": "folder", "exclusions": [], "baseline": baseline})
     
     @Slot()
     def _add_files(self):
@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+# Скомпилированные правила отслеживания: какие пути относятся к отслеживаемым элементам
+import functools
+import os
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.ignore_files import IgnoreMatcher
+from app.path_patterns import PathPatterns
+from app.scanner import build_exclusion_keys, normalize_path
+
+
+class _TrieNode:
+    __slots__ = ("children", "folders", "excluded_folders", "is_file")
+
+    def __init__(self):
+        self.children: Dict[str, "_TrieNode"] = {}
+        self.folders: List[int] = []          # Индексы папок-элементов, корень которых - этот путь
+        self.excluded_folders: Set[int] = set() # Индексы папок-элементов, исключающих этот путь
+        self.is_file = False                    # Путь - отслеживаемый файл-элемент
+
+
+class WatchRules:
+    """
+    Правила отслеживания, скомпилированные из watched_items один раз при изменении настроек.
+    Общие для наблюдателя, сканирования, очистки истории и окна истории.
+
+    Пути элементов и исключений нормализуются заранее (как есть и после разрешения ссылок)
+    и раскладываются по компонентам в префиксное дерево. Проверка пути - один проход по его
+    компонентам, O(глубины), без системных вызовов: путь отслеживается, если он - файл-элемент
+    или лежит в папке-элементе и не попадает ни под одно исключение и шаблон этой же папки
+    (шаблоны каждой папки скомпилированы в одно выражение, см. PathPatterns), а для папок
+    с use_ignore_files - и под правила ее файлов .gitignore/.ignore (см. IgnoreMatcher). Только путь,
+    не подошедший как есть, проверяется еще раз с разрешенной родительской папкой (ссылки);
+    результаты разрешения папок кешируются (RESOLVE_CACHE_SIZE).
+    """
+    RESOLVE_CACHE_SIZE = 1024
+
+    def __init__(self, items: List[Dict]):
+        self.items = items
+        self._root = _TrieNode()
+        self._folder_items: List[Dict] = []
+        self._exclusion_keys: Dict[str, Set[str]] = {}
+        self._folder_patterns: List[Optional[PathPatterns]] = []
+        self._patterns: Dict[str, Optional[PathPatterns]] = {}
+        self._folder_ignores: List[Optional[IgnoreMatcher]] = []
+        self._ignores: Dict[str, Optional[IgnoreMatcher]] = {}
+        self.file_keys: Set[str] = set() # Нормализованные пути файлов-элементов
+        self._resolve_dir = functools.lru_cache(maxsize=self.RESOLVE_CACHE_SIZE)(os.path.realpath)
+
+        for item in items:
+            path_str = item.get("path")
+            item_type = item.get("type")
+            if not path_str or not item_type:
+                continue
+            # Несуществующие пути тоже учитываются: например, история папки на отключенном диске сохраняется
+            path_keys = {normalize_path(path_str), normalize_path(os.path.realpath(path_str))}
+            if item_type == "file":
+                self.file_keys |= path_keys
+                for key in path_keys:
+                    self._node(key).is_file = True
+            elif item_type == "folder":
+                index = len(self._folder_items)
+                self._folder_items.append(item)
+                patterns = PathPatterns.from_item(item)
+                self._folder_patterns.append(patterns)
+                self._patterns[path_str] = patterns
+                ignore = IgnoreMatcher(normalize_path(path_str)) if item.get("use_ignore_files") else None
+                self._folder_ignores.append(ignore)
+                self._ignores[path_str] = ignore
+                exclusion_keys = build_exclusion_keys(path_str, item.get("exclusions", []))
+                self._exclusion_keys[path_str] = exclusion_keys
+                for key in path_keys:
+                    self._node(key).folders.append(index)
+                for key in exclusion_keys:
+                    self._node(key).excluded_folders.add(index)
+
+    def _node(self, key: str) -> _TrieNode:
+        node = self._root
+        for part in _parts(key):
+            node = node.children.setdefault(part, _TrieNode())
+        return node
+
+    def _walk(self, parts: List[str]) -> Tuple[Optional[_TrieNode], List[Tuple[int, int]]]:
+        """
+        Проходит компоненты пути по дереву: (узел пути, если путь есть в дереве;
+        папки, в которых путь лежит и не исключен, с числом компонентов их корня).
+        """
+        node = self._root
+        folders: List[Tuple[int, int]] = []
+        for depth, part in enumerate(parts, 1):
+            node = node.children.get(part)
+            if node is None:
+                break
+            if node.folders:
+                folders = folders + [(index, depth) for index in node.folders]
+            if node.excluded_folders and folders:
+                folders = [folder for folder in folders if folder[0] not in node.excluded_folders]
+        return node, folders
+
+    def _match(self, key: str) -> Tuple[bool, List[int]]:
+        """Проверяет путь: (путь - файл-элемент, индексы папок, в которых он отслеживается)."""
+        parts = _parts(key)
+        node, folders = self._walk(parts)
+        return node is not None and node.is_file, [
+            index for index, depth in folders
+            if (self._folder_patterns[index] is None
+                or self._folder_patterns[index].is_file_watched("/".join(parts[depth:])))
+            and (self._folder_ignores[index] is None
+                 or not self._folder_ignores[index].is_ignored(parts[depth:]))
+        ]
+
+    def _resolve_match(self, path: str) -> Tuple[bool, List[int]]:
+        key = normalize_path(path)
+        is_file, folders = self._match(key)
+        if is_file or folders:
+            return is_file, folders
+        parent, name = os.path.split(key)
+        resolved_key = normalize_path(os.path.join(self._resolve_dir(parent), name))
+        if resolved_key == key:
+            return is_file, folders
+        return self._match(resolved_key)
+
+    def is_watched(self, path: str) -> bool:
+        """Относится ли путь к отслеживаемым элементам."""
+        is_file, folders = self._resolve_match(path)
+        return is_file or bool(folders)
+
+    def folder_of(self, path: str) -> Optional[Dict]:
+        """Папка-элемент (первая в порядке настроек), в которой отслеживается путь, или None."""
+        _, folders = self._resolve_match(path)
+        return self._folder_items[min(folders)] if folders else None
+
+    def exclusion_keys(self, item: Dict) -> Set[str]:
+        """Нормализованные исключения папки-элемента для scanner.walk_files."""
+        keys = self._exclusion_keys.get(item.get("path"))
+        if keys is None: # Элемент не входит в правила (например, правила построены по другому списку)
+            keys = build_exclusion_keys(item.get("path"), item.get("exclusions", []))
+        return keys
+
+    def patterns(self, item: Dict) -> Optional[PathPatterns]:
+        """Скомпилированные шаблоны папки-элемента для scanner.walk_files или None."""
+        if item.get("path") in self._patterns:
+            return self._patterns[item.get("path")]
+        return PathPatterns.from_item(item)
+
+    def ignore(self, item: Dict) -> Optional[IgnoreMatcher]:
+        """Правила игнор-файлов папки-элемента для scanner.walk_files или None, если они не учитываются."""
+        if item.get("path") in self._ignores:
+            return self._ignores[item.get("path")]
+        return IgnoreMatcher(normalize_path(item.get("path"))) if item.get("use_ignore_files") else None
+
+    def ignore_file_changed(self, path: str):
+        """Сбрасывает кешированные правила папки, в которой изменился, появился или удален игнор-файл."""
+        parts = _parts(normalize_path(path))
+        for index, depth in self._walk(parts)[1]:
+            if self._folder_ignores[index] is not None:
+                self._folder_ignores[index].invalidate(tuple(parts[depth:-1]))
+
+
+def _parts(key: str) -> List[str]:
+    # Корень ("/" или "c:\\") дает один компонент, как и начало любого пути под ним
+    return key.rstrip(os.sep).split(os.sep)
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+# Тесты для нарезки файлов на блоки (FastCDC)
+import io
+import random
+
+import pytest
+
+from app.chunker import FastCDC
+
+
+def _make_data(size: int, seed: int = 42) -> bytes:
+    rng = random.Random(seed)
+    return bytes(rng.getrandbits(8) for _ in range(size))
+
+
+@pytest.fixture
+def chunker() -> FastCDC:
+    """Небольшие размеры блоков, чтобы тесты работали быстро."""
+    return FastCDC(min_size=256, avg_size=1024, max_size=4096)
+
+
+def test_chunks_reassemble_to_original(chunker):
+    """Тест: склеенные блоки в точности совпадают с исходными данными."""
+    data = _make_data(50_000)
+    chunks = list(chunker.iter_chunks(io.BytesIO(data)))
+    assert b"".join(chunks) == data
+    assert len(chunks) > 1
+
+
+def test_chunk_sizes_respect_limits(chunker):
+    """Тест: все блоки, кроме последнего, укладываются в [min_size, max_size]."""
+    chunks = list(chunker.iter_chunks(io.BytesIO(_make_data(50_000))))
+    for chunk in chunks[:-1]:
+        assert chunker.min_size <= len(chunk) <= chunker.max_size
+    assert len(chunks[-1]) <= chunker.max_size
+
+
+def test_small_input_is_single_chunk(chunker):
+    """Тест: данные меньше минимального блока дают ровно один блок, пустые - ни одного."""
+    assert list(chunker.iter_chunks(io.BytesIO(b"abc"))) == [b"abc"]
+    assert list(chunker.iter_chunks(io.BytesIO(b""))) == []
+
+
+def test_insertion_changes_only_nearby_chunks(chunker):
+    """Тест: вставка в начало файла не сдвигает границы остальных блоков."""
+    data = _make_data(80_000)
+    modified = data[:100] + b"INSERTED BYTES" + data[100:]
+
+    original_chunks = set(chunker.iter_chunks(io.BytesIO(data)))
+    modified_chunks = list(chunker.iter_chunks(io.BytesIO(modified)))
+
+    new_chunks = [c for c in modified_chunks if c not in original_chunks]
+    # Измениться должны лишь один-два блока в районе вставки
+    assert len(new_chunks) <= 2
+    assert len(modified_chunks) > 10
+
+
+def test_invalid_sizes_raise():
+    """Тест: некорректные параметры размеров отклоняются."""
+    with pytest.raises(ValueError):
+        FastCDC(min_size=2048, avg_size=1024, max_size=4096)
+
+
+def test_vectorized_cut_points_match_bytewise_search(chunker, mocker):
+    """Тест: векторный поиск границ (numpy) дает те же блоки, что и побайтовый цикл."""
+    pytest.importorskip("numpy")
+    from app import chunker as chunker_module
+
+    data = _make_data(50_000)
+    vectorized = list(chunker.iter_chunks(io.BytesIO(data)))
+    mocker.patch.object(chunker_module, "_GEAR_ARRAY", None)
+    bytewise = list(chunker.iter_chunks(io.BytesIO(data)))
+    assert vectorized == bytewise
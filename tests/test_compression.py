@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+# Тесты для прозрачного сжатия объектов хранилища
+import io
+import os
+
+import pytest
+
+from app import compression
+
+
+def _encode(data: bytes, codec: int, level=None) -> bytes:
+    out = io.BytesIO()
+    writer = compression.EncodingWriter(out, codec, level)
+    for start in range(0, len(data), 1000):
+        writer.write(data[start:start + 1000])
+    writer.finish()
+    return out.getvalue()
+
+
+def _decode(stored: bytes) -> bytes:
+    with compression.open_decoded(io.BytesIO(stored)) as f:
+        return f.read()
+
+
+@pytest.mark.parametrize("data", [b"", b"hello world\n" * 5000, os.urandom(3000)])
+def test_zlib_roundtrip(data):
+    """Тест: данные, сжатые zlib, распаковываются без искажений."""
+    stored = _encode(data, compression.CODEC_ZLIB)
+    assert compression.parse_header(stored) == (compression.CODEC_ZLIB, compression.FAST_LEVELS[compression.CODEC_ZLIB])
+    assert _decode(stored) == data
+
+
+def test_text_is_actually_compressed():
+    """Тест: повторяющийся текст занимает заметно меньше места."""
+    data = b"2024-01-01 INFO something happened\n" * 10000
+    assert len(_encode(data, compression.CODEC_ZLIB)) < len(data) // 10
+
+
+def test_raw_data_is_stored_without_header():
+    """Тест: без сжатия данные хранятся как есть и читаются напрямую."""
+    data = b"plain content"
+    assert _encode(data, compression.CODEC_NONE) == data
+    assert _decode(data) == data
+
+
+def test_raw_data_that_looks_like_header_is_escaped():
+    """Тест: несжатые данные, начинающиеся с MAGIC, получают заголовок и не искажаются при чтении."""
+    data = compression.MAGIC + b"\x01\x01 definitely not zlib"
+    stored = _encode(data, compression.CODEC_NONE)
+    assert compression.parse_header(stored) == (compression.CODEC_NONE, 0)
+    assert _decode(stored) == data
+
+
+def test_incompressible_detection():
+    """Тест: уже сжатые данные определяются по сигнатуре и по энтропии, текст - нет."""
+    text = b"The quick brown fox jumps over the lazy dog. " * 500
+    assert not compression.is_data_incompressible(text)
+    assert compression.is_data_incompressible(os.urandom(40000))
+    assert compression.is_data_incompressible(b"PK\x03\x04" + text) # ZIP (DOCX, XLSX)
+    assert compression.is_data_incompressible(b"\xff\xd8\xff\xe0" + text) # JPEG
+
+
+def test_codec_from_name_falls_back_to_available_codec():
+    """Тест: неизвестное имя кодека заменяется кодеком по умолчанию."""
+    assert compression.codec_from_name("zlib") == compression.CODEC_ZLIB
+    assert compression.codec_from_name("none") == compression.CODEC_NONE
+    assert compression.codec_from_name("auto") == compression.default_codec()
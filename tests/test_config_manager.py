@@ -166,4 +166,35 @@ def test_get_storage_path(fs):
     storage_path = config_manager.get_storage_path()
     
     expected_path = Path.home() / "AppData/Local/Undoit/storage"
-    assert storage_path == expected_path
\ No newline at end of file
+    assert storage_path == expected_path
+
+def test_changing_item_baseline_mode_is_a_change(fs, mocker):
+    """Тест: смена режима начальной версии элемента сохраняется и испускает сигнал."""
+    fs.create_dir(Path.home())
+    config_manager = ConfigManager()
+    items = [{"path": "D:/Projects", "type": "folder", "exclusions": []}]
+    config_manager.set("watched_items", items)
+
+    mock_signal_handler = mocker.Mock()
+    config_manager.watched_items_changed.connect(mock_signal_handler)
+    config_manager.set("watched_items", [dict(items[0], baseline="full")]) # Значение по умолчанию - не изменение
+    mock_signal_handler.assert_not_called()
+    config_manager.set("watched_items", [dict(items[0], baseline="hash")])
+    mock_signal_handler.assert_called_once()
+    assert config_manager.get_watched_items()[0]["baseline"] == "hash"
+
+
+def test_changing_item_patterns_is_a_change(fs, mocker):
+    """Тест: изменение шаблонов элемента сохраняется, а их порядок не считается изменением."""
+    fs.create_dir(Path.home())
+    config_manager = ConfigManager()
+    items = [{"path": "D:/Projects", "type": "folder", "exclusions": [], "exclude_patterns": ["*.tmp", "build"]}]
+    config_manager.set("watched_items", items)
+
+    mock_signal_handler = mocker.Mock()
+    config_manager.watched_items_changed.connect(mock_signal_handler)
+    config_manager.set("watched_items", [dict(items[0], exclude_patterns=["build", "*.tmp"])])
+    mock_signal_handler.assert_not_called()
+    config_manager.set("watched_items", [dict(items[0], include_patterns=["*.py"])])
+    mock_signal_handler.assert_called_once()
+    assert config_manager.get_watched_items()[0]["include_patterns"] == ["*.py"]
@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+# Тесты для бинарных дельт между версиями
+import random
+
+import pytest
+
+from app import delta
+
+
+def _make_text(lines: int, seed: int = 1) -> bytes:
+    rng = random.Random(seed)
+    return "".join(f"{i};{rng.randint(0, 10**9)};значение {rng.random():.6f}\n" for i in range(lines)).encode("utf-8")
+
+
+def test_roundtrip_for_small_edit():
+    """Тест: правка нескольких строк дает маленькую дельту, которая точно восстанавливает версию."""
+    base = _make_text(2000)
+    target = base.replace(b"\n5;", b"\n5;EDITED;", 1) + b"new line at the end\n"
+
+    encoded = delta.encode(base, target)
+    assert delta.apply(base, encoded) == target
+    assert len(encoded) < len(target) // 20
+
+
+def test_roundtrip_for_unrelated_data():
+    """Тест: даже для совершенно разных данных дельта корректно восстанавливает версию."""
+    base = _make_text(100, seed=1)
+    target = _make_text(120, seed=2)
+    assert delta.apply(base, delta.encode(base, target)) == target
+
+
+@pytest.mark.parametrize("base,target", [(b"", b""), (b"", b"abc"), (b"abc", b""), (b"x" * 100, b"x" * 100)])
+def test_roundtrip_edge_cases(base, target):
+    """Тест: пустые и одинаковые версии обрабатываются корректно."""
+    assert delta.apply(base, delta.encode(base, target)) == target
+
+
+def test_apply_rejects_wrong_base():
+    """Тест: дельта, примененная к чужой базовой версии, отклоняется."""
+    base = _make_text(100)
+    encoded = delta.encode(base, base + b"tail")
+    with pytest.raises(delta.DeltaError):
+        delta.apply(base[:-1], encoded)
+    with pytest.raises(delta.DeltaError):
+        delta.apply(base, b"garbage")
+
+
+def test_encoding_skips_ahead_and_finds_matches_after_unrelated_data():
+    """Тест: участок без совпадений проходится с растущим шагом, а совпадение после него находится целиком."""
+    rng = random.Random(7)
+    base = _make_text(2000)
+    target = rng.randbytes(200_000) + base
+
+    encoded = delta.encode(base, target)
+    assert delta.apply(base, encoded) == target
+    assert len(encoded) < 200_000 + len(base) // 20
+
+
+def test_encoding_stops_when_delta_exceeds_max_size():
+    """Тест: для несвязанных данных кодирование прекращается, как только дельта превысит предел."""
+    rng = random.Random(3)
+    base = rng.randbytes(100_000)
+    target = rng.randbytes(100_000)
+    assert delta.encode(base, target, max_size=50_000) is None
+    small_edit = base[:500] + b"edit" + base[500:]
+    assert delta.apply(base, delta.encode(base, small_edit, max_size=50_000)) == small_edit
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+# Тесты для последовательного чтения больших файлов
+import io
+import os
+
+from app import file_io
+
+
+def test_blocks_are_read_into_reused_buffer(mocker):
+    """Тест: поток читается блоками через один и тот же буфер, вложенное чтение получает свой буфер."""
+    mocker.patch.object(file_io, "IO_BUFFER_SIZE", 1000)
+    mocker.patch.object(file_io._thread_buffers, "buffer", None, create=True)
+    data = os.urandom(3500)
+
+    blocks = []
+    for block in file_io.iter_blocks(io.BytesIO(data)):
+        # Вложенное чтение не портит блок внешнего
+        inner = b"".join(bytes(b) for b in file_io.iter_blocks(io.BytesIO(b"inner")))
+        assert inner == b"inner"
+        blocks.append(bytes(block))
+    assert b"".join(blocks) == data
+    assert [len(b) for b in blocks] == [1000, 1000, 1000, 500]
+
+    first_buffer = file_io._thread_buffers.buffer
+    list(file_io.iter_blocks(io.BytesIO(data)))
+    assert file_io._thread_buffers.buffer is first_buffer
+
+
+def test_large_file_can_be_read_through_mmap(tmp_path, mocker):
+    """Тест: с use_mmap крупный файл читается через отображение в память, а мелкий - обычным чтением."""
+    mocker.patch.object(file_io, "MMAP_THRESHOLD", 4096)
+    mocker.patch.object(file_io, "IO_BUFFER_SIZE", 1024)
+    big_path, small_path = tmp_path / "big.bin", tmp_path / "small.bin"
+    big_path.write_bytes(os.urandom(10_000))
+    small_path.write_bytes(b"small")
+    map_spy = mocker.spy(file_io.mmap, "mmap")
+
+    with file_io.open_sequential(big_path) as f:
+        assert b"".join(bytes(b) for b in file_io.iter_blocks(f, use_mmap=True)) == big_path.read_bytes()
+    assert map_spy.call_count == 1
+    with file_io.open_sequential(small_path) as f:
+        assert b"".join(bytes(b) for b in file_io.iter_blocks(f, use_mmap=True)) == b"small"
+    assert map_spy.call_count == 1
+
+
+def test_sequential_read_drops_cache_of_large_files(tmp_path, mocker):
+    """Тест: после чтения большого файла ОС получает подсказку убрать его страницы из кеша."""
+    mocker.patch.object(file_io, "DROP_CACHE_THRESHOLD", 1000)
+    fadvise = mocker.patch.object(file_io, "_fadvise")
+    source_path, target_path = tmp_path / "source.bin", tmp_path / "target.bin"
+    source_path.write_bytes(os.urandom(5000))
+
+    with file_io.open_sequential(source_path) as source, open(target_path, "wb") as target:
+        assert file_io.copy_stream(source, target) == 5000
+    assert target_path.read_bytes() == source_path.read_bytes()
+    assert [c.args[1] for c in fadvise.call_args_list] == ["POSIX_FADV_SEQUENTIAL", "POSIX_FADV_DONTNEED"]
+
+    fadvise.reset_mock()
+    with file_io.open_sequential(source_path, drop_cache=False) as source:
+        source.read()
+    assert [c.args[1] for c in fadvise.call_args_list] == ["POSIX_FADV_SEQUENTIAL"]
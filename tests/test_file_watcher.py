@@ -6,6 +6,7 @@ import pytest
 from unittest.mock import Mock, MagicMock
 
 from app.file_watcher import ChangeHandler, FileWatcher
+from app.watch_rules import WatchRules
 
 # --- Тесты для ChangeHandler (логика правил) ---
 
@@ -31,22 +32,14 @@ def create_watched_structure(fs):
 
 def test_change_handler_allows_direct_file(create_watched_structure):
     """Тест: обработчик должен разрешать путь к напрямую отслеживаемому файлу."""
-    rules = {
-        'files': {Path("/another_folder/watched_file.md").resolve()},
-        'folders': {}
-    }
+    rules = WatchRules([{"path": "/another_folder/watched_file.md", "type": "file", "exclusions": []}])
     handler = ChangeHandler(Mock(), rules)
     assert handler._is_path_allowed("/another_folder/watched_file.md") is True
 
 
 def test_change_handler_allows_file_in_watched_folder(create_watched_structure):
     """Тест: обработчик должен разрешать путь к файлу внутри отслеживаемой папки."""
-    rules = {
-        'files': set(),
-        'folders': {
-            Path("/watched_folder").resolve(): set()
-        }
-    }
+    rules = WatchRules([{"path": "/watched_folder", "type": "folder", "exclusions": []}])
     handler = ChangeHandler(Mock(), rules)
     assert handler._is_path_allowed("/watched_folder/file1.txt") is True
     assert handler._is_path_allowed("/watched_folder/subfolder/file2.py") is True
@@ -54,12 +47,9 @@ def test_change_handler_allows_file_in_watched_folder(create_watched_structure):
 
 def test_change_handler_denies_file_in_excluded_folder(create_watched_structure):
     """Тест: обработчик должен запрещать путь к файлу в исключенной подпапке."""
-    rules = {
-        'files': set(),
-        'folders': {
-            Path("/watched_folder").resolve(): {Path("/watched_folder/excluded_folder").resolve()}
-        }
-    }
+    rules = WatchRules([
+        {"path": "/watched_folder", "type": "folder", "exclusions": ["/watched_folder/excluded_folder"]}
+    ])
     handler = ChangeHandler(Mock(), rules)
     assert handler._is_path_allowed("/watched_folder/excluded_folder/ignored.log") is False
     # Но файлы не в исключенной папке должны быть разрешены
@@ -68,12 +58,10 @@ def test_change_handler_denies_file_in_excluded_folder(create_watched_structure)
 
 def test_change_handler_denies_unwatched_file(create_watched_structure):
     """Тест: обработчик должен запрещать путь к файлу, не подпадающему ни под одно правило."""
-    rules = {
-        'files': {Path("/another_folder/watched_file.md").resolve()},
-        'folders': {
-            Path("/watched_folder").resolve(): set()
-        }
-    }
+    rules = WatchRules([
+        {"path": "/another_folder/watched_file.md", "type": "file", "exclusions": []},
+        {"path": "/watched_folder", "type": "folder", "exclusions": []}
+    ])
     handler = ChangeHandler(Mock(), rules)
     assert handler._is_path_allowed("/unwatched_folder/some_file.txt") is False
 
@@ -107,12 +95,13 @@ def test_file_watcher_builds_correct_rules(fs):
     rules = watcher._rules
     
     # 1. Проверяем отслеживаемые файлы
-    assert Path("/docs/readme.md").resolve() in rules['files']
+    assert rules.is_watched("/docs/readme.md")
+    assert not rules.is_watched("/docs/other.md")
     
     # 2. Проверяем отслеживаемые папки и исключения
     project_folder_path = Path("/project").resolve()
-    assert project_folder_path in rules['folders']
-    assert Path("/project/node_modules").resolve() in rules['folders'][project_folder_path]
+    assert rules.is_watched("/project/src/app.py")
+    assert not rules.is_watched("/project/node_modules/lib.js")
 
     # 3. Проверяем список папок для передачи в watchdog.Observer
     # Должны быть родительские папки файлов и сами отслеживаемые папки
@@ -146,4 +135,59 @@ def test_file_watcher_start_stop_calls_observer(fs, mocker):
     
     # Проверяем, что наблюдатель был остановлен
     mock_observer_instance.stop.assert_called_once()
-    mock_observer_instance.join.assert_called_once()
\ No newline at end of file
+    mock_observer_instance.join.assert_called_once()
+
+def test_file_watcher_collapses_nested_watches(fs, mocker):
+    """Тест: вложенные папки и файлы внутри наблюдаемой папки не получают отдельных наблюдений."""
+    mock_observer = mocker.patch('app.file_watcher.Observer').return_value
+    fs.create_dir("/project/src/app")
+    fs.create_file("/project/readme.md")
+    fs.create_file("/project/src/main.py")
+    fs.create_dir("/project-docs")
+    items = [
+        {"path": "/project/src/app", "type": "folder", "exclusions": []},
+        {"path": "/project", "type": "folder", "exclusions": ["/project/src"]},
+        {"path": "/project/readme.md", "type": "file", "exclusions": []},
+        {"path": "/project/src/main.py", "type": "file", "exclusions": []},
+        {"path": "/project-docs", "type": "folder", "exclusions": []},
+    ]
+    notifications = []
+
+    watcher = FileWatcher(items)
+    watcher.file_watcher_notification.connect(lambda message, icon: notifications.append(message))
+    assert watcher._folders_to_watch == {Path("/project").resolve(): True, Path("/project-docs").resolve(): True}
+    assert mock_observer.schedule.call_count == 2
+    assert watcher.get_saved_watch_count() == 3
+
+    # Правила по-прежнему решают, какие события проходят через общее наблюдение
+    assert watcher._handler._is_path_allowed("/project/src/app/view.py")
+    assert watcher._handler._is_path_allowed("/project/src/main.py")
+    assert not watcher._handler._is_path_allowed("/project/src/other.py")
+
+    watcher.start()
+    assert notifications[-1].endswith("Объединено перекрывающихся наблюдений: 3.")
+
+
+def test_file_items_use_one_non_recursive_watch_per_directory(fs, mocker):
+    """Тест: папка файлов-элементов наблюдается нерекурсивно одним наблюдением, а события фильтруются по множеству файлов."""
+    mock_observer = mocker.patch('app.file_watcher.Observer').return_value
+    fs.create_file("/home/user/notes.txt")
+    fs.create_file("/home/user/todo.txt")
+    fs.create_file("/home/user/other.txt")
+    fs.create_dir("/home/user/projects/app")
+    items = [
+        {"path": "/home/user/notes.txt", "type": "file", "exclusions": []},
+        {"path": "/home/user/todo.txt", "type": "file", "exclusions": []},
+        {"path": "/home/user/projects/app", "type": "folder", "exclusions": []},
+    ]
+
+    watcher = FileWatcher(items)
+    home, app_dir = Path("/home/user").resolve(), Path("/home/user/projects/app").resolve()
+    assert watcher._folders_to_watch == {home: False, app_dir: True}
+    assert watcher.get_saved_watch_count() == 1
+    scheduled = {c.args[1]: (c.args[0], c.kwargs["recursive"]) for c in mock_observer.schedule.call_args_list}
+    assert scheduled[str(home)] == (watcher._file_items_handler, False)
+    assert scheduled[str(app_dir)] == (watcher._handler, True)
+
+    assert watcher._file_items_handler._is_path_allowed("/home/user/notes.txt")
+    assert not watcher._file_items_handler._is_path_allowed("/home/user/other.txt")
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+# Тесты для алгоритмов хеширования содержимого
+import hashlib
+import io
+import types
+
+import pytest
+
+from app import hashing
+
+
+def test_sha256_is_default_and_always_available():
+    """Тест: SHA-256 доступен всегда, а неизвестный алгоритм заменяется им."""
+    assert hashing.is_available(hashing.ALGORITHM_SHA256)
+    assert hashing.algorithm_from_name("unknown") == hashing.ALGORITHM_SHA256
+    assert hashing.hash_bytes(hashing.ALGORITHM_SHA256, b"abc") == hashlib.sha256(b"abc").hexdigest()
+    with pytest.raises(ValueError):
+        hashing.new_hasher("unknown")
+
+
+def test_blake3_falls_back_when_module_missing(mocker):
+    """Тест: без модуля blake3 настройка "blake3" означает SHA-256."""
+    mocker.patch.object(hashing, "blake3", None)
+    assert not hashing.is_available(hashing.ALGORITHM_BLAKE3)
+    assert hashing.algorithm_from_name(hashing.ALGORITHM_BLAKE3) == hashing.ALGORITHM_SHA256
+
+
+def test_blake3_is_used_when_available(mocker):
+    """Тест: при наличии модуля blake3 хеш считается им и имеет тот же формат, что и SHA-256."""
+    mocker.patch.object(hashing, "blake3", types.SimpleNamespace(blake3=hashlib.sha3_256))
+    assert hashing.algorithm_from_name(hashing.ALGORITHM_BLAKE3) == hashing.ALGORITHM_BLAKE3
+    digest = hashing.hash_bytes(hashing.ALGORITHM_BLAKE3, b"abc")
+    assert digest == hashlib.sha3_256(b"abc").hexdigest()
+    assert len(digest) == len(hashing.hash_bytes(hashing.ALGORITHM_SHA256, b"abc"))
+
+
+def test_quick_hash_is_optional(mocker):
+    """Тест: без модуля xxhash быстрый хеш не считается, а с ним считается потоково."""
+    mocker.patch.object(hashing, "xxhash", None)
+    assert not hashing.quick_hash_available()
+    assert hashing.quick_hash_stream(io.BytesIO(b"data")) is None
+
+    mocker.patch.object(hashing, "xxhash", types.SimpleNamespace(xxh3_128=hashlib.md5))
+    assert hashing.quick_hash_stream(io.BytesIO(b"data" * 100)) == hashlib.md5(b"data" * 100).hexdigest()
@@ -1,9 +1,13 @@
 # -*- coding: utf-8 -*-
 # Тесты для HistoryManager
+import errno
+import os
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Generator
 import pytest
+from app import file_io
 from app.history_manager import HistoryManager
 
 # --- Фикстуры Pytest для настройки тестового окружения ---
@@ -17,6 +21,8 @@ def history_manager(fs, mocker) -> Generator[HistoryManager, None, None]:
     """
     # Мокаем QTimer, чтобы он не мешал тестам
     mocker.patch('app.history_manager.QTimer')
+    # Виртуальная ФС не поддерживает клонирование файлов (FICLONE, copy_file_range)
+    mocker.patch('app.object_store.ObjectStore.probe_clone_support')
 
     # Создаем соединение с БД в памяти ОДИН РАЗ
     in_memory_connection = sqlite3.connect(':memory:', check_same_thread=False)
@@ -51,6 +57,14 @@ def create_files(fs):
     fs.create_file("/test_files/project/main.py", contents="import sys")
     return fs
 
+def _is_db_lock_held(hm: HistoryManager) -> bool:
+    """Занята ли блокировка БД: свободную блокировку удается взять из другого потока."""
+    with ThreadPoolExecutor(max_workers=1) as probe:
+        acquired = probe.submit(hm._db_connection_lock.acquire, False).result()
+        if acquired:
+            probe.submit(hm._db_connection_lock.release).result()
+    return not acquired
+
 # --- Тесты ---
 
 def test_add_first_version(history_manager, create_files, mocker):
@@ -277,4 +291,1016 @@ def test_clean_unwatched_files(history_manager, create_files, mocker):
     mock_files_deleted.assert_called_once()
     deleted_info = mock_files_deleted.call_args[0][0] # Первый аргумент первого вызова
     assert len(deleted_info) == 1
-    assert Path(deleted_info[0][1]).as_posix() == path2 # Проверяем путь удаленного файла
\ No newline at end of file
+    assert Path(deleted_info[0][1]).as_posix() == path2 # Проверяем путь удаленного файла
+
+def test_use_mmap_setting_reaches_file_reads(history_manager, fs, mocker):
+    """Тест: настройка use_mmap включает чтение исходных файлов через отображение в память."""
+    from app import file_io
+
+    hm = history_manager
+    iter_blocks = mocker.spy(file_io, "iter_blocks")
+    fs.create_file("/test_files/a.bin", contents=bytes(range(256)) * 64)
+    hm.add_file_version("/test_files/a.bin")
+    assert iter_blocks.call_count > 0
+    assert all(call.args[1] is False for call in iter_blocks.call_args_list)
+
+    iter_blocks.reset_mock()
+    hm.set_use_mmap(True)
+    with open("/test_files/a.bin", "ab") as f:
+        f.write(b"tail")
+    hm.add_file_version("/test_files/a.bin")
+    assert iter_blocks.call_count > 0
+    assert all(call.args[1] is True for call in iter_blocks.call_args_list)
+    file_id = hm.get_all_tracked_files()[0][0]
+    with hm.open_object(hm.get_versions_for_file(file_id)[0][2]) as f:
+        assert f.read() == bytes(range(256)) * 64 + b"tail"
+
+
+def test_large_file_is_stored_in_chunks(history_manager, fs, mocker):
+    """Тест: крупный файл хранится блоками, а новая версия добавляет только измененные блоки."""
+    from app.chunker import FastCDC
+    from app.object_store import ObjectStore
+
+    hm = history_manager
+    mocker.patch.object(ObjectStore, 'CHUNKING_THRESHOLD', 4096)
+    hm.object_store._chunker = FastCDC(min_size=256, avg_size=1024, max_size=4096)
+
+    data = bytes((i * 7919) % 251 for i in range(40_000))
+    fs.create_file("/test_files/disk.img", contents=data)
+    hm.add_file_version("/test_files/disk.img")
+
+    file_id = hm.get_all_tracked_files()[0][0]
+    first_hash = hm.get_versions_for_file(file_id)[0][2]
+    assert hm.object_store.is_chunked(first_hash)
+    chunk_files_before = {p for p in Path("/storage/chunks").rglob("*") if p.is_file()}
+
+    # Меняем один байт в середине файла
+    modified = bytearray(data)
+    modified[20_000] ^= 0xFF
+    fs.remove("/test_files/disk.img")
+    fs.create_file("/test_files/disk.img", contents=bytes(modified))
+    hm.add_file_version("/test_files/disk.img")
+
+    chunk_files_after = {p for p in Path("/storage/chunks").rglob("*") if p.is_file()}
+    assert 0 < len(chunk_files_after - chunk_files_before) <= 2
+
+    # Обе версии собираются обратно без искажений
+    versions = hm.get_versions_for_file(file_id)
+    restored = {v[2]: hm.get_object_path(v[2]).read_bytes() for v in versions}
+    assert restored[first_hash] == data
+    assert bytes(modified) in restored.values()
+
+    # Удаление первой версии не трогает блоки, которые использует вторая
+    first_version_id = [v[0] for v in versions if v[2] == first_hash][0]
+    hm.delete_file_version(first_version_id, file_id, first_hash)
+    second_hash = hm.get_versions_for_file(file_id)[0][2]
+    assert hm.get_object_path(second_hash).read_bytes() == bytes(modified)
+    assert not hm.object_store.contains(first_hash)
+
+
+def test_chunk_staging_checks_packed_chunks_in_batches(history_manager, fs, mocker):
+    """Тест: при нарезке упакованные блоки ищутся одним запросом на пачку и не записываются заново."""
+    from app.chunker import FastCDC
+    from app.object_store import ObjectStore
+
+    hm = history_manager
+    store = hm.object_store
+    mocker.patch.object(ObjectStore, 'CHUNKING_THRESHOLD', 4096)
+    mocker.patch.object(ObjectStore, 'PACK_HOT_AGE', -60)
+    store._chunker = FastCDC(min_size=256, avg_size=1024, max_size=4096)
+
+    data = bytes((i * 7919) % 251 for i in range(40_000))
+    fs.create_file("/test_files/disk.img", contents=data)
+    hm.add_file_version("/test_files/disk.img")
+    hm.repack_objects()
+    assert not [p for p in store.chunks_path.rglob("*") if p.is_file()]
+
+    modified = bytearray(data)
+    modified[20_000] ^= 0xFF
+    fs.remove("/test_files/disk.img")
+    fs.create_file("/test_files/disk.img", contents=bytes(modified))
+
+    pack_location = mocker.spy(store, "_get_pack_location")
+    packed_chunks = mocker.spy(store, "_get_packed_chunks")
+    staged = store.stage_file(Path("/test_files/disk.img"))
+
+    # Поблочных обращений к БД нет, а из упакованных блоков заново записаны только измененные
+    assert pack_location.call_count == 0
+    assert packed_chunks.call_count == 1
+    assert 0 < len(staged.new_chunks) <= 2
+    assert {p for p in store.chunks_path.rglob("*") if p.is_file()} == {
+        store._chunk_path(chunk_hash) for chunk_hash, _ in staged.new_chunks}
+    assert not store._in_flight_chunks
+
+    with hm._db_connection_lock:
+        store.commit_staged(staged)
+        hm._db_connection.commit()
+    with hm.open_object(staged.object_hash) as f:
+        assert f.read() == bytes(modified)
+
+
+def test_queued_large_file_is_read_outside_db_lock(history_manager, fs, mocker):
+    """Тест: событие наблюдателя сохраняется в фоновом потоке, а крупный файл читается без блокировки БД."""
+    from app.chunker import FastCDC
+    from app.object_store import ObjectStore
+
+    hm = history_manager
+    mocker.patch.object(ObjectStore, 'CHUNKING_THRESHOLD', 4096)
+    hm.object_store._chunker = FastCDC(min_size=256, avg_size=1024, max_size=4096)
+    fs.create_file("/test_files/disk.img", contents=bytes(range(256)) * 40)
+
+    lock_held_while_staging = []
+    original_stage_file = hm.object_store.stage_file
+    def stage_file(*args, **kwargs):
+        lock_held_while_staging.append(_is_db_lock_held(hm))
+        return original_stage_file(*args, **kwargs)
+    mocker.patch.object(hm.object_store, "stage_file", side_effect=stage_file)
+
+    hm.queue_file_version("/test_files/disk.img")
+    hm._version_executor.shutdown(wait=True)
+
+    assert lock_held_while_staging == [False]
+    file_id = hm.get_all_tracked_files()[0][0]
+    assert len(hm.get_versions_for_file(file_id)) == 1
+
+
+def test_text_versions_are_stored_as_delta_chain(history_manager, fs, mocker):
+    """Тест: версии текстового файла хранятся дельтами с периодическими полными версиями."""
+    from app.object_store import ObjectStore
+
+    hm = history_manager
+    mocker.patch.object(ObjectStore, 'DELTA_KEYFRAME_INTERVAL', 3)
+    file_path = "/test_files/data.csv"
+    read_chain = mocker.spy(hm.object_store, "_read_delta_chain")
+    contents = []
+    for i in range(5):
+        lines = [f"{n};row {n};{'edited' if n == i else 'value'}\n" for n in range(500)]
+        contents.append("".join(lines))
+        if i:
+            fs.remove(file_path)
+        fs.create_file(file_path, contents=contents[-1])
+        hm.add_file_version(file_path)
+
+    # Первая версия сохранена без базы и читается с диска один раз, базы следующих дельт берутся из кеша
+    assert read_chain.call_count == 1
+
+    file_id = hm.get_all_tracked_files()[0][0]
+    hashes = [v[2] for v in reversed(hm.get_versions_for_file(file_id))] # от старой к новой
+    assert len(hashes) == 5
+
+    # Версии 1 и 4 - опорные, остальные - дельты (интервал опорных версий = 3)
+    stored_as_delta = [hm.object_store._get_delta_info(h) is not None for h in hashes]
+    assert stored_as_delta == [False, True, True, False, True]
+
+    for sha256_hash, expected in zip(hashes, contents):
+        assert hm.get_object_path(sha256_hash).read_text() == expected
+
+    # Удаление опорной версии не удаляет объект, пока от него зависят дельты
+    versions = {v[2]: v[0] for v in hm.get_versions_for_file(file_id)}
+    hm.delete_file_version(versions[hashes[0]], file_id, hashes[0])
+    assert hm.object_store.contains(hashes[0])
+    assert hm.get_object_path(hashes[2]).read_text() == contents[2]
+
+    # Когда удалены все зависимые версии, освобождается и вся цепочка
+    hm.delete_file_version(versions[hashes[2]], file_id, hashes[2])
+    hm.delete_file_version(versions[hashes[1]], file_id, hashes[1])
+    assert not any(hm.object_store.contains(h) for h in hashes[:3])
+    assert hm.get_object_path(hashes[4]).read_text() == contents[4]
+
+
+def test_objects_are_compressed_and_recompressed_when_cold(history_manager, fs, mocker):
+    """Тест: объекты сжимаются, читаются прозрачно, а холодные пересжимаются сильнее."""
+    from datetime import timedelta
+    from app import compression
+
+    hm = history_manager
+    hm.set_compression_codec("zlib")
+    text = "".join(f"{i}: строка журнала с повторяющимся содержимым\n" for i in range(3000))
+    fs.create_file("/test_files/app.log", contents=text)
+    fs.create_file("/test_files/photo.jpg", contents=b"\xff\xd8\xff\xe0" + bytes(range(256)) * 20)
+    hm.add_file_version("/test_files/app.log")
+    hm.add_file_version("/test_files/photo.jpg")
+
+    log_id, photo_id = [f_id for f_id, _ in sorted(hm.get_all_tracked_files(), key=lambda f: f[1])]
+    log_hash = hm.get_versions_for_file(log_id)[0][2]
+    photo_hash = hm.get_versions_for_file(photo_id)[0][2]
+
+    stored_log = hm.object_store._loose_path(log_hash)
+    assert compression.read_header(stored_log) == (compression.CODEC_ZLIB, compression.FAST_LEVELS[compression.CODEC_ZLIB])
+    assert stored_log.stat().st_size < len(text.encode()) // 5
+    # Уже сжатый формат хранится как есть и доступен напрямую
+    assert hm.object_store.get_loose_path(photo_hash) is not None
+
+    # Прозрачное чтение: путь, поток и экспорт
+    assert hm.get_object_path(log_hash).read_text() == text
+    with hm.open_object(log_hash) as f:
+        assert f.read().decode() == text
+    hm.export_object(log_hash, Path("/test_files/restored.log"))
+    assert Path("/test_files/restored.log").read_text() == text
+    content_type, content = hm.get_file_content_for_preview(log_hash, ".log")
+    assert content_type == "text" and content == text[:1024 * 10]
+
+    # Объекты становятся "холодными" и пересжимаются максимальным уровнем
+    mocker.patch.object(hm, 'COLD_OBJECT_AGE', timedelta(seconds=-60))
+    assert hm.recompress_cold_objects() is not None
+    assert compression.read_header(stored_log) == (compression.CODEC_ZLIB, compression.MAX_LEVELS[compression.CODEC_ZLIB])
+    assert hm.get_object_path(log_hash).read_text() == text
+    # Повторный проход ничего не делает
+    assert hm.recompress_cold_objects() is None
+
+
+def test_small_objects_are_packed_and_compacted(history_manager, fs, mocker):
+    """Тест: небольшие объекты и блоки переносятся в пакет, читаются из него, а удаленные записи уплотняются."""
+    from app.chunker import FastCDC
+    from app.object_store import ObjectStore
+
+    hm = history_manager
+    store = hm.object_store
+    mocker.patch.object(ObjectStore, 'CHUNKING_THRESHOLD', 4096)
+    mocker.patch.object(ObjectStore, 'PACK_HOT_AGE', -60)
+    store._chunker = FastCDC(min_size=256, avg_size=1024, max_size=4096)
+
+    contents = {f"/test_files/note{i}.txt": f"заметка номер {i}\n" * (i + 1) for i in range(5)}
+    big_content = bytes(range(256)) * 64
+    contents["/test_files/big.bin"] = big_content
+    for path, content in contents.items():
+        fs.create_file(path, contents=content)
+        hm.add_file_version(path)
+
+    def read_all():
+        result = {}
+        for file_id, path in hm.get_all_tracked_files():
+            sha256_hash = hm.get_versions_for_file(file_id)[0][2]
+            with hm.open_object(sha256_hash) as f:
+                result[path] = f.read()
+        return result
+
+    expected = {path: (c.encode() if isinstance(c, str) else c) for path, c in contents.items()}
+    assert hm.repack_objects() is not None
+
+    # Отдельных файлов не осталось, все читается из одного пакета
+    loose_files = [p for root in (store.objects_path, store.chunks_path) for p in root.rglob("*") if p.is_file()]
+    assert loose_files == []
+    assert len(list(store.packs_path.glob("pack-*.pack"))) == 1
+    assert read_all() == expected
+    assert hm.get_object_path(hm.get_versions_for_file(1)[0][2]).read_bytes() == expected["/test_files/note0.txt"]
+
+    # Повторная упаковка ничего не делает
+    assert hm.repack_objects() is None
+
+    # Удаляем большую часть файлов: их записи становятся мусором, и пакет переписывается
+    files = {path: file_id for file_id, path in hm.get_all_tracked_files()}
+    doomed = {files["/test_files/big.bin"], files["/test_files/note3.txt"], files["/test_files/note4.txt"]}
+    hm.delete_tracked_files(doomed)
+    old_pack = next(store.packs_path.glob("pack-*.pack"))
+    old_pack_size = old_pack.stat().st_size
+    assert hm.repack_objects() is not None
+    packs = list(store.packs_path.glob("pack-*.pack"))
+    assert not old_pack.exists()
+    assert len(packs) == 1 and packs[0].stat().st_size < old_pack_size
+    remaining = {path: c for path, c in expected.items() if files[path] not in doomed}
+    assert read_all() == remaining
+
+    # Новая версия после упаковки снова пишется отдельным файлом и читается вместе с упакованными
+    fs.create_file("/test_files/new.txt", contents="fresh")
+    hm.add_file_version("/test_files/new.txt")
+    assert read_all() == dict(remaining, **{"/test_files/new.txt": b"fresh"})
+
+
+def test_ingestion_leaves_no_temporary_files(history_manager, fs):
+    """Тест: копия неизмененного файла отбрасывается, а в хранилище не остается временных файлов."""
+    import hashlib
+
+    hm = history_manager
+    fs.create_file("/test_files/data.bin", contents=b"payload" * 100)
+    hm.add_file_version("/test_files/data.bin")
+    hm.add_file_version("/test_files/data.bin") # Содержимое не изменилось
+
+    file_id = hm.get_all_tracked_files()[0][0]
+    versions = hm.get_versions_for_file(file_id)
+    assert len(versions) == 1
+    assert versions[0][2] == hashlib.sha256(b"payload" * 100).hexdigest()
+    assert versions[0][3] == 700
+    assert list(Path("/storage").rglob("*.tmp")) == []
+
+
+@pytest.mark.skipif(not file_io.available_clone_methods(), reason="Платформа не поддерживает копирование без чтения в память")
+def test_uncompressed_objects_are_cloned_on_supporting_volume(tmp_path, mocker):
+    """Тест: на реальной ФС объект без сжатия копируется клонированием/в ядре, а при отказе - обычным способом."""
+    mocker.patch('app.history_manager.QTimer')
+    hm = HistoryManager(storage_path=tmp_path / "storage")
+    try:
+        store = hm.object_store
+        if not store.clone_methods:
+            pytest.skip("Том не поддерживает ни FICLONE, ни copy_file_range")
+        hm.set_compression_codec("none")
+        clone_spy = mocker.spy(file_io, 'clone_file')
+
+        first = tmp_path / "photo.raw"
+        first.write_bytes(bytes(range(256)) * 1000)
+        hm.add_file_version(str(first))
+        assert clone_spy.call_count >= 1
+        sha256_hash = hm.get_versions_for_file(hm.get_all_tracked_files()[0][0])[0][2]
+        assert store.get_loose_path(sha256_hash).read_bytes() == first.read_bytes()
+
+        # Отказ клонирования (например, файл на другом томе): объект сохраняется обычным копированием
+        mocker.patch('app.object_store.file_io.clone_file', side_effect=OSError(errno.EXDEV, "cross-device"))
+        second = tmp_path / "other.raw"
+        second.write_bytes(b"other content" * 500)
+        hm.add_file_version(str(second))
+        assert os.stat(second).st_dev in store._clone_unsupported_devices
+        file_id = [f_id for f_id, path in hm.get_all_tracked_files() if path == str(second)][0]
+        with hm.open_object(hm.get_versions_for_file(file_id)[0][2]) as f:
+            assert f.read() == second.read_bytes()
+        assert list((tmp_path / "storage").rglob("*.tmp")) == []
+    finally:
+        hm.close()
+
+
+def test_storage_usage_counter_tracks_objects(history_manager, fs, mocker):
+    """Тест: счетчик объема хранилища совпадает с фактическим размером файлов после любых операций."""
+    from app.object_store import ObjectStore
+
+    hm = history_manager
+    store = hm.object_store
+    mocker.patch.object(ObjectStore, 'PACK_HOT_AGE', -60)
+    assert store.get_stored_bytes() == 0
+
+    for i in range(4):
+        fs.create_file(f"/test_files/file{i}.txt", contents=f"содержимое {i}\n" * 200 * (i + 1))
+        hm.add_file_version(f"/test_files/file{i}.txt")
+    assert store.get_stored_bytes() == store.measure_stored_bytes() > 0
+
+    hm.repack_objects()
+    assert store.get_stored_bytes() == store.measure_stored_bytes()
+
+    file_ids = {path: file_id for file_id, path in hm.get_all_tracked_files()}
+    hm.delete_tracked_files({file_ids["/test_files/file0.txt"], file_ids["/test_files/file3.txt"]})
+    hm.repack_objects()
+    assert store.get_stored_bytes() == store.measure_stored_bytes()
+
+    # Размер для индикатора берется из счетчика, без обхода папок
+    mocker.patch('app.history_manager.os.walk', side_effect=AssertionError("os.walk не должен вызываться"))
+    mocker.patch('app.history_manager.psutil.disk_usage', return_value=mocker.Mock(free=10 ** 9))
+    emitted = []
+    hm.storage_info_updated.connect(lambda *args: emitted.append(args))
+    hm.update_storage_info()
+    assert emitted and emitted[-1][1] != hm.tr("Н/Д")
+
+
+def test_storage_usage_reconciliation(history_manager, fs, mocker):
+    """Тест: фоновая сверка исправляет разошедшийся счетчик, но не чаще заданного интервала."""
+    from datetime import timedelta
+
+    hm = history_manager
+    store = hm.object_store
+    fs.create_file("/test_files/a.txt", contents="a" * 5000)
+    hm.add_file_version("/test_files/a.txt")
+    actual = store.measure_stored_bytes()
+
+    store.set_stored_bytes(123)
+    hm.reconcile_storage_usage()
+    assert store.get_stored_bytes() == actual
+
+    store.set_stored_bytes(456)
+    hm.reconcile_storage_usage() # Сверка недавно была - счетчик не трогаем
+    assert store.get_stored_bytes() == 456
+
+    mocker.patch.object(hm, 'STORAGE_RECONCILE_INTERVAL', timedelta(seconds=-1))
+    hm.reconcile_storage_usage()
+    assert store.get_stored_bytes() == actual
+
+
+def test_object_refcounts_follow_versions(history_manager, fs):
+    """Тест: таблица objects ведет счетчик ссылок, и объект удаляется, только когда ссылок не осталось."""
+    hm = history_manager
+    fs.create_file("/test_files/a.txt", contents="общее содержимое")
+    fs.create_file("/test_files/b.txt", contents="общее содержимое")
+    hm.add_file_version("/test_files/a.txt")
+    hm.add_file_version("/test_files/b.txt")
+
+    file_ids = {path: file_id for file_id, path in hm.get_all_tracked_files()}
+    shared_hash = hm.get_versions_for_file(file_ids["/test_files/a.txt"])[0][2]
+    cursor = hm._db_connection.cursor()
+    cursor.execute("SELECT size, refcount, stored_size, codec FROM objects WHERE hash = ?", (shared_hash,))
+    size, refcount, stored_size, codec = cursor.fetchone()
+    assert (size, refcount) == (len("общее содержимое".encode()), 2)
+    assert stored_size > 0 and codec is not None
+
+    hm.delete_tracked_files({file_ids["/test_files/a.txt"]})
+    cursor.execute("SELECT refcount FROM objects WHERE hash = ?", (shared_hash,))
+    assert cursor.fetchone()[0] == 1
+    assert hm.has_object(shared_hash)
+
+    version_id = hm.get_versions_for_file(file_ids["/test_files/b.txt"])[0][0]
+    assert hm.delete_file_version(version_id, file_ids["/test_files/b.txt"], shared_hash)
+    cursor.execute("SELECT 1 FROM objects WHERE hash = ?", (shared_hash,))
+    assert cursor.fetchone() is None
+    assert not hm.has_object(shared_hash)
+
+
+def test_objects_table_is_backfilled_for_existing_database(fs, mocker):
+    """Тест: для базы, созданной до появления таблицы objects, счетчики ссылок заполняются по версиям."""
+    mocker.patch('app.history_manager.QTimer')
+    mocker.patch('app.object_store.ObjectStore.probe_clone_support')
+    connection = sqlite3.connect(':memory:', check_same_thread=False)
+    connection.executescript("""
+        CREATE TABLE tracked_files (id INTEGER PRIMARY KEY, original_path TEXT NOT NULL UNIQUE);
+        CREATE TABLE versions (
+            id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL, timestamp TEXT NOT NULL,
+            sha256_hash TEXT NOT NULL, file_size INTEGER NOT NULL,
+            FOREIGN KEY (file_id) REFERENCES tracked_files (id) ON DELETE CASCADE);
+        INSERT INTO tracked_files VALUES (1, '/a.txt'), (2, '/b.txt');
+        INSERT INTO versions VALUES (1, 1, '2024-01-01T00:00:00', 'aa', 10), (2, 1, '2024-01-02T00:00:00', 'bb', 20),
+                                    (3, 2, '2024-01-03T00:00:00', 'aa', 10);
+    """)
+    mocker.patch('app.history_manager.sqlite3.connect', return_value=connection)
+    fs.create_dir("/storage")
+    HistoryManager(storage_path=Path("/storage"))
+
+    rows = connection.execute("SELECT hash, size, refcount FROM objects ORDER BY hash").fetchall()
+    assert rows == [('aa', 10, 2), ('bb', 20, 1)]
+    connection.close()
+
+
+def test_store_is_rekeyed_after_hash_algorithm_change(history_manager, fs, mocker):
+    """Тест: после смены алгоритма объекты, блоки и дельты переадресуются, а версии читаются без искажений."""
+    import hashlib
+    import types
+    from app import hashing
+    from app.chunker import FastCDC
+    from app.object_store import ObjectStore
+
+    hm = history_manager
+    mocker.patch.object(hashing, "blake3", types.SimpleNamespace(blake3=hashlib.sha3_256))
+    mocker.patch.object(ObjectStore, 'CHUNKING_THRESHOLD', 16384)
+    hm.object_store._chunker = FastCDC(min_size=256, avg_size=1024, max_size=4096)
+
+    big_data = bytes((i * 7919) % 251 for i in range(40_000))
+    fs.create_file("/test_files/disk.img", contents=big_data)
+    hm.add_file_version("/test_files/disk.img")
+    text_versions = ["".join("line {0} of version {1}\n".format(i, v if i == 5 else 0) for i in range(400)) for v in range(3)]
+    fs.create_file("/test_files/notes.txt", contents=text_versions[0])
+    for text in text_versions:
+        with open("/test_files/notes.txt", "w") as f:
+            f.write(text)
+        hm.add_file_version("/test_files/notes.txt")
+    assert hm._db_connection.execute("SELECT COUNT(*) FROM object_deltas").fetchone()[0] > 0
+
+    hm.set_hash_algorithm("blake3")
+    assert hm._db_connection.execute("SELECT value FROM store_properties WHERE name = 'hash_algorithm'").fetchone() == ("blake3",)
+    # Копия уже сохраненного содержимого под новым хешем: при переадресации объекты объединяются
+    fs.create_file("/test_files/copy.txt", contents=text_versions[0])
+    hm.add_file_version("/test_files/copy.txt")
+
+    assert hm.rekey_objects() is not None
+    assert hm.rekey_objects() is None
+
+    cursor = hm._db_connection.cursor()
+    cursor.execute("SELECT DISTINCT hash_algorithm FROM objects WHERE refcount > 0")
+    assert cursor.fetchall() == [("blake3",)]
+    cursor.execute("SELECT DISTINCT hash_algorithm FROM object_chunks")
+    assert cursor.fetchall() == [("blake3",)]
+    expected = {"/test_files/disk.img": [big_data], "/test_files/notes.txt": [t.encode() for t in text_versions],
+                "/test_files/copy.txt": [text_versions[0].encode()]}
+    for file_id, path in hm.get_all_tracked_files():
+        versions = hm.get_versions_for_file(file_id)
+        contents = []
+        for version in versions:
+            content = hm.get_object_path(version[2]).read_bytes()
+            assert version[2] == hashlib.sha3_256(content).hexdigest()
+            contents.append(content)
+        assert sorted(contents) == sorted(expected[path])
+    # Ссылки объединенного объекта перенесены, а старая копия удалена
+    cursor.execute("SELECT refcount FROM objects WHERE hash = ?", (hashlib.sha3_256(text_versions[0].encode()).hexdigest(),))
+    assert cursor.fetchone()[0] == 2
+    assert not hm.has_object(hashlib.sha256(text_versions[0].encode()).hexdigest())
+
+
+def test_unavailable_hash_algorithm_does_not_rekey_store(history_manager, fs, mocker):
+    """Тест: недоступный алгоритм из настроек не меняет алгоритм хранилища и не запускает переадресацию."""
+    import hashlib
+    import types
+    from PySide6.QtWidgets import QSystemTrayIcon
+    from app import hashing
+
+    hm = history_manager
+    mock_notification = mocker.Mock()
+    hm.history_notification.connect(mock_notification)
+    def warnings_count():
+        return sum(1 for call in mock_notification.call_args_list if call.args[1] == QSystemTrayIcon.Warning)
+    def store_property():
+        return hm._db_connection.execute("SELECT value FROM store_properties WHERE name = 'hash_algorithm'").fetchone()
+
+    # Хранилище на SHA-256, а blake3 не установлен: настройка не применяется
+    mocker.patch.object(hashing, "blake3", None)
+    fs.create_file("/test_files/a.txt", contents="первый файл")
+    hm.add_file_version("/test_files/a.txt")
+    hm.set_hash_algorithm("blake3")
+    assert warnings_count() == 1
+    assert store_property() is None
+    assert hm.object_store.hash_algorithm == "sha256"
+    hm.set_hash_algorithm("sha256")
+    assert warnings_count() == 1
+
+    # Хранилище на blake3, который пропал после перезапуска: объекты не переадресуются на SHA-256
+    mocker.patch.object(hashing, "blake3", types.SimpleNamespace(blake3=hashlib.sha3_256))
+    hm.set_hash_algorithm("blake3")
+    assert hm.rekey_objects() is not None
+    mocker.patch.object(hashing, "blake3", None)
+    hm._setup_object_store()
+    hm.set_hash_algorithm("blake3")
+    assert warnings_count() == 2
+    fs.create_file("/test_files/b.txt", contents="второй файл")
+    hm.add_file_version("/test_files/b.txt")
+    assert hm.rekey_objects() is None
+    assert store_property() == ("blake3",)
+    cursor = hm._db_connection.execute("SELECT hash_algorithm FROM objects ORDER BY hash_algorithm")
+    assert cursor.fetchall() == [("blake3",), ("sha256",)]
+
+
+def test_unchanged_large_file_is_detected_by_quick_hash(history_manager, fs, mocker):
+    """Тест: неизмененный большой файл распознается по быстрому хешу без повторной нарезки."""
+    import hashlib
+    import types
+    from app import hashing
+    from app.object_store import ObjectStore
+
+    hm = history_manager
+    mocker.patch.object(hashing, "xxhash", types.SimpleNamespace(xxh3_128=hashlib.md5))
+    mocker.patch.object(ObjectStore, 'CHUNKING_THRESHOLD', 4096)
+    fs.create_file("/test_files/disk.img", contents=b"x" * 10_000)
+    hm.add_file_version("/test_files/disk.img")
+
+    ingest = mocker.spy(hm.object_store, "ingest_file")
+    lock_held_while_hashing = []
+    original_matches_quick_hash = hm.object_store.matches_quick_hash
+    def matches_quick_hash(*args):
+        lock_held_while_hashing.append(_is_db_lock_held(hm))
+        return original_matches_quick_hash(*args)
+    mocker.patch.object(hm.object_store, "matches_quick_hash", side_effect=matches_quick_hash)
+    hm.add_file_version("/test_files/disk.img")
+    ingest.assert_not_called()
+    assert lock_held_while_hashing == [False] # Файл читается без блокировки БД
+
+    with open("/test_files/disk.img", "r+b") as f:
+        f.write(b"y")
+    hm.add_file_version("/test_files/disk.img")
+    ingest.assert_called_once()
+    assert len(hm.get_versions_for_file(hm.get_all_tracked_files()[0][0])) == 2
+
+
+def test_unchanged_fingerprint_skips_reading_file(history_manager, fs, mocker):
+    """Тест: событие для файла с прежним отпечатком не читает содержимое, а изменение mtime - читает."""
+    hm = history_manager
+    fs.create_file("/test_files/report.txt", contents="содержимое")
+    os.utime("/test_files/report.txt", (1_600_000_000, 1_600_000_000))
+    hm.add_file_version("/test_files/report.txt")
+    saved = hm._db_connection.execute("SELECT fp_size, fp_mtime_ns FROM tracked_files").fetchone()
+    assert saved == (len("содержимое".encode()), 1_600_000_000 * 10 ** 9)
+
+    ingest = mocker.spy(hm.object_store, "ingest_file")
+    hm.add_file_version("/test_files/report.txt")
+    ingest.assert_not_called()
+
+    # Тот же размер, но другое содержимое и mtime: файл читается, и сохраняется новая версия
+    with open("/test_files/report.txt", "w") as f:
+        f.write("СОДЕРЖИМОЕ")
+    os.utime("/test_files/report.txt", (1_600_000_100, 1_600_000_100))
+    hm.add_file_version("/test_files/report.txt")
+    ingest.assert_called_once()
+    assert len(hm.get_versions_for_file(hm.get_all_tracked_files()[0][0])) == 2
+
+
+def test_recently_modified_file_fingerprint_is_not_trusted(history_manager, fs):
+    """Тест: отпечаток только что измененного файла не сохраняется (mtime мог не успеть смениться)."""
+    hm = history_manager
+    fs.create_file("/test_files/fresh.txt", contents="данные")
+    hm.add_file_version("/test_files/fresh.txt")
+    assert hm._db_connection.execute("SELECT fp_mtime_ns FROM tracked_files").fetchone() == (None,)
+
+
+def test_scan_processes_files_in_parallel_without_duplicates(history_manager, fs, mocker):
+    """Тест: параллельное сканирование сохраняет все файлы, а одинаковые блоки записываются один раз."""
+    from app.chunker import FastCDC
+    from app.history_manager import ScanWorker
+    from app.object_store import ObjectStore
+
+    hm = history_manager
+    store = hm.object_store
+    mocker.patch.object(ObjectStore, 'CHUNKING_THRESHOLD', 16384)
+    store._chunker = FastCDC(min_size=256, avg_size=1024, max_size=4096)
+    mocker.patch.object(ScanWorker, 'PARALLEL_FILES', 4)
+    mocker.patch.object(ScanWorker, 'MAX_PENDING_FILES', 6)
+
+    big_data = bytes((i * 7919) % 251 for i in range(60_000))
+    expected = {}
+    for i in range(20):
+        path = f"/project/dir{i % 3}/file{i}.txt"
+        expected[path] = f"файл {i % 5}\n".encode() * (i + 1)
+    for i in range(4):
+        expected[f"/project/big{i}.img"] = big_data # Одинаковые большие файлы читаются одновременно
+    for path, content in expected.items():
+        fs.create_file(path, contents=content)
+
+    worker = ScanWorker(hm, [{"path": "/project", "type": "folder", "exclusions": []}])
+    worker.run()
+
+    tracked = {path: file_id for file_id, path in hm.get_all_tracked_files()}
+    assert set(tracked) == set(expected)
+    for path, file_id in tracked.items():
+        version_hash = hm.get_versions_for_file(file_id)[0][2]
+        assert hm.get_object_path(version_hash).read_bytes() == expected[path]
+    chunk_count = hm._db_connection.execute("SELECT COUNT(DISTINCT chunk_hash) FROM object_chunks").fetchone()[0]
+    assert len([p for p in Path("/storage/chunks").rglob("*") if p.is_file()]) == chunk_count
+    assert store.get_stored_bytes() == store.measure_stored_bytes()
+    assert not list(Path("/storage").rglob("*.tmp"))
+
+
+def test_stopped_scan_discards_staged_files(history_manager, fs, mocker):
+    """Тест: после остановки прочитанные, но не записанные в БД файлы отбрасываются."""
+    from app.history_manager import ScanWorker
+
+    hm = history_manager
+    for i in range(10):
+        fs.create_file(f"/project/file{i}.txt", contents=f"данные {i}")
+    worker = ScanWorker(hm, [{"path": "/project", "type": "folder", "exclusions": []}])
+    discard = mocker.spy(hm, 'discard_staged_version')
+    # Первый готовый файл останавливает сканирование вместо записи в БД
+    mocker.patch.object(hm, 'commit_initial_version',
+                        side_effect=lambda staged: (worker.stop(), hm.discard_staged_version(staged)))
+    worker.run()
+
+    assert hm.get_all_tracked_files() == []
+    assert discard.call_count >= 1
+    assert not list(Path("/storage").rglob("*.tmp"))
+
+
+def test_discarded_chunked_files_leave_no_orphan_chunks(history_manager, fs, mocker):
+    """Тест: блоки отброшенного крупного файла удаляются, а забытые блоки собирает обслуживание."""
+    from app.chunker import FastCDC
+    from app.history_manager import ScanWorker
+    from app.object_store import ObjectStore
+
+    hm = history_manager
+    mocker.patch.object(ObjectStore, 'CHUNKING_THRESHOLD', 4096)
+    hm.object_store._chunker = FastCDC(min_size=256, avg_size=1024, max_size=4096)
+    for i in range(3):
+        fs.create_file(f"/project/disk{i}.img", contents=bytes((n * (i + 3)) % 251 for n in range(20_000)))
+    worker = ScanWorker(hm, [{"path": "/project", "type": "folder", "exclusions": []}])
+    mocker.patch.object(hm, 'commit_initial_version',
+                        side_effect=lambda staged: (worker.stop(), hm.discard_staged_version(staged)))
+    worker.run()
+
+    assert hm.get_all_tracked_files() == []
+    assert not [p for p in Path("/storage/chunks").rglob("*") if p.is_file()]
+    assert hm.object_store.get_stored_bytes() == hm.object_store.measure_stored_bytes() == 0
+
+    # Блок без ссылок (например, после сбоя) удаляется, когда становится достаточно старым
+    fs.create_file("/storage/chunks/ab/" + "c" * 62, contents=b"orphan")
+    assert hm.remove_orphan_chunks() is None # Свежий блок может сейчас публиковаться
+    os.utime("/storage/chunks/ab/" + "c" * 62, (1_600_000_000, 1_600_000_000))
+    assert hm.remove_orphan_chunks() is not None
+    assert not Path("/storage/chunks/ab").exists()
+
+
+def test_rescan_skips_tracked_files_without_per_file_queries(history_manager, fs, mocker):
+    """Тест: отслеживаемые пути элемента загружаются одним запросом, и повторное сканирование их не читает."""
+    from app.history_manager import ScanWorker
+
+    hm = history_manager
+    for i in range(5):
+        fs.create_file(f"/project/src/file{i}.txt", contents=f"данные {i}")
+    fs.create_file("/project.txt", contents="рядом с папкой")
+    fs.create_file("/projects/other.txt", contents="соседняя папка")
+    hm.add_file_version("/project.txt")
+    hm.add_file_version("/projects/other.txt")
+    ScanWorker(hm, [{"path": "/project", "type": "folder", "exclusions": []}]).run()
+
+    assert hm.get_tracked_paths_under(Path("/project")) == {f"/project/src/file{i}.txt" for i in range(5)}
+    assert hm.get_tracked_paths_under(Path("/project.txt")) == {"/project.txt"}
+
+    fs.create_file("/project/src/new.txt", contents="новый файл")
+    stage = mocker.spy(hm, "stage_initial_version")
+    ScanWorker(hm, [{"path": "/project", "type": "folder", "exclusions": []}]).run()
+    assert [c.args[0] for c in stage.call_args_list] == ["/project/src/new.txt"]
+
+
+def test_scan_progress_is_reported_as_throttled_snapshots(history_manager, fs, mocker):
+    """Тест: ход сканирования публикуется редкими снимками с итогами, а не сигналом на каждый файл."""
+    from app.history_manager import ScanWorker
+
+    hm = history_manager
+    for i in range(30):
+        fs.create_file(f"/project/dir{i % 4}/file{i}.txt", contents="x" * (i + 1))
+    # Отпечаток давно измененного файла надежен: повторное сканирование его не читает
+    os.utime("/project/dir0/file0.txt", (1_600_000_000, 1_600_000_000))
+    hm.add_file_version("/project/dir0/file0.txt")
+
+    mocker.patch.object(ScanWorker, 'PROGRESS_INTERVAL_S', 3600)
+    worker = ScanWorker(hm, [{"path": "/project", "type": "folder", "exclusions": []}], count_files_first=True)
+    snapshots = []
+    worker.progress.connect(snapshots.append)
+    worker.run()
+
+    # Промежуточные снимки подавлены интервалом, остается только итоговый
+    assert len(snapshots) == 1
+    final = snapshots[0]
+    assert (final.files_done, final.files_total) == (30, 30)
+    assert final.bytes_done == sum(i + 1 for i in range(1, 30)) # Уже отслеживаемый файл не читается
+    assert final.eta_seconds == 0
+
+    # Без предварительного подсчета общее число оценивается по предыдущему сканированию, без обхода
+    walk = mocker.spy(ScanWorker, "_count_files")
+    worker = ScanWorker(hm, [{"path": "/project", "type": "folder", "exclusions": []}])
+    snapshots.clear()
+    worker.progress.connect(snapshots.append)
+    worker.run()
+    walk.assert_not_called()
+    assert [(s.files_done, s.files_total, s.eta_seconds) for s in snapshots] == [(30, 30, 0)]
+
+    # У папки без истории общее число неизвестно, и оставшееся время не оценивается
+    fs.create_file("/other/file.txt", contents="x")
+    worker = ScanWorker(hm, [{"path": "/other", "type": "folder", "exclusions": []}])
+    snapshots.clear()
+    worker.progress.connect(snapshots.append)
+    worker.run()
+    assert [(s.files_done, s.files_total, s.eta_seconds) for s in snapshots] == [(1, 0, None)]
+
+
+def test_scan_progress_text_contains_rate_and_eta(history_manager):
+    """Тест: текст снимка содержит число файлов, скорость и оставшееся время."""
+    from app.history_manager import ScanProgress
+
+    text = history_manager.format_scan_progress(ScanProgress(150, 600, 3 * 1024 ** 2, 50.0, 1024 ** 2, 9.0, "a.txt"))
+    assert text == "Просканировано 150 из 600 файлов (50 файл/с, 1.0 MB/с), осталось ~9 с"
+    text = history_manager.format_scan_progress(ScanProgress(150, 0, 0, 50.0, 0.0, None, "a.txt"))
+    assert text == "Просканировано 150 файлов (50 файл/с, 0 B/с)"
+
+
+def test_interrupted_scan_resumes_from_checkpoint(history_manager, fs, mocker):
+    """Тест: прерванное сканирование продолжается после последней полностью записанной папки."""
+    from app import scanner
+    from app.history_manager import ScanWorker
+
+    hm = history_manager
+    for d in range(6):
+        for f in range(3):
+            fs.create_file(f"/project/d{d}/file{f}.txt", contents=f"данные {d} {f}")
+    items = [{"path": "/project", "type": "folder", "exclusions": []}]
+    mocker.patch.object(ScanWorker, 'PARALLEL_FILES', 1)
+    mocker.patch.object(ScanWorker, 'MAX_PENDING_FILES', 1)
+    mocker.patch.object(ScanWorker, 'CHECKPOINT_INTERVAL_S', 0)
+
+    worker = ScanWorker(hm, items)
+    commit = hm.commit_initial_version
+    committed = []
+    def commit_then_stop(staged_version):
+        commit(staged_version)
+        committed.append(staged_version)
+        if len(committed) == 7: # Записаны d0, d1 и один файл из d2
+            worker.stop()
+    mocker.patch.object(hm, 'commit_initial_version', side_effect=commit_then_stop)
+    worker.run()
+    assert hm.get_scan_checkpoint("/project", "") == "/project/d1"
+    assert hm.get_scan_checkpoint("/project", "/project/d5") is None # Другие правила - обход с начала
+
+    mocker.patch.object(hm, 'commit_initial_version', side_effect=commit)
+    walk = mocker.spy(scanner, "walk_files")
+    ScanWorker(hm, items).run()
+    assert walk.call_args_list[-1].args[3] == "/project/d1"
+    assert len(hm.get_all_tracked_files()) == 18
+    row = hm._db_connection.execute("SELECT generation, last_directory FROM scan_checkpoints").fetchone()
+    assert row == (1, None)
+
+
+def test_items_on_different_devices_are_scanned_concurrently(history_manager, fs, mocker):
+    """Тест: папки на разных устройствах сканируются одновременно, каждая своей дорожкой."""
+    import threading
+    from app.history_manager import ScanWorker
+
+    hm = history_manager
+    fs.add_mount_point("/ssd")
+    fs.add_mount_point("/usb")
+    for i in range(3):
+        fs.create_file(f"/ssd/docs/file{i}.txt", contents=f"ssd {i}")
+        fs.create_file(f"/usb/photos/file{i}.txt", contents=f"usb {i}")
+    fs.create_file("/ssd/notes.txt", contents="заметки")
+    items = [{"path": "/ssd/docs", "type": "folder", "exclusions": []},
+             {"path": "/usb/photos", "type": "folder", "exclusions": []},
+             {"path": "/ssd/notes.txt", "type": "file"}]
+    groups = ScanWorker._group_by_device(items)
+    assert [[item["path"] for item in group] for group in groups] == [["/ssd/docs", "/ssd/notes.txt"], ["/usb/photos"]]
+
+    # Первые файлы обеих дорожек дожидаются друг друга: при последовательном сканировании барьер не пройти
+    barrier = threading.Barrier(2, timeout=5)
+    stage = hm.stage_initial_version
+    def stage_together(file_path_str, *args):
+        if file_path_str.endswith("file0.txt"):
+            barrier.wait()
+        return stage(file_path_str, *args)
+    mocker.patch.object(hm, 'stage_initial_version', side_effect=stage_together)
+    mocker.patch.object(ScanWorker, 'PARALLEL_FILES', 2)
+
+    ScanWorker(hm, items).run()
+    tracked = {path for _, path in hm.get_all_tracked_files()}
+    assert tracked == {f"/ssd/docs/file{i}.txt" for i in range(3)} | {f"/usb/photos/file{i}.txt" for i in range(3)} | {"/ssd/notes.txt"}
+
+
+def test_hash_baseline_stores_content_only_after_first_change(history_manager, fs, mocker):
+    """Тест: в режиме "hash" сканирование запоминает только хеш, а содержимое сохраняется при изменении."""
+    from app.history_manager import ScanWorker
+
+    hm = history_manager
+    fs.create_file("/project/a.txt", contents="исходный текст")
+    fs.create_file("/project/b.txt", contents="другой файл")
+    ScanWorker(hm, [{"path": "/project", "type": "folder", "exclusions": [], "baseline": "hash"}]).run()
+
+    assert hm.get_all_tracked_files() == [] # В истории пока нечего восстанавливать
+    assert hm.get_tracked_paths_under(Path("/project")) == {"/project/a.txt", "/project/b.txt"}
+    assert hm._db_connection.execute("SELECT COUNT(*) FROM objects").fetchone()[0] == 0
+
+    # Событие без изменения содержимого: хеш совпадает с базовым, содержимое не копируется
+    ingest = mocker.spy(hm.object_store, "ingest_file")
+    lock_held_while_hashing = []
+    original_hash_file = hm._hash_file
+    def hash_file(file_path):
+        lock_held_while_hashing.append(_is_db_lock_held(hm))
+        return original_hash_file(file_path)
+    mocker.patch.object(hm, "_hash_file", side_effect=hash_file)
+    os.utime("/project/a.txt", (1_600_000_000, 1_600_000_000))
+    hm.add_file_version("/project/a.txt")
+    ingest.assert_not_called()
+    assert lock_held_while_hashing == [False] # Файл читается без блокировки БД
+
+    with open("/project/a.txt", "w", encoding="utf-8") as f:
+        f.write("измененный текст")
+    file_list_updates = []
+    hm.file_list_updated.connect(lambda: file_list_updates.append(True))
+    hm.add_file_version("/project/a.txt")
+    assert [path for _, path in hm.get_all_tracked_files()] == ["/project/a.txt"]
+    assert file_list_updates == [True] # Файл впервые появляется в истории
+    version_hash = hm.get_versions_for_file(hm.get_all_tracked_files()[0][0])[0][2]
+    assert hm.get_object_path(version_hash).read_text(encoding="utf-8") == "измененный текст"
+
+
+def test_background_baseline_is_captured_by_maintenance(history_manager, fs, mocker):
+    """Тест: в режиме "background" содержимое сохраняется фоновой задачей порциями."""
+    from app.history_manager import HistoryManager, ScanWorker
+
+    hm = history_manager
+    for i in range(3):
+        fs.create_file(f"/project/file{i}.txt", contents=f"данные {i}")
+    fs.create_file("/project/gone.txt", contents="будет удален")
+    ScanWorker(hm, [{"path": "/project", "type": "folder", "exclusions": [], "baseline": "background"}]).run()
+    assert hm.get_all_tracked_files() == []
+    os.remove("/project/gone.txt")
+
+    mocker.patch.object(HistoryManager, 'BASELINE_CAPTURE_BATCH_FILES', 2)
+    lock_held_while_staging = []
+    original_stage_file = hm.object_store.stage_file
+    def stage_file(*args, **kwargs):
+        lock_held_while_staging.append(_is_db_lock_held(hm))
+        return original_stage_file(*args, **kwargs)
+    mocker.patch.object(hm.object_store, "stage_file", side_effect=stage_file)
+    assert hm.capture_baselines() is not None
+    assert hm.capture_baselines() is not None
+    assert hm.capture_baselines() is None # Захватывать больше нечего
+    assert lock_held_while_staging == [False] * 3 # Содержимое читается без блокировки БД
+
+    tracked = {path: file_id for file_id, path in hm.get_all_tracked_files()}
+    assert set(tracked) == {f"/project/file{i}.txt" for i in range(3)}
+    for i in range(3):
+        version_hash = hm.get_versions_for_file(tracked[f"/project/file{i}.txt"])[0][2]
+        assert hm.get_object_path(version_hash).read_text(encoding="utf-8") == f"данные {i}"
+    assert hm._db_connection.execute("SELECT SUM(capture_pending) FROM tracked_files").fetchone()[0] == 0
+
+
+def test_background_capture_discards_file_saved_while_reading(history_manager, fs, mocker):
+    """Тест: если версию файла сохранили, пока фоновый захват его читал, прочитанная копия отбрасывается."""
+    from app.history_manager import ScanWorker
+
+    hm = history_manager
+    fs.create_file("/project/file.txt", contents="исходное содержимое")
+    ScanWorker(hm, [{"path": "/project", "type": "folder", "exclusions": [], "baseline": "background"}]).run()
+
+    original_stage_file = hm.object_store.stage_file
+    def stage_file(*args, **kwargs):
+        staged = original_stage_file(*args, **kwargs)
+        if stage_file_mock.call_count == 1:
+            hm.add_file_version("/project/file.txt") # Событие наблюдателя во время чтения
+        return staged
+    stage_file_mock = mocker.patch.object(hm.object_store, "stage_file", side_effect=stage_file)
+    discard = mocker.spy(hm.object_store, "discard_staged")
+    assert hm.capture_baselines() is None
+
+    discard.assert_called_once()
+    assert len(hm.get_versions_for_file(hm.get_all_tracked_files()[0][0])) == 1
+    assert not list(Path("/storage").rglob("*.tmp"))
+
+
+def test_rescan_captures_offline_changes_and_skips_unchanged_directories(history_manager, fs, mocker):
+    """Тест: повторное сканирование сохраняет правки, сделанные без приложения, и не читает неизмененные папки."""
+    from app import scanner
+    from app.history_manager import ScanWorker
+
+    hm = history_manager
+    old_time = (1_600_000_000, 1_600_000_000)
+    for d in range(3):
+        for f in range(2):
+            fs.create_file(f"/project/d{d}/file{f}.txt", contents=f"данные {d} {f}")
+            os.utime(f"/project/d{d}/file{f}.txt", old_time)
+        os.utime(f"/project/d{d}", old_time)
+    os.utime("/project", old_time)
+    items = [{"path": "/project", "type": "folder", "exclusions": []}]
+    ScanWorker(hm, items).run()
+    assert hm._db_connection.execute("SELECT COUNT(*) FROM dir_index").fetchone()[0] == 4
+
+    # Правка на месте не меняет mtime папки, новый файл - меняет
+    with open("/project/d1/file0.txt", "w", encoding="utf-8") as f:
+        f.write("правка без приложения")
+    os.utime("/project/d1/file0.txt", (1_600_000_500, 1_600_000_500))
+    os.utime("/project/d1", old_time)
+    fs.create_file("/project/d2/new.txt", contents="новый файл")
+    os.utime("/project/d2/new.txt", old_time)
+    os.utime("/project/d2", (1_600_000_600, 1_600_000_600))
+
+    scandir = mocker.spy(scanner.os, "scandir")
+    ingest = mocker.spy(hm.object_store, "ingest_file")
+    ScanWorker(hm, items).run()
+    assert {c.args[0] for c in scandir.call_args_list} == {"/project/d2"}
+    assert [c.args[0] for c in ingest.call_args_list] == [Path("/project/d1/file0.txt")] # Остальные файлы не читаются
+    tracked = {path: file_id for file_id, path in hm.get_all_tracked_files()}
+    assert "/project/d2/new.txt" in tracked
+    versions = hm.get_versions_for_file(tracked["/project/d1/file0.txt"])
+    assert len(versions) == 2
+    assert hm.get_object_path(versions[0][2]).read_text(encoding="utf-8") == "правка без приложения"
+
+    # На неизмененном дереве ни одна папка не читается
+    scandir.reset_mock()
+    ScanWorker(hm, items).run()
+    assert scandir.call_count == 0
+
+
+def test_export_replaces_target_atomically_and_keeps_version_mtime(history_manager, fs, mocker):
+    """Тест: версия подменяет файл целиком с временем версии, а ошибка записи оставляет файл нетронутым."""
+    hm = history_manager
+    fs.create_file("/test_files/report.txt", contents="старое содержимое")
+    hm.add_file_version("/test_files/report.txt")
+    version_hash = hm.get_versions_for_file(hm.get_all_tracked_files()[0][0])[0][2]
+    with open("/test_files/report.txt", "w", encoding="utf-8") as f:
+        f.write("текущее содержимое")
+
+    original_copy_stream = file_io.copy_stream
+    copy_stream = mocker.patch.object(file_io, "copy_stream", side_effect=OSError("диск заполнен"))
+    with pytest.raises(OSError):
+        hm.export_object(version_hash, Path("/test_files/report.txt"), 1_600_000_000)
+    assert Path("/test_files/report.txt").read_text(encoding="utf-8") == "текущее содержимое"
+    assert os.listdir("/test_files") == ["report.txt"] # Временный файл удален
+
+    copy_stream.side_effect = original_copy_stream
+    assert hm.export_object(version_hash, Path("/test_files/report.txt"), 1_600_000_000)
+    assert Path("/test_files/report.txt").read_text(encoding="utf-8") == "старое содержимое"
+    assert os.stat("/test_files/report.txt").st_mtime == 1_600_000_000
+    assert not hm.export_object("0" * 64, Path("/test_files/missing.txt"))
+    assert not Path("/test_files/missing.txt").exists()
+
+
+def test_rescan_reconciles_changed_files_in_read_pool(history_manager, fs, mocker):
+    """Тест: сверка отслеживаемых файлов идет через пул чтения, с одним уведомлением на сканирование."""
+    from app.history_manager import ScanWorker
+
+    hm = history_manager
+    old_time = (1_600_000_000, 1_600_000_000)
+    for i in range(4):
+        fs.create_file(f"/project/file{i}.bin", contents=f"данные {i}")
+        os.utime(f"/project/file{i}.bin", old_time)
+    items = [{"path": "/project", "type": "folder", "exclusions": []}]
+    ScanWorker(hm, items).run()
+
+    # Два файла изменены без приложения, у двух изменился только mtime
+    for i in range(2):
+        with open(f"/project/file{i}.bin", "w", encoding="utf-8") as f:
+            f.write(f"правка {i}")
+    for i in range(4):
+        os.utime(f"/project/file{i}.bin", (1_600_000_100, 1_600_000_100))
+
+    add_file_version = mocker.spy(hm, "add_file_version")
+    stage = mocker.spy(hm, "stage_changed_version")
+    notifications = []
+    worker = ScanWorker(hm, items)
+    worker.scan_notification.connect(lambda message, icon: notifications.append(message))
+    worker.run()
+
+    add_file_version.assert_not_called()
+    assert stage.call_count == 4
+    tracked = {path: file_id for file_id, path in hm.get_all_tracked_files()}
+    assert [len(hm.get_versions_for_file(tracked[f"/project/file{i}.bin"])) for i in range(4)] == [2, 2, 1, 1]
+    assert [m for m in notifications if "измененных вне приложения" in m] == [
+        "Сохранены новые версии файлов, измененных вне приложения: 2"
+    ]
+
+    # Отпечатки записаны: следующее сканирование ничего не читает
+    stage.reset_mock()
+    ScanWorker(hm, items).run()
+    stage.assert_not_called()
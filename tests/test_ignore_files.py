@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+# Тесты для файлов .gitignore и .ignore
+from app.ignore_files import IgnoreFile, IgnoreMatcher, parse_ignore_lines
+
+
+def test_rules_follow_git_semantics():
+    """Тест: последнее подходящее правило решает, "/" привязывает к папке, "/" на конце - только папки."""
+    ignore_file = IgnoreFile(parse_ignore_lines([
+        "# комментарий", "", "*.log", "!keep.log", "/dist", "cache/", "docs/**/*.pdf", "\\#notes", "trailing   ",
+    ]))
+    assert ignore_file.match("debug.log") is True
+    assert ignore_file.match("src/keep.log") is False
+    assert ignore_file.match("dist") is True
+    assert ignore_file.match("src/dist") is None
+    assert ignore_file.match("cache/") is True
+    assert ignore_file.match("cache") is None
+    assert ignore_file.match("docs/a/b/manual.pdf") is True
+    assert ignore_file.match("#notes") is True
+    assert ignore_file.match("trailing") is True
+
+
+def test_nested_ignore_files_and_ignored_directories(fs):
+    """Тест: правила вложенного файла важнее, а содержимое игнорируемой папки нельзя вернуть через "!"."""
+    fs.create_file("/repo/.gitignore", contents="build/\n*.tmp\n!important.tmp\n")
+    fs.create_file("/repo/sub/.ignore", contents="*.txt\n!build/\n")
+    matcher = IgnoreMatcher("/repo")
+
+    assert matcher.is_ignored(["build", "out.o"])
+    assert matcher.is_ignored(["a.tmp"])
+    assert not matcher.is_ignored(["important.tmp"])
+    assert matcher.is_ignored(["sub", "notes.txt"])
+    assert not matcher.is_ignored(["notes.txt"])
+    assert not matcher.is_ignored(["sub", "build", "out.o"]) # Вложенный файл отменил правило для своей папки
+    assert matcher.is_ignored([".git", "HEAD"])
+
+    fs.remove_object("/repo/sub/.ignore")
+    assert matcher.is_ignored(["sub", "notes.txt"]) # Правила кешированы до сброса
+    matcher.invalidate(("sub",))
+    assert not matcher.is_ignored(["sub", "notes.txt"])
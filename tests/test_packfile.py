@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Тесты для формата пакетных файлов хранилища
+import hashlib
+import io
+
+from app import compression, packfile
+
+
+def _hash(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def test_written_entries_are_read_back(tmp_path):
+    """Тест: записи пакета читаются по смещению и длине, а пакет появляется только после close()."""
+    writer = packfile.PackWriter(tmp_path)
+    first, second = b"first object", b"second object" * 100
+    first_location = writer.add(0, _hash(first), first)
+    second_location = writer.add(1, _hash(second), second)
+    assert not writer.path.exists()
+    writer.close()
+
+    assert packfile.is_pack_name(writer.name)
+    assert writer.path.stat().st_size == writer.size
+    assert not list(tmp_path.glob("*.tmp"))
+    with packfile.open_entry(writer.path, *first_location) as f:
+        assert f.read() == first
+    with packfile.open_entry(writer.path, *second_location) as f:
+        assert f.read(5) == second[:5]
+        f.seek(0)
+        assert f.read() == second
+    with open(writer.path, "rb") as pack_file:
+        assert packfile.read_entry(pack_file, *second_location) == second
+
+
+def test_compressed_entry_is_decoded_transparently(tmp_path):
+    """Тест: сжатая запись пакета распаковывается через compression.open_decoded."""
+    data = b"log line\n" * 1000
+    encoded = io.BytesIO()
+    encoder = compression.EncodingWriter(encoded, compression.CODEC_ZLIB)
+    encoder.write(data)
+    encoder.finish()
+
+    writer = packfile.PackWriter(tmp_path)
+    writer.add(0, _hash(b"padding"), b"padding")
+    location = writer.add(0, _hash(data), encoded.getvalue())
+    writer.close()
+    with compression.open_decoded(packfile.open_entry(writer.path, *location)) as f:
+        assert f.read() == data
+
+
+def test_abort_leaves_no_files(tmp_path):
+    """Тест: отмененный пакет не оставляет файлов."""
+    writer = packfile.PackWriter(tmp_path)
+    writer.add(0, _hash(b"x"), b"x")
+    writer.abort()
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+# Тесты для шаблонов исключения и включения путей
+from app.path_patterns import PathPatterns, pattern_error
+
+
+def test_glob_patterns_match_names_and_anchored_paths():
+    """Тест: глоб без "/" совпадает с именем на любом уровне, с "/" - с путем от корня папки, вместе с содержимым."""
+    patterns = PathPatterns(exclude=["node_modules", "*.tmp", "~$*.docx", ".git/objects", "build/**/*.o", "cache/"])
+    assert patterns.is_excluded("node_modules/")
+    assert patterns.is_excluded("web/node_modules/react/index.js")
+    assert patterns.is_excluded("notes/draft.tmp")
+    assert patterns.is_excluded("~$report.docx")
+    assert patterns.is_excluded(".git/objects/ab/cdef")
+    assert patterns.is_excluded("build/x/y/main.o")
+    assert patterns.is_excluded("cache/")
+    assert patterns.is_excluded("a/cache/data.bin")
+
+    assert not patterns.is_excluded("node_modules_backup/readme.md")
+    assert not patterns.is_excluded("notes/draft.tmp.txt")
+    assert not patterns.is_excluded("src/.git/objects/ab") # Путь с "/" привязан к корню папки
+    assert not patterns.is_excluded(".git/config")
+    assert not patterns.is_excluded("cache") # "cache/" относится только к папкам
+    assert not patterns.is_excluded("src/build/main.o")
+
+
+def test_include_and_regex_patterns():
+    """Тест: шаблоны включения ограничивают отслеживаемые файлы, а исключения имеют приоритет."""
+    patterns = PathPatterns(exclude=[r"re:.*\.(log|bak)"], include=["*.py", "docs"])
+    assert patterns.is_file_watched("src/app/main.py")
+    assert patterns.is_file_watched("docs/guide/index.md")
+    assert not patterns.is_file_watched("src/app/data.json")
+    assert not patterns.is_file_watched("docs/debug.log")
+    assert PathPatterns.from_item({"path": "/p", "type": "folder", "exclusions": []}) is None
+
+    assert pattern_error("*.py") is None
+    assert pattern_error("re:(unclosed") is not None
+    assert pattern_error("/") is not None
@@ -0,0 +1,135 @@
+# -*- coding: utf-8 -*-
+# Тесты для обхода отслеживаемых папок
+import os
+
+import pytest
+
+from app import scanner
+from app.ignore_files import IgnoreMatcher
+from app.path_patterns import PathPatterns
+
+
+@pytest.fixture
+def tree(tmp_path):
+    """Дерево папок с исключаемой папкой, ссылками и специальным файлом."""
+    root = tmp_path / "project"
+    (root / "src" / "deep").mkdir(parents=True)
+    (root / "build").mkdir()
+    (root / "src" / "main.py").write_text("print()")
+    (root / "src" / "deep" / "data.bin").write_bytes(b"\x00" * 10)
+    (root / "build" / "out.o").write_bytes(b"obj")
+    (root / "readme.md").write_text("readme")
+    os.symlink(root, root / "src" / "loop") # Ссылка на предка: обход не должен зациклиться
+    os.symlink(root / "readme.md", root / "readme-link.md")
+    if hasattr(os, "mkfifo"):
+        os.mkfifo(root / "pipe")
+    return root
+
+
+def _walk(root, exclusions=()):
+    keys = scanner.build_exclusion_keys(str(root), [str(e) for e in exclusions])
+    return {os.path.relpath(path, root): file_stat for path, file_stat in scanner.walk_files(str(root), keys)}
+
+
+def test_walk_yields_regular_files_with_stat(tree):
+    """Тест: отдаются обычные файлы (в том числе через ссылку на файл) вместе с их stat."""
+    found = _walk(tree)
+    expected = {os.path.join("src", "main.py"), os.path.join("src", "deep", "data.bin"),
+                os.path.join("build", "out.o"), "readme.md", "readme-link.md"}
+    assert set(found) == expected
+    assert found[os.path.join("src", "deep", "data.bin")].st_size == 10
+
+
+def test_excluded_directories_are_not_entered(tree):
+    """Тест: исключенная папка не обходится."""
+    found = _walk(tree, [tree / "build"])
+    assert os.path.join("build", "out.o") not in found
+    assert os.path.join("src", "main.py") in found
+
+
+def test_exclusions_match_through_symlinked_root(tree, tmp_path):
+    """Тест: исключение, заданное реальным путем, действует и при обходе через ссылку на корень."""
+    link_root = tmp_path / "project-link"
+    os.symlink(tree, link_root)
+    found = _walk(link_root, [tree / "src"])
+    assert set(found) == {os.path.join("build", "out.o"), "readme.md", "readme-link.md"}
+
+
+def test_pattern_excluded_directories_are_not_read(tree, mocker):
+    """Тест: папка, исключенная шаблоном, не читается, а файлы фильтруются шаблонами исключения и включения."""
+    scandir_spy = mocker.spy(scanner.os, "scandir")
+    keys = scanner.build_exclusion_keys(str(tree), [])
+    patterns = PathPatterns(exclude=["build", "*.bin"], include=["*.py", "*.o", "*.bin"])
+    found = {os.path.relpath(p, tree) for p, _ in scanner.walk_files(str(tree), keys, patterns=patterns)}
+    assert found == {os.path.join("src", "main.py")}
+    assert str(tree / "build") not in [str(c.args[0]) for c in scandir_spy.call_args_list]
+
+
+def test_ignored_directories_are_not_read_and_rules_follow_edits(tree, mocker):
+    """Тест: папки из .gitignore не читаются, а измененный игнор-файл перечитывается при следующем обходе."""
+    (tree / ".gitignore").write_text("build/\n")
+    (tree / "src" / ".ignore").write_text("*.py\n")
+    scandir_spy = mocker.spy(scanner.os, "scandir")
+    keys = scanner.build_exclusion_keys(str(tree), [])
+    ignore = IgnoreMatcher(str(tree))
+
+    def walk():
+        return {os.path.relpath(p, tree) for p, _ in scanner.walk_files(str(tree), keys, ignore=ignore)}
+
+    assert walk() == {".gitignore", os.path.join("src", ".ignore"), os.path.join("src", "deep", "data.bin"),
+                      "readme.md", "readme-link.md"}
+    assert str(tree / "build") not in [str(c.args[0]) for c in scandir_spy.call_args_list]
+
+    (tree / "src" / ".ignore").write_text("deep/\n")
+    os.utime(tree / "src" / ".ignore", ns=(1, 1))
+    found = walk()
+    assert os.path.join("src", "main.py") in found
+    assert os.path.join("src", "deep", "data.bin") not in found
+
+
+def test_walk_can_be_stopped(tree):
+    """Тест: обход прекращается по запросу."""
+    keys = scanner.build_exclusion_keys(str(tree), [])
+    assert list(scanner.walk_files(str(tree), keys, lambda: True)) == []
+
+
+def test_walk_resumes_after_checkpoint_directory(tmp_path, mocker):
+    """Тест: папки обходятся по имени, а обход с resume_after продолжается после этой папки."""
+    root = tmp_path / "tree"
+    for rel in ["a/x/f1", "a/y/f2", "a/y/z/f3", "b/f4", "c/f5", "top"]:
+        (root / rel).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel).write_text(rel)
+    keys = scanner.build_exclusion_keys(str(root), [])
+
+    order = [os.path.relpath(path, root) for path, _ in scanner.walk_files(str(root), keys)]
+    assert order == ["top"] + [os.path.join(*p.split("/")) for p in ["a/x/f1", "a/y/f2", "a/y/z/f3", "b/f4", "c/f5"]]
+
+    scandir = mocker.spy(scanner.os, "scandir")
+    resumed = [os.path.relpath(path, root) for path, _ in
+               scanner.walk_files(str(root), keys, resume_after=str(root / "a" / "y"))]
+    assert resumed == [os.path.join("a", "y", "z", "f3"), os.path.join("b", "f4"), os.path.join("c", "f5")]
+    # Поддерево, целиком пройденное до точки продолжения, не читается
+    assert str(root / "a" / "x") not in [c.args[0] for c in scandir.call_args_list]
+
+
+def test_unchanged_directories_are_not_listed(tmp_path, mocker):
+    """Тест: с индексом папок неизмененные папки не читаются, а их известные файлы запрашиваются по одному."""
+    root = tmp_path / "tree"
+    for rel in ["a/known.txt", "b/known.txt", "b/c/known.txt"]:
+        (root / rel).parent.mkdir(parents=True, exist_ok=True)
+        (root / rel).write_text(rel)
+    for directory in [root, root / "a", root / "b", root / "b" / "c"]:
+        os.utime(directory, (1_600_000_000, 1_600_000_000))
+    keys = scanner.build_exclusion_keys(str(root), [])
+    known = [str(root / rel) for rel in ["a/known.txt", "b/known.txt", "b/c/known.txt"]]
+
+    first = scanner.DirIndex({}, known, trusted_before_ns=2_000_000_000 * 10 ** 9)
+    assert {path for path, _ in scanner.walk_files(str(root), keys, dir_index=first)} == set(known)
+    assert len(first.visited) == 4
+
+    (root / "b" / "new.txt").write_text("новый") # Меняет mtime только папки b
+    scandir = mocker.spy(scanner.os, "scandir")
+    second = scanner.DirIndex(first.visited, known, trusted_before_ns=2_000_000_000 * 10 ** 9)
+    found = {path for path, _ in scanner.walk_files(str(root), keys, dir_index=second)}
+    assert found == set(known) | {str(root / "b" / "new.txt")}
+    assert [c.args[0] for c in scandir.call_args_list] == [str(root / "b")]
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+# Тесты для миграций схемы базы данных
+import sqlite3
+
+import pytest
+
+from app import schema
+
+
+@pytest.fixture
+def connection():
+    """Соединение с базой в памяти с базовой схемой в ее исходном виде."""
+    conn = sqlite3.connect(':memory:')
+    conn.executescript("""
+        CREATE TABLE tracked_files (id INTEGER PRIMARY KEY, original_path TEXT NOT NULL UNIQUE);
+        CREATE TABLE versions (
+            id INTEGER PRIMARY KEY, file_id INTEGER NOT NULL, timestamp TEXT NOT NULL,
+            sha256_hash TEXT NOT NULL, file_size INTEGER NOT NULL);
+        CREATE INDEX idx_versions_file_id ON versions (file_id);
+        CREATE TABLE objects (
+            hash TEXT PRIMARY KEY, size INTEGER NOT NULL, refcount INTEGER NOT NULL DEFAULT 0,
+            stored_size INTEGER, codec INTEGER) WITHOUT ROWID;
+        CREATE TABLE object_chunks (
+            object_hash TEXT NOT NULL, seq INTEGER NOT NULL, chunk_hash TEXT NOT NULL, chunk_size INTEGER NOT NULL,
+            PRIMARY KEY (object_hash, seq));
+    """)
+    yield conn
+    conn.close()
+
+
+def test_migrations_are_applied_once_in_order(connection):
+    """Тест: миграции применяются по порядку, повышают user_version и не повторяются."""
+    reports = []
+    applied = schema.migrate(connection, lambda description, fraction: reports.append(fraction))
+    assert applied == [m.version for m in schema.MIGRATIONS]
+    assert schema.get_schema_version(connection) == schema.LATEST_VERSION
+    assert reports[0] == 0.0 and reports[-1] == 1.0
+
+    assert schema.migrate(connection) == []
+
+
+def test_latest_version_lookup_uses_covering_index(connection):
+    """Тест: поиск последней версии файла и версий по хешу идут по индексам."""
+    schema.migrate(connection)
+    plan = " ".join(row[-1] for row in connection.execute(
+        "EXPLAIN QUERY PLAN SELECT sha256_hash FROM versions WHERE file_id = ? ORDER BY timestamp DESC LIMIT 1", (1,)))
+    assert "COVERING INDEX idx_versions_file_time" in plan
+    plan = " ".join(row[-1] for row in connection.execute(
+        "EXPLAIN QUERY PLAN SELECT COUNT(*) FROM versions WHERE sha256_hash = ?", ("aa",)))
+    assert "idx_versions_hash_time" in plan
+    indexes = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    assert "idx_versions_file_id" not in indexes
+
+
+def test_failed_migration_is_rolled_back(connection):
+    """Тест: упавшая миграция откатывается целиком, а предыдущие остаются примененными."""
+    def create_table(cursor, report):
+        cursor.execute("CREATE TABLE first (id INTEGER)")
+
+    def broken(cursor, report):
+        cursor.execute("CREATE TABLE second (id INTEGER)")
+        raise sqlite3.OperationalError("сбой посреди миграции")
+
+    migrations = [schema.Migration(1, "first", create_table), schema.Migration(2, "broken", broken)]
+    with pytest.raises(sqlite3.OperationalError):
+        schema.migrate(connection, migrations=migrations)
+
+    assert schema.get_schema_version(connection) == 1
+    tables = {row[0] for row in connection.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    assert "first" in tables and "second" not in tables
+
+
+def test_hash_algorithm_columns_default_to_sha256(connection):
+    """Тест: объекты, сохраненные до миграции, считаются адресованными SHA-256."""
+    connection.execute("INSERT INTO objects (hash, size, refcount) VALUES ('aa', 1, 1)")
+    connection.commit()
+    schema.migrate(connection)
+    assert connection.execute("SELECT hash_algorithm, quick_hash FROM objects").fetchone() == ("sha256", None)
+    connection.execute("INSERT INTO store_properties (name, value) VALUES ('hash_algorithm', 'blake3')")
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+# Тесты для скомпилированных правил отслеживания
+from app.watch_rules import WatchRules
+
+
+def test_exclusions_apply_only_to_their_own_folder(fs):
+    """Тест: исключение одной папки не мешает другой папке-элементу отслеживать тот же путь."""
+    fs.create_dir("/data/build/keep")
+    items = [
+        {"path": "/data", "type": "folder", "exclusions": ["/data/build"]},
+        {"path": "/data/build/keep", "type": "folder", "exclusions": []},
+        {"path": "/notes/todo.txt", "type": "file", "exclusions": []},
+    ]
+    rules = WatchRules(items)
+
+    assert rules.is_watched("/data/report.txt")
+    assert not rules.is_watched("/data/build/out.o")
+    assert rules.is_watched("/data/build/keep/config.ini")
+    assert rules.is_watched("/notes/todo.txt")
+    assert not rules.is_watched("/notes/other.txt")
+    assert not rules.is_watched("/database/file.txt") # Совпадение по компонентам, а не по префиксу строки
+
+    # Файл относится к первой по порядку настроек папке, в которой он отслеживается
+    assert rules.folder_of("/data/build/keep/config.ini") is items[1]
+    assert rules.folder_of("/data/report.txt") is items[0]
+    assert rules.folder_of("/notes/todo.txt") is None
+    assert rules.exclusion_keys(items[0]) == {"/data/build"}
+
+
+def test_matching_paths_are_checked_without_resolving(fs):
+    """Тест: пути, подходящие как есть, не разрешаются; путь через ссылку разрешается с кешем по папке."""
+    fs.create_dir("/real/project/src")
+    fs.create_symlink("/link", "/real/project")
+    rules = WatchRules([{"path": "/real/project", "type": "folder", "exclusions": ["/real/project/src"]}])
+
+    assert rules.is_watched("/real/project/a.txt")
+    assert rules._resolve_dir.cache_info().currsize == 0
+
+    assert rules.is_watched("/link/a.txt")
+    assert rules.is_watched("/link/b.txt")
+    assert not rules.is_watched("/link/src/c.txt")
+    assert rules._resolve_dir.cache_info().hits == 1 # Папка /link разрешена один раз
+
+
+def test_patterns_filter_events_of_their_folder(fs):
+    """Тест: шаблоны папки-элемента применяются к пути относительно ее корня."""
+    items = [{"path": "/repo", "type": "folder", "exclusions": [],
+              "exclude_patterns": ["node_modules", "*.tmp"], "include_patterns": ["src/**", "*.md"]}]
+    rules = WatchRules(items)
+
+    assert rules.is_watched("/repo/src/main.py")
+    assert rules.is_watched("/repo/README.md")
+    assert not rules.is_watched("/repo/setup.cfg")
+    assert not rules.is_watched("/repo/src/node_modules/lib/index.js")
+    assert not rules.is_watched("/repo/src/~lock.tmp")
+    assert rules.patterns(items[0]) is not None
+
+
+def test_ignore_files_are_opt_in_and_invalidated_on_change(fs):
+    """Тест: .gitignore учитывается только для папок с use_ignore_files, а его изменение сбрасывает кеш правил."""
+    fs.create_file("/repo/.gitignore", contents="*.log\n")
+    fs.create_file("/plain/.gitignore", contents="*.log\n")
+    rules = WatchRules([
+        {"path": "/repo", "type": "folder", "exclusions": [], "use_ignore_files": True},
+        {"path": "/plain", "type": "folder", "exclusions": []},
+    ])
+
+    assert not rules.is_watched("/repo/debug.log")
+    assert rules.is_watched("/repo/main.py")
+    assert rules.is_watched("/plain/debug.log")
+
+    with open("/repo/.gitignore", "w") as f:
+        f.write("*.py\n")
+    assert not rules.is_watched("/repo/debug.log") # До события правила берутся из кеша
+    rules.ignore_file_changed("/repo/.gitignore")
+    assert rules.is_watched("/repo/debug.log")
+    assert not rules.is_watched("/repo/main.py")